@@ -1,6 +1,11 @@
 from __future__ import absolute_import
 
 import os, time
+import shutil
+import warnings
+import cPickle
+
+import numpy
 
 from Orange.orng import orngServerFiles
 
@@ -11,6 +16,8 @@ from .. import dicty as obiDicty
 from .. import biomart as obiBioMart
 
 from . import homology
+from ..utils.compiled import save_arrays, load_arrays, file_key, LOAD_ERRORS, \
+    csr_gather, csr_unique
 
 default_database_path = orngServerFiles.localpath("NCBI_geneinfo")
 
@@ -424,6 +431,55 @@ def join_sets_l(lsets, lower=False):
         current = join_sets(current, b, lower=lower)
     return current
 
+def _overlapping_groups(index1, index2):
+    """
+    Return (groups1, groups2) arrays of all pairs of groups from two 
+    AliasIndex instances that share a key.
+    """
+    common = numpy.intersect1d(index1.keys, index2.keys)
+    keys1 = numpy.searchsorted(index1.keys, common)
+    keys2 = numpy.searchsorted(index2.keys, common)
+    positions, groups1 = csr_gather(index1.key_indptr, index1.key_groups, keys1)
+    #pair each group with all groups of index2 containing the same key
+    repeats, groups2 = csr_gather(index2.key_indptr, index2.key_groups, keys2[positions])
+    n2 = max(len(index2), 1)
+    pairs = numpy.unique(numpy.asarray(groups1, dtype=numpy.int64)[repeats] * n2 + groups2)
+    return divmod(pairs, n2)
+
+def join_aliases(sources, lower=False):
+    """
+    Join groups of aliases from any number of sources (lists of sets of
+    aliases or :obj:`AliasIndex` instances) as join_sets_l does: each 
+    pair of groups from the sources joined so far and the next source
+    that share an alias (compared in lower case if lower) is joined into 
+    a new group, groups without a match are kept unchanged. Groups from 
+    the same source are never joined. 
+
+    Overlapping groups are found on the compiled indices. The groups are
+    ordered by their sorted aliases, so joining two sources does not 
+    depend on their order.
+    """
+    indices = []
+    for source in sources:
+        if not (isinstance(source, AliasIndex) and source.ignore_case == lower):
+            source = AliasIndex.from_aliases(source, ignore_case=lower)
+        indices.append(source)
+    if not indices:
+        return []
+
+    current = indices[0]
+    for index in indices[1:]:
+        groups1, groups2 = _overlapping_groups(current, index)
+        aliases1, aliases2 = current.aliases(), index.aliases()
+        joined = [ aliases1[i] | aliases2[j] 
+                   for i, j in zip(groups1.tolist(), groups2.tolist()) ]
+        used1, used2 = set(groups1.tolist()), set(groups2.tolist())
+        joined.extend(aliases1[i] for i in range(len(current)) if i not in used1)
+        joined.extend(aliases2[j] for j in range(len(index)) if j not in used2)
+        current = AliasIndex.from_aliases(joined, ignore_case=lower)
+
+    return sorted(current.aliases(), key=sorted)
+
 class Matcher(object):
     """
     Matches an input gene to some target gene (set in advance).
@@ -456,6 +512,43 @@ class Matcher(object):
         """
         notImplemented()
 
+    def match_many(self, genes):
+        """
+        Match a list of genes at once. Return (indptr, indices) arrays:
+        matches of genes[i] are targets[indices[indptr[i]:indptr[i+1]]].
+        """
+        return self.matcho.match_many(genes)
+
+    def umatch_many(self, genes):
+        """
+        Return an array of indices of unique matching targets of genes 
+        (-1 if there are no or multiple matches).
+        """
+        return self.matcho.umatch_many(genes)
+
+    @property
+    def targets(self):
+        """ Target genes (indexed by match_many and umatch_many). """
+        return self.matcho.targets
+
+def umatch_names(matcher, genes):
+    """
+    Return a list of unique matching target genes of genes (None if there
+    are no or multiple matches). Matchers without umatch_many or
+    targets, or with targets that do not include all their matches,
+    are queried with umatch for each gene.
+    """
+    genes = list(genes)
+    targets = getattr(matcher, "targets", None)
+    if hasattr(matcher, "umatch_many") and targets is not None and \
+            len(targets):
+        try:
+            return [targets[i] if i >= 0 else None
+                    for i in matcher.umatch_many(genes)]
+        except ValueError:
+            pass
+    return [matcher.umatch(gene) for gene in genes]
+
 def buffer_path():
     """ Returns buffer path from Orange's setting folder if not 
     defined differently (in gene_matcher_path). """
@@ -510,6 +603,194 @@ def auto_pickle(filename, version, func, *args, **kwargs):
 
     return output
 
+def _bytes(alias):
+    return alias.encode("utf-8") if isinstance(alias, unicode) else alias
+
+def _string_array(strings):
+    strings = numpy.array(strings, dtype=str)
+    return strings if len(strings) else numpy.array([], dtype="S1")
+
+class AliasIndex(object):
+    """
+    A compiled index of groups of gene aliases: a sorted table of
+    aliases (lower case if ignore_case) with ids of groups that contain
+    them, and the groups as indices into a sorted table of names.
+
+    Lookups are binary searches in the sorted table. The index is saved
+    as a directory of numpy arrays which are memory mapped when loaded,
+    so loading is fast and processes using the same index share one copy.
+    Unicode aliases are stored UTF-8 encoded.
+    """
+
+    version = 1
+    _ARRAYS = ["keys", "key_indptr", "key_groups",
+               "names", "group_indptr", "group_names"]
+
+    def __init__(self, arrays, meta):
+        for name in self._ARRAYS:
+            setattr(self, name, arrays[name])
+        self.ignore_case = meta["ignore_case"]
+        self.key = meta.get("key")
+
+    @classmethod
+    def from_aliases(cls, aliases, ignore_case=True):
+        """ Build an index from a list of sets of aliases. """
+        flat, sizes = [], []
+        for group in aliases:
+            flat.extend(group)
+            sizes.append(len(group))
+        ngroups = len(sizes)
+        members = numpy.repeat(numpy.arange(ngroups, dtype=numpy.int64), sizes)
+
+        names, name_ids = numpy.unique(
+            _string_array([ _bytes(a) for a in flat ]), return_inverse=True)
+        #unique (group, name) pairs, sorted by group
+        pairs = numpy.unique(members * max(len(names), 1) + name_ids)
+        members, name_ids = divmod(pairs, max(len(names), 1))
+        group_indptr = numpy.searchsorted(members, numpy.arange(ngroups + 1))
+
+        if ignore_case:
+            keys, name_keys = numpy.unique(
+                _string_array([ n.lower() for n in names.tolist() ]), 
+                return_inverse=True)
+        else:
+            keys, name_keys = names, numpy.arange(len(names))
+        #unique (key, group) pairs, sorted by key
+        pairs = numpy.unique(name_keys[name_ids] * max(ngroups, 1) + members)
+        rows, cols = divmod(pairs, max(ngroups, 1))
+        key_indptr = numpy.searchsorted(rows, numpy.arange(len(keys) + 1))
+
+        arrays = {"keys": _string_array(keys),
+                  "key_indptr": key_indptr.astype(numpy.int64),
+                  "key_groups": cols.astype(numpy.int32),
+                  "names": _string_array(names),
+                  "group_indptr": group_indptr.astype(numpy.int64),
+                  "group_names": name_ids.astype(numpy.int32)}
+        return cls(arrays, {"ignore_case": ignore_case})
+
+    def __len__(self):
+        """ Number of groups. """
+        return len(self.group_indptr) - 1
+
+    def group(self, i):
+        """ Return the set of aliases in group i. """
+        names = self.group_names[self.group_indptr[i]:self.group_indptr[i+1]]
+        return set(self.names[names].tolist())
+
+    def find(self, alias):
+        """ Return the index of alias in the key table or -1. """
+        alias = _bytes(alias)
+        if self.ignore_case:
+            alias = alias.lower()
+        i = int(numpy.searchsorted(self.keys, alias))
+        if i < len(self.keys) and self.keys[i] == alias:
+            return i
+        return -1
+
+    def groups(self, alias):
+        """ Return a set of ids of groups containing alias. """
+        i = self.find(alias)
+        if i < 0:
+            return set()
+        return set(self.key_groups[self.key_indptr[i]:self.key_indptr[i+1]].tolist())
+
+    def find_many(self, aliases):
+        """ Return an array of indices of aliases in the key table (-1 if missing). """
+        if self.ignore_case:
+            aliases = [ _bytes(a).lower() for a in aliases ]
+        else:
+            aliases = [ _bytes(a) for a in aliases ]
+        aliases = _string_array(aliases)
+        found = numpy.searchsorted(self.keys, aliases)
+        ok = found < len(self.keys)
+        ok[ok] = self.keys[found[ok]] == aliases[ok]
+        return numpy.where(ok, found, -1)
+
+    def groups_many(self, aliases):
+        """ 
+        Return (positions, group ids) arrays of groups containing aliases:
+        aliases[positions[j]] is in group ids[j].
+        """
+        keys = self.find_many(aliases)
+        rows = numpy.flatnonzero(keys >= 0)
+        positions, groups = csr_gather(self.key_indptr, self.key_groups, keys[rows])
+        return rows[positions], groups
+
+    def aliases(self):
+        """ Return the groups as a (lazy) list of sets of aliases. """
+        return _IndexAliases(self)
+
+    def mapping(self):
+        """ Return a mapping of aliases to group ids (as create_mapping). """
+        return _IndexMapping(self)
+
+    def save(self, path, key=None):
+        """
+        Save the index into a directory path. The directory is written
+        under a temporary name and then renamed into place.
+        """
+        save_arrays(path, self, {"key": key, "ignore_case": self.ignore_case})
+        self.key = key
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """ Load an index saved with save, memory mapping its arrays. """
+        return cls(*load_arrays(path, cls, mmap_mode))
+
+    @classmethod
+    def load_cached(cls, path, key):
+        """ Return the index saved in path with key or None. """
+        try:
+            index = cls.load(path)
+        except LOAD_ERRORS:
+            return None
+        return index if index.key == key else None
+
+class _IndexAliases(object):
+    """ Groups of an AliasIndex as a read-only list of sets. """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.index.group(i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.index.group(i)
+
+class _IndexMapping(object):
+    """ Aliases to group ids mapping of an AliasIndex. Like the 
+    defaultdict of create_mapping, unknown aliases map to an empty set. """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index.keys)
+
+    def __getitem__(self, alias):
+        return self.index.groups(alias)
+
+    def __contains__(self, alias):
+        return self.index.find(alias) >= 0
+
+    def get(self, alias, default=None):
+        return self.index.groups(alias) if alias in self else default
+
+    def __iter__(self):
+        return iter(self.index.keys.tolist())
+
+    def keys(self):
+        return self.index.keys.tolist()
+
 class MatcherAliases(Matcher):
     """
     Genes matcher based on a list of sets of given aliases.
@@ -529,19 +810,41 @@ class MatcherAliases(Matcher):
             gene = gene.lower()
         return self.mdict[gene]
 
+    def to_ids_many(self, genes):
+        """ 
+        Return (positions, ids) arrays of sets of aliases the genes belong
+        to: genes[positions[j]] belongs to the set ids[j].
+        """
+        mdict = self.mdict
+        if isinstance(mdict, _IndexMapping):
+            return mdict.index.groups_many(genes)
+        positions, ids = [], []
+        for i, gene in enumerate(genes):
+            if self.ignore_case:
+                gene = gene.lower()
+            for id in mdict.get(gene, ()):
+                positions.append(i)
+                ids.append(id)
+        return numpy.array(positions, dtype=int), numpy.array(ids, dtype=int)
+
     def set_targets(self, targets):
         """
         A reverse dictionary is made according to each target's membership
         in the sets of aliases.
         """
+        targets = list(targets)
         d = defaultdict(list)
         #d = id: [ targets ], where id is index of the set of aliases
-        for target in targets:
+        pairs = []
+        first = {}
+        for i, target in enumerate(targets):
             ids = self.to_ids(target)
             if ids != None:
+                i = first.setdefault(target, i)
                 for id in ids:
                     d[id].append(target)
-        mo = MatchAliases(d, self)
+                    pairs.append((id, i))
+        mo = MatchAliases(d, self, targets, pairs)
         self.matcho = mo #backward compatibility - default match object
         return mo
 
@@ -553,16 +856,66 @@ class MatcherAliases(Matcher):
 
 class Match(object):
 
+    targets = []
+
     def umatch(self, gene):
         """Returns an unique (only one matching target) target or None"""
         mat = self.match(gene)
         return mat[0] if len(mat) == 1 else None
+
+    def match_many(self, genes):
+        """
+        Match a list of genes at once. Return (indptr, indices) arrays:
+        matches of genes[i] are targets[indices[indptr[i]:indptr[i+1]]].
+        Raise ValueError if a gene matches a target which is not in
+        targets (then use match for each gene).
+        """
+        genes = list(genes)
+        index = {}
+        for i, target in enumerate(self.targets):
+            index.setdefault(target, i)
+        rows, cols = [], []
+        for i, gene in enumerate(genes):
+            for target in self.match(gene):
+                if target not in index:
+                    raise ValueError("Matched target %r is not in targets"
+                                     % (target,))
+                rows.append(i)
+                cols.append(index[target])
+        return csr_unique(len(genes), rows, cols)
+
+    def umatch_many(self, genes):
+        """
+        Return an array of indices of unique matching targets of genes 
+        (-1 if there are no or multiple matches).
+        """
+        indptr, indices = self.match_many(genes)
+        unique = numpy.diff(indptr) == 1
+        result = numpy.empty(len(indptr) - 1, dtype=int)
+        result.fill(-1)
+        result[unique] = indices[indptr[:-1][unique]]
+        return result
  
 class MatchAliases(Match):
 
-    def __init__(self, to_targets, parent):
+    def __init__(self, to_targets, parent, targets=None, pairs=None):
         self.to_targets = to_targets
         self.parent = parent
+        self.targets = targets if targets is not None else []
+        #sorted ids of sets of aliases with target indices (as CSR)
+        pairs = numpy.array(sorted(pairs or []), dtype=int).reshape(-1, 2)
+        self._ids, starts = numpy.unique(pairs[:, 0], return_index=True)
+        self._ids_indptr = numpy.append(starts, len(pairs))
+        self._ids_targets = pairs[:, 1]
+
+    def match_many(self, genes):
+        genes = list(genes)
+        positions, ids = self.parent.to_ids_many(genes)
+        j = numpy.searchsorted(self._ids, ids)
+        ok = j < len(self._ids)
+        ok[ok] = self._ids[j[ok]] == ids[ok]
+        rows, targets = csr_gather(self._ids_indptr, self._ids_targets, j[ok])
+        return csr_unique(len(genes), positions[ok][rows], targets)
 
     def match(self, gene):
         """
@@ -590,6 +943,9 @@ class MatcherAliasesPickled(MatcherAliases):
     Loading of gene aliases is done lazily: they are loaded when they are
     needed. Loading of aliases for components of joined matchers is often 
     unnecessary and is therefore avoided. 
+
+    Aliases are stored as a compiled :obj:`AliasIndex` (built once for
+    each version of the aliases) which is memory mapped when loaded.
     """
     
     def set_aliases(self, aliases):
@@ -606,7 +962,11 @@ class MatcherAliasesPickled(MatcherAliases):
     def get_mdict(self):
         """ Creates mdict. Aliases are loaded if needed. """
         if not self.saved_mdict:
-            self.saved_mdict = create_mapping(self.aliases, self.ignore_case)
+            index = self.alias_index()
+            if index is not None:
+                self.saved_mdict = index.mapping()
+            else:
+                self.saved_mdict = create_mapping(self.aliases, self.ignore_case)
         return self.saved_mdict
 
     def set_mdict(self, mdict):
@@ -630,19 +990,58 @@ class MatcherAliasesPickled(MatcherAliases):
         notImplemented()
 
     def load_aliases(self):
-        fn = self.filename()
-        ver = self.create_aliases_version() #if version == None ignore it
-        if fn != None:
-            if isinstance(fn, tuple): #if you pass tuple, look directly
-               filename = fn[0]
-            else:
-               filename = os.path.join(buffer_path(), fn)
-            return auto_pickle(filename, ver, self.create_aliases)
+        index = self.alias_index()
+        if index is not None:
+            return index.aliases()
         else:
             #if either file version of version is None, do not pickle
             return self.create_aliases()
 
+    def alias_index(self):
+        """ 
+        Return the compiled :obj:`AliasIndex` of aliases or None if the
+        aliases can not be pickled. The index is saved next to the
+        pickled aliases and rebuilt when their version changes.
+        """
+        if self._alias_index is not None:
+            return self._alias_index
+        fn = self.filename()
+        if fn == None:
+            return None
+        if isinstance(fn, tuple): #if you pass tuple, look directly
+           filename = fn[0]
+        else:
+           filename = os.path.join(buffer_path(), fn)
+        ver = self.create_aliases_version() #if version == None ignore it
+
+        def key():
+            return "v%i.%s" % (AliasIndex.version, 
+                ver if ver != None else file_key(filename))
+
+        path = filename + (".ic" if self.ignore_case else "") + ".compiled"
+        index = None
+        if ver != None or os.path.exists(filename):
+            index = AliasIndex.load_cached(path, key())
+        if index is None:
+            if self.pickle_aliases:
+                aliases = auto_pickle(filename, ver, self.create_aliases)
+            else:
+                aliases = self.create_aliases()
+            index = AliasIndex.from_aliases(aliases, self.ignore_case)
+            if ver != None or os.path.exists(filename):
+                try:
+                    index.save(path, key())
+                except (IOError, OSError):
+                    warnings.warn("Could not save the alias index to %r" % path,
+                                  UserWarning)
+        self._alias_index = index
+        return index
+
+    #if False, only the compiled index of aliases is saved
+    pickle_aliases = True
+
     def __init__(self, ignore_case=True):
+        self._alias_index = None
         self.aliases = []
         self.mdict = {}
         self.ignore_case = ignore_case
@@ -827,13 +1226,24 @@ class MatcherAliasesPickledJoined(MatcherAliasesPickled):
     Sets of aliases are joined if they contain common genes.
 
     The joined gene matcher can only be pickled if the source gene
-    matchers are picklable.
+    matchers are picklable. The aliases of matchers are joined in the
+    order of their file names, so the joined aliases (and their file
+    name) do not depend on the order of matchers. Only their compiled
+    index is saved.
     """
 
+    pickle_aliases = False
+
+    def _sorted_matchers(self):
+        try:
+            return sorted(self.matchers, key=lambda mat: mat.filename())
+        except:
+            return list(self.matchers)
+
     def filename(self):
         # do not pickle if any is unpicklable
         try:
-            filenames = [ mat.filename() for mat in self.matchers ]
+            filenames = sorted([ mat.filename() for mat in self.matchers ])
             if self.ignore_case:
                 filenames += [ "icj" ]
             return "__".join(filenames)
@@ -841,11 +1251,16 @@ class MatcherAliasesPickledJoined(MatcherAliasesPickled):
             return None
 
     def create_aliases(self):
-        return join_sets_l([ mat.aliases for mat in self.matchers ], lower=self.ignore_case)
+        sources = []
+        for mat in self._sorted_matchers():
+            index = getattr(mat, "alias_index", lambda: None)()
+            sources.append(index if index is not None else mat.aliases)
+        return join_aliases(sources, lower=self.ignore_case)
 
     def create_aliases_version(self):
         try:
-            return "v4_" + "__".join([ mat.create_aliases_version() for mat in self.matchers ])
+            return "v6_" + "__".join([ mat.create_aliases_version() 
+                                       for mat in self._sorted_matchers() ])
         except:
             return None
 
@@ -856,8 +1271,6 @@ class MatcherAliasesPickledJoined(MatcherAliasesPickled):
 
         If ignore_case is True, ignores case when joining gene aliases.
         """
-        #FIXME: sorting of matchers to avoid multipying pickled files for
-        #different orderings.
         self.matchers = matchers
         allic = set([ m.ignore_case for m in self.matchers ])
         if len(allic) > 1:
@@ -881,7 +1294,7 @@ class MatcherSequence(Matcher):
                                 #be problematic if a generator was passed
         for matcher in self.matchers:
             ms.append(matcher.set_targets(targets))
-        om = MatchSequence(ms)
+        om = MatchSequence(ms, targets)
         self.matcho = om
         return om
 
@@ -894,8 +1307,26 @@ class MatcherSequence(Matcher):
 
 class MatchSequence(Match):
 
-    def __init__(self, ms):
+    def __init__(self, ms, targets=None):
         self.ms = ms
+        self.targets = targets if targets is not None else []
+
+    def match_many(self, genes):
+        """ Genes are passed to the next match only if they were not matched. """
+        genes = list(genes)
+        remaining = numpy.arange(len(genes))
+        rows, cols = [], []
+        for match in self.ms:
+            if not len(remaining):
+                break
+            indptr, indices = match.match_many([ genes[i] for i in remaining ])
+            counts = numpy.diff(indptr)
+            rows.append(numpy.repeat(remaining, counts))
+            cols.append(indices)
+            remaining = remaining[counts == 0]
+        if not rows:
+            return csr_unique(len(genes), [], [])
+        return csr_unique(len(genes), numpy.concatenate(rows), numpy.concatenate(cols))
 
     def match(self, gene):
         for match in self.ms:
@@ -14,16 +14,21 @@ import cPickle
 import shutil
 import urllib2
 import warnings
+import multiprocessing
 
 from gzip import GzipFile
-from collections import defaultdict
+from collections import defaultdict, MutableMapping
 from operator import attrgetter
 
+import numpy
+
 from Orange.utils import \
     deprecated_keywords, deprecated_members, progress_bar_milestones, \
     serverfiles, environ
 
 from .utils import stats
+from .utils.compiled import save_arrays, load_arrays, file_key, LOAD_ERRORS, \
+    csr_from_pairs, csr_gather
 
 from . import gene as obiGene, taxonomy as obiTaxonomy
 
@@ -171,6 +176,7 @@ class OBOObject(object):
 
     def parse_stanza(self, stanza):
         intern_tags = set(self._INTERN_TAGS)
+        lines = []
         for line in stanza.splitlines():
             if ":" not in line:
                 continue
@@ -188,6 +194,13 @@ class OBOObject(object):
             comment = comment.strip()
             if tag in intern_tags:
                 value, comment = intern(value), intern(comment)
+            lines.append((tag, value, modifiers, comment))
+        self.add_lines(lines)
+
+    def add_lines(self, lines):
+        """Add already parsed (tag, value, modifiers, comment) tuples.
+        """
+        for tag, value, modifiers, comment in lines:
             self._lines.append((tag, value, modifiers, comment))
             if tag in multipleTagSet:
                 self.values.setdefault(tag, []).append(value)
@@ -284,13 +297,7 @@ class Ontology(object):
 
     @deprecated_keywords({"progressCallback": "progress_callback"})
     def __init__(self, filename=None, progress_callback=None, rev=None):
-        self.terms = {}
-        self.typedefs = {}
-        self.instances = {}
-        self.slims_subset = set()
-        self.alias_mapper = {}
-        self.reverse_alias_mapper = defaultdict(set)
-        self.header = ""
+        self._reset()
 
         if filename is not None:
             self.parse_file(filename, progress_callback)
@@ -312,7 +319,18 @@ class Ontology(object):
             filename = serverfiles.localpath_download(
                 "GO", "gene_ontology_edit.obo.tar.gz"
             )
-            self.parse_file(filename, progress_callback)
+            self._load_compiled(filename, progress_callback)
+
+    def _reset(self):
+        self.terms = {}
+        self.typedefs = {}
+        self.instances = {}
+        self.slims_subset = set()
+        self.alias_mapper = {}
+        self.reverse_alias_mapper = defaultdict(set)
+        self.header = ""
+        self._snapshot = None
+        self._closure = None
 
     @classmethod
     @deprecated_keywords({"progressCallback": "progress_callback"})
@@ -327,10 +345,64 @@ class Ontology(object):
         if not os.path.isfile(filename) and not os.path.isdir(filename):
             serverfiles.download("GO", "gene_ontology_edit.obo.tar.gz")
 
-        return cls(filename, progress_callback=progress_callback)
+        return cls.load_compiled(filename, progress_callback)
 
     Load = load
 
+    @classmethod
+    def load_compiled(cls, filename, progress_callback=None):
+        """ Load the ontology from `filename` using a compiled
+        :class:`OntologySnapshot` stored next to it (in
+        `filename + ".compiled"`). The snapshot is (re)built if missing
+        or older than the file.
+
+        """
+        ontology = cls.__new__(cls)
+        ontology._reset()
+        ontology._load_compiled(filename, progress_callback)
+        return ontology
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """ Return an ontology backed by an :class:`OntologySnapshot`.
+        Term objects are created from the snapshot on first access.
+
+        """
+        ontology = cls.__new__(cls)
+        ontology._reset()
+        ontology._set_snapshot(snapshot)
+        return ontology
+
+    def _load_compiled(self, filename, progress_callback=None):
+        snapshot = _load_cached(OntologySnapshot, filename)
+        if snapshot is not None:
+            self._set_snapshot(snapshot)
+        else:
+            self.parse_file(filename, progress_callback)
+            _save_cached(OntologySnapshot.from_ontology(self), filename)
+
+    def _set_snapshot(self, snapshot):
+        self._snapshot = snapshot
+        self._closure = None
+        self.header = snapshot.header
+        self.terms = _SnapshotTerms(snapshot, self)
+        self.typedefs = {}
+        for lines in snapshot.typedefs:
+            typedef = Typedef(ontology=self)
+            typedef.add_lines(lines)
+            self.typedefs[typedef.id] = typedef
+        self.instances = {}
+        for lines in snapshot.instances:
+            instance = Instance(ontology=self)
+            instance.add_lines(lines)
+            self.instances[instance.id] = instance
+        self.alias_mapper = dict(
+            zip(map(intern, snapshot.alt_ids.tolist()),
+                [snapshot.term_ids[i] for i in snapshot.alt_terms]))
+        self.reverse_alias_mapper = defaultdict(set)
+        for alt, termid in self.alias_mapper.iteritems():
+            self.reverse_alias_mapper[termid].add(alt)
+
     @deprecated_keywords({"progressCallback": "progress_callback"})
     def parse_file(self, file, progress_callback=None):
         """ Parse the file. file can be a filename string or an open filelike
@@ -378,11 +450,12 @@ class Ontology(object):
             try:
                 self.alias_mapper.update([(alt_id, id)
                                           for alt_id in term.alt_id])
-                self.reverse_alias_mapper[id].union_update(term.alt_id)
+                self.reverse_alias_mapper[id].update(term.alt_id)
             except AttributeError:
                 pass
             if progress_callback and i in milestones:
                 progress_callback(90.0 + 10.0 * i / len(self.terms))
+        self._closure = None
 
     def defined_slims_subsets(self):
         """
@@ -404,6 +477,9 @@ class Ontology(object):
         .. seealso:: :func:`defined_slims_subsets`
 
         """
+        if self._snapshot is not None:
+            return [self._snapshot.term_ids[i]
+                    for i in self._snapshot.subset_terms(subset)]
         return [id for id, term in self.terms.items()
                 if subset in getattr(term, "subset", set())]
 
@@ -431,18 +507,25 @@ class Ontology(object):
         :param str term: Term ID.
 
         """
-        queue = set([term])
+        if term in self.slims_subset:
+            return set([term])
+        closure = self.closure_index()
+        slims = set(closure.term_index[t] for t in self.slims_subset
+                    if t in closure.term_index)
+        indptr, indices = closure.parent_indptr, closure.parent_indices
+        i = self._term_indices([term])[0]
+        queue = set(indices[indptr[i]: indptr[i + 1]].tolist())
         visited = set()
-        slims = set()
+        result = set()
         while queue:
-            term = queue.pop()
-            visited.add(term)
-            if term in self.slims_subset:
-                slims.add(term)
+            i = queue.pop()
+            visited.add(i)
+            if i in slims:
+                result.add(closure.term_ids[i])
             else:
-                queue.update(set(tid for _, tid in self[term].related) -
+                queue.update(set(indices[indptr[i]: indptr[i + 1]].tolist()) -
                              visited)
-        return slims
+        return result
 
     def extract_super_graph(self, terms):
         """
@@ -452,14 +535,9 @@ class Ontology(object):
 
         """
         terms = [terms] if isinstance(terms, basestring) else terms
-        visited = set()
-        queue = set(terms)
-        while queue:
-            term = queue.pop()
-            visited.add(term)
-            queue.update(set(tid for _, tid in self[term].related) -
-                         visited)
-        return visited
+        closure = self.closure_index()
+        ancestors = closure.ancestors(self._term_indices(terms))
+        return set(terms) | set(closure.term_ids[i] for i in ancestors)
 
     def extract_sub_graph(self, terms):
         """
@@ -469,27 +547,38 @@ class Ontology(object):
 
         """
         terms = [terms] if type(terms) == str else terms
-        visited = set()
-        queue = set(terms)
-        while queue:
-            term = queue.pop()
-            visited.add(term)
-            queue.update(set(tid for _, tid in self[term].related_to) -
-                         visited)
-        return visited
+        closure = self.closure_index()
+        descendants = closure.descendants(self._term_indices(terms))
+        return set(terms) | set(closure.term_ids[i] for i in descendants)
 
-    def term_depth(self, term, cache_={}):
+    def term_depth(self, term):
         """
         Return the minimum depth of a `term`.
 
         (length of the shortest path to this term from the top level term).
 
         """
-        if term not in cache_:
-            cache_[term] = min([self.term_depth(parent) + 1
-                                for _, parent in self[term].related] or
-                               [1])
-        return cache_[term]
+        closure = self.closure_index()
+        return int(closure.depth[self._term_indices([term])[0]])
+
+    def closure_index(self):
+        """
+        Return the :class:`OntologyClosure` of this ontology (built on
+        first use).
+
+        """
+        if self._closure is None:
+            self._closure = OntologyClosure.from_ontology(self)
+        return self._closure
+
+    def _term_indices(self, terms):
+        """
+        Return an array of :func:`closure_index` indices of `terms`
+        (alternative ids are mapped to their primary terms).
+        """
+        index = self.closure_index().term_index
+        return numpy.array([index[self.alias_mapper.get(t, t)]
+                            for t in terms], dtype=numpy.int64)
 
     def __getitem__(self, termid):
         """
@@ -565,6 +654,432 @@ class Ontology(object):
     DownloadOntologyAtRev = download_ontology_at_rev
 
 
+class OntologyClosure(object):
+    """
+    The transitive closure of the term relations (of all relation types)
+    in an :class:`Ontology`.
+
+    Terms are indexed by integers (positions in `term_ids`). The strict
+    ancestors and descendants of each term are stored as CSR arrays
+    (`anc_indptr`, `anc_indices` and `desc_indptr`, `desc_indices`), and
+    `depth` holds the minimum depth of each term (top level terms have
+    depth 1). Build it with :func:`Ontology.closure_index`.
+
+    """
+    def __init__(self, term_ids, parent_indptr, parent_indices):
+        self.term_ids = list(term_ids)
+        self.term_index = dict((t, i) for i, t in enumerate(self.term_ids))
+        n = len(self.term_ids)
+        self.parent_indptr = numpy.asarray(parent_indptr, dtype=numpy.int64)
+        self.parent_indices = numpy.asarray(parent_indices,
+                                            dtype=numpy.int32)
+
+        child_order = numpy.argsort(self.parent_indices, kind="mergesort")
+        child_indptr = numpy.searchsorted(
+            self.parent_indices[child_order], numpy.arange(n + 1))
+        children = numpy.repeat(numpy.arange(n), numpy.diff(
+            self.parent_indptr))[child_order]
+
+        # Process the terms in topological order (a layer at a time); the
+        # ancestors of a term are its parents and their ancestors. The
+        # ancestors of term i are buffer[start[i]: start[i] + count[i]].
+        buffer = numpy.zeros(0, dtype=numpy.int32)
+        start = numpy.zeros(n, dtype=numpy.int64)
+        count = numpy.zeros(n, dtype=numpy.int64)
+        n_parents = numpy.diff(self.parent_indptr)
+        layer = numpy.flatnonzero(n_parents == 0)
+        while len(layer):
+            positions, parents = csr_gather(
+                self.parent_indptr, self.parent_indices, layer)
+            rep, ancestors = self._gather(start, count, buffer, parents)
+            rows = numpy.r_[layer[positions], layer[positions][rep]]
+            cols = numpy.r_[parents, ancestors]
+            keys = numpy.unique(rows * n + cols)
+            rows, cols = keys // n, keys % n
+            start[layer] = len(buffer) + numpy.searchsorted(rows, layer)
+            count[layer] = numpy.searchsorted(rows, layer, side="right") - \
+                numpy.searchsorted(rows, layer)
+            buffer = numpy.r_[buffer, cols.astype(numpy.int32)]
+
+            _, layer_children = csr_gather(child_indptr, children, layer)
+            n_parents -= numpy.bincount(layer_children, minlength=n)
+            layer = numpy.unique(layer_children)
+            layer = layer[n_parents[layer] == 0]
+
+        # Terms on (or below) a relation cycle (e.g. has_part/part_of
+        # pairs) are never reached; search their ancestors one at a time.
+        for i in numpy.flatnonzero(n_parents > 0):
+            ancestors = self._search_ancestors(i, n_parents, start, count,
+                                               buffer)
+            start[i], count[i] = len(buffer), len(ancestors)
+            buffer = numpy.r_[buffer, numpy.array(sorted(ancestors),
+                                                  dtype=numpy.int32)]
+
+        _, cols = self._gather(start, count, buffer, numpy.arange(n))
+        rows = numpy.repeat(numpy.arange(n), count)
+        self.anc_indptr = numpy.r_[0, numpy.cumsum(count)].astype(numpy.int64)
+        self.anc_indices = cols.astype(numpy.int32)
+        order = numpy.argsort(cols.astype(numpy.int64) * n + rows)
+        self.desc_indptr, self.desc_indices = \
+            csr_from_pairs(cols[order], rows[order], n)
+
+        # Breadth first from the top level terms along child relations.
+        self.depth = numpy.zeros(n, dtype=numpy.int32)
+        level = numpy.flatnonzero(numpy.diff(self.parent_indptr) == 0)
+        d = 1
+        while len(level):
+            self.depth[level] = d
+            _, level = csr_gather(child_indptr, children, level)
+            level = numpy.unique(level)
+            level = level[self.depth[level] == 0]
+            d += 1
+
+    def _search_ancestors(self, i, n_parents, start, count, buffer):
+        """
+        Return the set of strict ancestors of term `i` by a depth first
+        search (reusing the ancestors of already processed terms).
+        """
+        ancestors = set()
+        stack = [i]
+        while stack:
+            j = stack.pop()
+            parents = self.parent_indices[self.parent_indptr[j]:
+                                          self.parent_indptr[j + 1]]
+            for p in parents.tolist():
+                if p in ancestors:
+                    continue
+                ancestors.add(p)
+                if n_parents[p] > 0:
+                    stack.append(p)
+                else:
+                    ancestors.update(
+                        buffer[start[p]: start[p] + count[p]].tolist())
+        ancestors.discard(i)
+        return ancestors
+
+    @staticmethod
+    def _gather(start, count, buffer, rows):
+        """
+        Like :func:`csr_gather` for rows stored at `buffer[start[i]:
+        start[i] + count[i]]`.
+        """
+        counts = count[rows]
+        positions = numpy.repeat(numpy.arange(len(rows)), counts)
+        offsets = numpy.arange(len(positions)) - \
+            numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        return positions, buffer[start[rows][positions] + offsets]
+
+    @classmethod
+    def from_ontology(cls, ontology):
+        """
+        Build the closure of an :class:`Ontology`.
+        """
+        snapshot = ontology._snapshot
+        if snapshot is not None and not ontology.terms.modified:
+            return cls(snapshot.term_ids, snapshot.parent_indptr,
+                       snapshot.parent_indices)
+
+        term_ids = sorted(ontology.terms)
+        index = dict((t, i) for i, t in enumerate(term_ids))
+        edges = numpy.unique(numpy.array(
+            [i * len(term_ids) + index[parent]
+             for i, termid in enumerate(term_ids)
+             for _, parent in ontology.terms[termid].related],
+            dtype=numpy.int64))
+        indptr, indices = csr_from_pairs(
+            edges // len(term_ids), edges % len(term_ids), len(term_ids))
+        return cls(term_ids, indptr, indices)
+
+    def ancestors(self, indices):
+        """
+        Return a sorted array of the indices of all strict ancestors of
+        terms at `indices`.
+        """
+        return numpy.unique(
+            csr_gather(self.anc_indptr, self.anc_indices, indices)[1])
+
+    def descendants(self, indices):
+        """
+        Return a sorted array of the indices of all strict descendants of
+        terms at `indices`.
+        """
+        return numpy.unique(
+            csr_gather(self.desc_indptr, self.desc_indices, indices)[1])
+
+    def ancestor_pairs(self, indices):
+        """
+        Return `(positions, ancestors)` arrays listing the strict ancestors
+        of each term in `indices` (`positions` index into `indices`).
+        """
+        return csr_gather(self.anc_indptr, self.anc_indices, indices)
+
+    def descendant_pairs(self, indices):
+        """
+        Return `(positions, descendants)` arrays listing the strict
+        descendants of each term in `indices`.
+        """
+        return csr_gather(self.desc_indptr, self.desc_indices, indices)
+
+
+class _SnapshotTerms(MutableMapping):
+    """
+    A dictionary of :class:`Term` instances (keyed by term id) backed by
+    an :class:`OntologySnapshot`. The terms are created on first access.
+    """
+    def __init__(self, snapshot, ontology):
+        self.snapshot = snapshot
+        self.ontology = ontology
+        self._terms = {}
+        self._deleted = set()
+        #: Were terms added or removed
+        self.modified = False
+
+    def __getitem__(self, termid):
+        if termid in self._terms:
+            return self._terms[termid]
+        if termid in self._deleted:
+            raise KeyError(termid)
+        term = self.snapshot.term(self.snapshot.term_index[termid],
+                                  self.ontology)
+        self._terms[termid] = term
+        return term
+
+    def __setitem__(self, termid, term):
+        self._deleted.discard(termid)
+        self._terms[termid] = term
+        self.modified = True
+
+    def __delitem__(self, termid):
+        if termid not in self:
+            raise KeyError(termid)
+        self._terms.pop(termid, None)
+        if termid in self.snapshot.term_index:
+            self._deleted.add(termid)
+        self.modified = True
+
+    def __contains__(self, termid):
+        return termid in self._terms or \
+            (termid in self.snapshot.term_index and
+             termid not in self._deleted)
+
+    def __iter__(self):
+        for termid in self.snapshot.term_ids:
+            if termid not in self._deleted:
+                yield termid
+        for termid in self._terms:
+            if termid not in self.snapshot.term_index:
+                yield termid
+
+    def __len__(self):
+        extra = [t for t in self._terms if t not in self.snapshot.term_index]
+        return len(self.snapshot.term_ids) - len(self._deleted) + len(extra)
+
+
+class OntologySnapshot(object):
+    """
+    A compiled form of an :class:`Ontology`.
+
+    Term ids are interned to consecutive integers (their index in
+    `term_ids`), the parent and child relations are stored as CSR arrays
+    and term names and namespaces in string tables. A snapshot is saved
+    as a directory of `.npy` files which are memory mapped on load, so
+    processes loading the same snapshot share one copy.
+
+    Use :func:`Ontology.from_snapshot` to get an :class:`Ontology` which
+    creates its :class:`Term` objects lazily from the snapshot.
+
+    """
+    #: Snapshot format version.
+    version = 1
+
+    _ARRAYS = ["ids", "names", "namespaces",
+               "parent_indptr", "parent_indices", "parent_types",
+               "child_indptr", "child_indices", "child_types",
+               "alt_ids", "alt_terms", "subset_indptr", "subset_indices",
+               "lines_indptr", "lines"]
+
+    # separators of tag, value, modifiers and comment fields and of the
+    # lines in the stored stanzas
+    _FIELD_SEP = "\x1f"
+    _LINE_SEP = "\x1e"
+
+    def __init__(self, arrays, meta):
+        for name in self._ARRAYS:
+            setattr(self, name, arrays[name])
+        self.header = meta["header"]
+        self.namespace_names = meta["namespace_names"]
+        self.relation_types = meta["relation_types"]
+        self.subset_names = meta["subset_names"]
+        self.typedefs = meta["typedefs"]
+        self.instances = meta["instances"]
+        self.key = meta.get("key")
+        self.term_ids = map(intern, self.ids.tolist())
+        self.term_index = dict((termid, i)
+                               for i, termid in enumerate(self.term_ids))
+
+    @classmethod
+    def from_ontology(cls, ontology):
+        """
+        Compile an :class:`Ontology` instance.
+        """
+        term_ids = sorted(ontology.terms)
+        index = dict((termid, i) for i, termid in enumerate(term_ids))
+        terms = [ontology.terms[termid] for termid in term_ids]
+
+        relation_types = sorted(set(rel for term in terms
+                                    for rel, _ in term.related))
+        rel_index = dict((rel, i) for i, rel in enumerate(relation_types))
+        edges = numpy.array(
+            [(i, index[parent], rel_index[rel])
+             for i, term in enumerate(terms)
+             for rel, parent in sorted(term.related)],
+            dtype=numpy.int32).reshape(-1, 3)
+
+        def csr(rows, cols, types):
+            order = numpy.argsort(rows, kind="mergesort")
+            indptr = numpy.searchsorted(rows[order],
+                                        numpy.arange(len(terms) + 1))
+            return (indptr.astype(numpy.int64), cols[order],
+                    types[order].astype(numpy.int16))
+
+        parent_indptr, parent_indices, parent_types = \
+            csr(edges[:, 0], edges[:, 1], edges[:, 2])
+        child_indptr, child_indices, child_types = \
+            csr(edges[:, 1], edges[:, 0], edges[:, 2])
+
+        namespace_names = sorted(set(getattr(term, "namespace", "")
+                                     for term in terms))
+        ns_index = dict((ns, i) for i, ns in enumerate(namespace_names))
+        subset_names = sorted(set(subset for term in terms
+                                  for subset in getattr(term, "subset", [])))
+        subset_index = dict((s, i) for i, s in enumerate(subset_names))
+        subsets = [sorted(set(subset_index[s]
+                              for s in getattr(term, "subset", [])))
+                   for term in terms]
+
+        alt_ids = sorted(ontology.alias_mapper)
+        lines = [cls._dump_lines(term._lines) for term in terms]
+
+        arrays = {
+            "ids": numpy.array(term_ids, dtype=str),
+            "names": numpy.array([getattr(term, "name", "")
+                                  for term in terms], dtype=str),
+            "namespaces": numpy.array(
+                [ns_index[getattr(term, "namespace", "")] for term in terms],
+                dtype=numpy.int16),
+            "parent_indptr": parent_indptr,
+            "parent_indices": parent_indices,
+            "parent_types": parent_types,
+            "child_indptr": child_indptr,
+            "child_indices": child_indices,
+            "child_types": child_types,
+            "alt_ids": numpy.array(alt_ids, dtype=str),
+            "alt_terms": numpy.array(
+                [index[ontology.alias_mapper[alt]] for alt in alt_ids],
+                dtype=numpy.int32),
+            "subset_indptr": numpy.cumsum(
+                [0] + map(len, subsets)).astype(numpy.int64),
+            "subset_indices": numpy.array(
+                [i for s in subsets for i in s], dtype=numpy.int16),
+            "lines_indptr": numpy.cumsum(
+                [0] + map(len, lines)).astype(numpy.int64),
+            "lines": numpy.frombuffer("".join(lines), dtype=numpy.uint8),
+        }
+        meta = {
+            "header": ontology.header,
+            "namespace_names": namespace_names,
+            "relation_types": relation_types,
+            "subset_names": subset_names,
+            "typedefs": [t._lines for t in ontology.typedefs.values()],
+            "instances": [i._lines for i in ontology.instances.values()],
+        }
+        return cls(arrays, meta)
+
+    @classmethod
+    def _dump_lines(cls, lines):
+        return cls._LINE_SEP.join(cls._FIELD_SEP.join(line)
+                                  for line in lines)
+
+    @classmethod
+    def _load_lines(cls, data):
+        return [tuple(map(intern, line.split(cls._FIELD_SEP)))
+                for line in data.split(cls._LINE_SEP) if line]
+
+    def term(self, i, ontology=None):
+        """
+        Return a new :class:`Term` for the term with index `i`.
+        """
+        start, end = self.lines_indptr[i], self.lines_indptr[i + 1]
+        term = Term(ontology=ontology)
+        term.add_lines(self._load_lines(self.lines[start: end].tobytes()))
+        start, end = self.child_indptr[i], self.child_indptr[i + 1]
+        term.related_to = set(
+            (self.relation_types[rel], self.term_ids[child])
+            for rel, child in zip(self.child_types[start: end],
+                                  self.child_indices[start: end]))
+        return term
+
+    def subset_terms(self, subset):
+        """
+        Return the indices of terms in a named `subset`.
+        """
+        if subset not in self.subset_names:
+            return numpy.zeros(0, dtype=int)
+        rows = numpy.repeat(numpy.arange(len(self.term_ids)),
+                            numpy.diff(self.subset_indptr))
+        return numpy.unique(
+            rows[self.subset_indices == self.subset_names.index(subset)])
+
+    def save(self, path, key=None):
+        """
+        Save the snapshot into a directory `path`.
+        """
+        meta = {"key": key, "header": self.header,
+                "namespace_names": self.namespace_names,
+                "relation_types": self.relation_types,
+                "subset_names": self.subset_names,
+                "typedefs": self.typedefs, "instances": self.instances}
+        save_arrays(path, self, meta)
+        self.key = key
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load a snapshot saved with :func:`save` memory mapping its arrays.
+        """
+        return cls(*load_arrays(path, cls, mmap_mode))
+
+
+def _load_cached(cls, filename):
+    """
+    Return a compiled `cls` instance stored next to `filename` (in
+    `filename + ".compiled"`) or `None` if it is missing or out of date.
+    """
+    try:
+        compiled = cls.load(filename + ".compiled")
+    except LOAD_ERRORS:
+        return None
+    if compiled.key != _cache_key(cls, filename):
+        return None
+    return compiled
+
+
+def _save_cached(compiled, filename):
+    """
+    Store `compiled` next to `filename` for :func:`_load_cached`.
+    """
+    path = filename + ".compiled"
+    try:
+        compiled.save(path, _cache_key(type(compiled), filename))
+    except (IOError, OSError):
+        warnings.warn("Could not save the compiled data to %r" % path,
+                      UserWarning)
+
+
+def _cache_key(cls, filename):
+    return "v%i.%s" % (cls.version, file_key(filename))
+
+
 from collections import namedtuple
 
 _AnnotationRecordBase = namedtuple(
@@ -618,6 +1133,530 @@ class AnnotationRecord(_AnnotationRecordBase):
         return list(map(intern, self.DB_Object_Synonym.split("|")))
 
 
+def _aspects_set(aspect):
+    if aspect is None:
+        return set(["P", "C", "F"])
+    elif isinstance(aspect, basestring):
+        return set([aspect])
+    else:
+        return set(aspect)
+
+
+def _open_annotations(file):
+    """
+    Open a GAF annotations `file` (see :func:`Annotations.parse_file`)
+    and return a (file object, size in bytes or None) tuple.
+    """
+    if isinstance(file, basestring):
+        if os.path.isfile(file) and tarfile.is_tarfile(file):
+            tar = tarfile.open(file)
+            info = tar.getmember("gene_association")
+            return tar.extractfile(info), info.size
+        elif os.path.isfile(file) and file.endswith(".gz"):
+            return gzip.open(file), None
+        elif os.path.isfile(file):
+            return open(file), os.path.getsize(file)
+        elif os.path.isdir(file):
+            file = os.path.join(file, "gene_association")
+            return open(file), os.path.getsize(file)
+        else:
+            raise ValueError("Cannot open %r for parsing." % file)
+    return file, None
+
+
+def _taxon_ids(taxon):
+    return set(t[6:] if t.startswith("taxon:") else t
+               for t in taxon.split("|"))
+
+
+_GAF_FIELD = dict((name, i) for i, name in enumerate(annotationFields))
+
+
+def iter_annotations(file, evidence_codes=None, exclude_evidence=None,
+                     aspect=None, taxids=None, exclude_qualifiers=("NOT",),
+                     header=None, progress_callback=None):
+    """
+    Iterate over the :class:`AnnotationRecord` instances in a GAF
+    annotations `file` (see :func:`Annotations.parse_file`) without
+    reading the whole file into memory. The filters are applied to the
+    raw line fields, so records are created only for retained lines.
+
+    :param evidence_codes: Keep only these evidence codes.
+    :param exclude_evidence: Skip these evidence codes (e.g. ``["IEA"]``).
+    :param aspect: Keep only these aspects ('P', 'F' or 'C').
+    :param taxids: Keep only annotations for these taxonomy ids.
+    :param exclude_qualifiers:
+        Skip annotations with any of these qualifiers.
+    :param list header: If given the header lines are appended to it.
+
+    """
+    f, size = _open_annotations(file)
+    evidence_codes = set(evidence_codes) if evidence_codes else None
+    exclude_evidence = set(exclude_evidence or [])
+    aspects = _aspects_set(aspect)
+    taxids = set(map(str, taxids)) if taxids else None
+    exclude_qualifiers = set(exclude_qualifiers or [])
+
+    symbol_i, goid_i = _GAF_FIELD["DB_Object_Symbol"], _GAF_FIELD["GO_ID"]
+    qualifier_i = _GAF_FIELD["Qualifier"]
+    evidence_i = _GAF_FIELD["Evidence_Code"]
+    aspect_i, taxon_i = _GAF_FIELD["Aspect"], _GAF_FIELD["Taxon"]
+
+    step = size // 100 if size and progress_callback else 0
+    next_report = step
+    read = 0
+    for line in f:
+        if step:
+            read += len(line)
+            if read >= next_report:
+                progress_callback(100.0 * read / size)
+                next_report = read + step
+
+        line = line.rstrip("\r\n")
+        if line.startswith("!"):
+            if header is not None:
+                header.append(line)
+            continue
+        elif not line.strip():
+            continue
+
+        fields = line.split("\t")
+        if not fields[symbol_i] or not fields[goid_i]:
+            continue
+        evidence = fields[evidence_i]
+        if evidence_codes is not None and evidence not in evidence_codes or \
+                evidence in exclude_evidence:
+            continue
+        if fields[aspect_i] not in aspects:
+            continue
+        if exclude_qualifiers and fields[qualifier_i] and \
+                exclude_qualifiers.intersection(
+                    fields[qualifier_i].split("|")):
+            continue
+        if taxids is not None and \
+                not taxids.intersection(_taxon_ids(fields[taxon_i])):
+            continue
+
+        yield AnnotationRecord._make(map(intern, fields))
+
+
+class TermGeneIndex(object):
+    """
+    A precomputed term by gene incidence index.
+
+    Terms and genes are interned to consecutive integers and the genes
+    annotated to each term (directly or through any of its sub terms)
+    are stored in a compressed sparse row layout (`indptr`, `indices`).
+    Counting the genes of a gene set annotated to all terms is then a
+    single vectorized pass over the index.
+
+    :param list terms: Term ids (the index rows).
+    :param list genes: Gene names (the index columns).
+    :param numpy.ndarray indptr: Row pointers into `indices`.
+    :param numpy.ndarray indices: Sorted gene indices of each row.
+
+    """
+    def __init__(self, terms, genes, indptr, indices):
+        self.terms = list(terms)
+        self.genes = list(genes)
+        self.term_index = dict((term, i) for i, term in enumerate(self.terms))
+        self.gene_index = dict((gene, i) for i, gene in enumerate(self.genes))
+        self.indptr = numpy.asarray(indptr, dtype=numpy.int64)
+        self.indices = numpy.asarray(indices, dtype=numpy.int32)
+
+    @classmethod
+    def from_annotations(cls, annotations, evidence_codes=None, aspect=None):
+        """
+        Build the index from an :class:`Annotations` instance using only
+        the annotations with `evidence_codes` and `aspect`. Annotations
+        are propagated to all super terms in the `annotations.ontology`.
+
+        """
+        ontology = annotations.ontology
+        evidence_codes = set(evidence_codes or evidenceDict.keys())
+        aspects_set = _aspects_set(aspect)
+
+        store = annotations._compiled_store()
+        direct = defaultdict(set)
+        if store is not None:
+            genes = store.gene_names
+            ngenes = max(len(genes), 1)
+            selected = store.select(evidence_codes, aspects_set)
+            pairs = numpy.unique(
+                store.term[selected].astype(numpy.int64) * ngenes +
+                store.gene[selected])
+            term_ids, gene_ids = pairs // ngenes, pairs % ngenes
+            bounds = numpy.flatnonzero(numpy.diff(term_ids)) + 1
+            if len(pairs):
+                for start, ids in zip(numpy.r_[0, bounds],
+                                      numpy.split(gene_ids, bounds)):
+                    direct[store.term_ids[term_ids[start]]] = \
+                        set(ids.tolist())
+        else:
+            genes = sorted(annotations.gene_names)
+            gene_index = dict((gene, i) for i, gene in enumerate(genes))
+            for ann in annotations.annotations:
+                if ann.Evidence_Code in evidence_codes and \
+                        ann.Aspect in aspects_set:
+                    direct[ann.GO_ID].add(gene_index[ann.geneName])
+
+        unknown = [term for term in direct if term not in ontology]
+        if unknown:
+            warnings.warn("%s terms in the annotations were not found in the "
+                          "ontology." % ",".join(map(repr, unknown)),
+                          UserWarning)
+
+        # Merge annotations of alternative ids into their primary terms.
+        direct_genes = defaultdict(set)
+        for term, gene_ids in direct.iteritems():
+            if term in ontology:
+                direct_genes[ontology.alias_mapper.get(term, term)] |= gene_ids
+
+        closure = ontology.closure_index()
+        pair_terms = []
+        pair_genes = []
+        for term, gene_ids in direct_genes.iteritems():
+            pair_terms.extend([closure.term_index[term]] * len(gene_ids))
+            pair_genes.extend(gene_ids)
+        pair_terms = numpy.array(pair_terms, dtype=numpy.int64)
+        pair_genes = numpy.array(pair_genes, dtype=numpy.int64)
+
+        # Expand each direct (term, gene) pair to (ancestor, gene) pairs.
+        positions, ancestors = closure.ancestor_pairs(pair_terms)
+        rows = numpy.r_[pair_terms, ancestors]
+        cols = numpy.r_[pair_genes, pair_genes[positions]]
+
+        ngenes = max(len(genes), 1)
+        keys = numpy.unique(rows * ngenes + cols)
+        rows, indices = keys // ngenes, keys % ngenes
+        used, rows = numpy.unique(rows, return_inverse=True)
+        terms = [closure.term_ids[i] for i in used]
+        indptr = numpy.searchsorted(rows, numpy.arange(len(terms) + 1))
+        return cls(terms, genes, indptr, indices)
+
+    def mask(self, genes):
+        """
+        Return a boolean gene mask (a numpy array) for the `genes`.
+        Genes not in the index are ignored.
+
+        """
+        mask = numpy.zeros(len(self.genes), dtype=bool)
+        ids = [self.gene_index[g] for g in genes if g in self.gene_index]
+        mask[ids] = True
+        return mask
+
+    def counts(self, mask):
+        """
+        Return the number of genes in the gene `mask` annotated to each
+        term (a numpy array of `len(self.terms)` integers).
+
+        """
+        csum = numpy.zeros(len(self.indices) + 1, dtype=numpy.int64)
+        numpy.cumsum(mask[self.indices], out=csum[1:])
+        return csum[self.indptr[1:]] - csum[self.indptr[:-1]]
+
+    def term_genes(self, term, mask=None):
+        """
+        Return a list of genes annotated to `term` (a term id or row
+        index). If `mask` is given only genes in the mask are returned.
+
+        """
+        if not isinstance(term, (int, long, numpy.integer)):
+            term = self.term_index[term]
+        ids = self.indices[self.indptr[term]: self.indptr[term + 1]]
+        if mask is not None:
+            ids = ids[mask[ids]]
+        return [self.genes[i] for i in ids]
+
+    def __len__(self):
+        return len(self.terms)
+
+
+EnrichmentBatch = namedtuple(
+    "EnrichmentBatch",
+    ["terms", "counts", "ref_counts", "p_values", "fdr"]
+)
+
+
+def _enrichment_row(state, gene_ids, n_genes):
+    """
+    Score one gene list (given as gene indices into `state`'s
+    :class:`TermGeneIndex`) against all terms.
+    """
+    index, ref_mask, ref_counts, ref_size, terms_mask, prob = state
+    genes_mask = numpy.zeros(len(index.genes), dtype=bool)
+    genes_mask[gene_ids] = True
+    present = (index.counts(genes_mask) > 0) & terms_mask
+    counts = index.counts(genes_mask & ref_mask)
+
+    p_values = numpy.empty(len(index.terms))
+    p_values.fill(numpy.nan)
+    p_values[present] = prob.p_values(counts[present], ref_size,
+                                      ref_counts[present], n_genes)
+    fdr = numpy.empty(len(index.terms))
+    fdr.fill(numpy.nan)
+    fdr[present] = stats.FDR(p_values[present])
+    return counts, p_values, fdr
+
+
+_enrichment_state = None
+
+
+def _enrichment_pool_init(state):
+    global _enrichment_state
+    _enrichment_state = state
+
+
+def _enrichment_pool_row(args):
+    return _enrichment_row(_enrichment_state, *args)
+
+
+class AnnotationStore(object):
+    """
+    A compiled, columnar form of GO annotations.
+
+    Gene names and term ids are interned to integers (indices into the
+    sorted `genes` and `terms` string tables). Each annotation record is
+    stored as its `gene` and `term` index, an `evidence` code bit (see
+    :func:`evidence_mask`), an `aspect` index and its original GAF line,
+    from which :class:`AnnotationRecord` instances are created on demand.
+    The records of each gene and term are indexed in CSR arrays.
+
+    Like :class:`OntologySnapshot` a store is saved as a directory of
+    `.npy` files which are memory mapped on load.
+
+    """
+    #: Store format version.
+    version = 1
+
+    _ARRAYS = ["genes", "terms", "gene", "term", "evidence", "aspect",
+               "gene_indptr", "gene_order", "term_indptr", "term_order",
+               "aliases", "alias_genes", "lines_indptr", "lines"]
+
+    def __init__(self, arrays, meta):
+        for name in self._ARRAYS:
+            setattr(self, name, arrays[name])
+        self.header = meta["header"]
+        self.evidence_codes = meta["evidence_codes"]
+        self.aspects = meta["aspects"]
+        self.key = meta.get("key")
+        self.gene_names = map(intern, self.genes.tolist())
+        self.term_ids = map(intern, self.terms.tolist())
+        self.gene_index = dict((g, i) for i, g in enumerate(self.gene_names))
+        self.term_index = dict((t, i) for i, t in enumerate(self.term_ids))
+
+    @classmethod
+    def from_records(cls, records, header="", alias_mapper=None):
+        """
+        Compile a sequence of :class:`AnnotationRecord` instances.
+        """
+        records = list(records)
+        genes = sorted(set(r.geneName for r in records))
+        terms = sorted(set(r.GO_ID for r in records))
+        evidence_codes = sorted(set(r.Evidence_Code for r in records))
+        if len(evidence_codes) > 64:
+            raise ValueError("Too many distinct evidence codes")
+        aspects = sorted(set(r.Aspect for r in records))
+        gene_index = dict((g, i) for i, g in enumerate(genes))
+        term_index = dict((t, i) for i, t in enumerate(terms))
+        ev_index = dict((e, i) for i, e in enumerate(evidence_codes))
+        aspect_index = dict((a, i) for i, a in enumerate(aspects))
+
+        gene = numpy.array([gene_index[r.geneName] for r in records],
+                           dtype=numpy.int32)
+        term = numpy.array([term_index[r.GO_ID] for r in records],
+                           dtype=numpy.int32)
+
+        def csr(rows, n):
+            order = numpy.argsort(rows, kind="mergesort").astype(numpy.int32)
+            indptr = numpy.searchsorted(rows[order], numpy.arange(n + 1))
+            return indptr.astype(numpy.int64), order
+
+        if alias_mapper is None:
+            alias_mapper = {}
+            for r in records:
+                alias_mapper.update([(alias, r.geneName) for alias in
+                                     r.alias + [r.geneName, r.DB_Object_ID]])
+        aliases = sorted(alias_mapper)
+        lines = ["\t".join(r) for r in records]
+
+        arrays = {
+            "genes": numpy.array(genes, dtype=str),
+            "terms": numpy.array(terms, dtype=str),
+            "gene": gene,
+            "term": term,
+            "evidence": numpy.array(
+                [1 << ev_index[r.Evidence_Code] for r in records],
+                dtype=numpy.uint64),
+            "aspect": numpy.array([aspect_index[r.Aspect] for r in records],
+                                  dtype=numpy.uint8),
+            "aliases": numpy.array(aliases, dtype=str),
+            "alias_genes": numpy.array(
+                [gene_index.get(alias_mapper[a], -1) for a in aliases],
+                dtype=numpy.int32),
+            "lines_indptr": numpy.cumsum(
+                [0] + map(len, lines)).astype(numpy.int64),
+            "lines": numpy.frombuffer("".join(lines), dtype=numpy.uint8),
+        }
+        arrays["gene_indptr"], arrays["gene_order"] = csr(gene, len(genes))
+        arrays["term_indptr"], arrays["term_order"] = csr(term, len(terms))
+        meta = {"header": header, "evidence_codes": evidence_codes,
+                "aspects": aspects}
+        return cls(arrays, meta)
+
+    def __len__(self):
+        return len(self.gene)
+
+    def record(self, i):
+        """
+        Return the `i`-th annotation as an :class:`AnnotationRecord`.
+        """
+        start, end = self.lines_indptr[i], self.lines_indptr[i + 1]
+        return AnnotationRecord.from_string(self.lines[start: end].tobytes())
+
+    def records(self, indices):
+        """
+        Return a list of :class:`AnnotationRecord` instances at `indices`.
+        """
+        return [self.record(i) for i in indices]
+
+    def gene_records(self, gene):
+        """
+        Return the indices of all annotations of `gene`.
+        """
+        if gene not in self.gene_index:
+            return numpy.zeros(0, dtype=numpy.int32)
+        i = self.gene_index[gene]
+        return self.gene_order[self.gene_indptr[i]: self.gene_indptr[i + 1]]
+
+    def term_records(self, term):
+        """
+        Return the indices of all annotations directly to `term`.
+        """
+        if term not in self.term_index:
+            return numpy.zeros(0, dtype=numpy.int32)
+        i = self.term_index[term]
+        return self.term_order[self.term_indptr[i]: self.term_indptr[i + 1]]
+
+    def evidence_mask(self, evidence_codes):
+        """
+        Return an `evidence` bit mask matching any of `evidence_codes`.
+        """
+        mask = 0
+        for i, code in enumerate(self.evidence_codes):
+            if code in evidence_codes:
+                mask |= 1 << i
+        return numpy.uint64(mask)
+
+    def select(self, evidence_codes=None, aspect=None):
+        """
+        Return a boolean mask of annotations with one of `evidence_codes`
+        and `aspect` (by default all evidence codes and aspects).
+        """
+        selected = numpy.ones(len(self), dtype=bool)
+        if evidence_codes is not None:
+            selected &= (self.evidence &
+                         self.evidence_mask(set(evidence_codes))) != 0
+        if aspect is not None:
+            aspects = _aspects_set(aspect)
+            codes = [i for i, a in enumerate(self.aspects) if a in aspects]
+            selected &= numpy.in1d(self.aspect, codes)
+        return selected
+
+    def save(self, path, key=None):
+        """
+        Save the store into a directory `path`.
+        """
+        meta = {"key": key, "header": self.header,
+                "evidence_codes": self.evidence_codes,
+                "aspects": self.aspects}
+        save_arrays(path, self, meta)
+        self.key = key
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load a store saved with :func:`save` memory mapping its arrays.
+        """
+        return cls(*load_arrays(path, cls, mmap_mode))
+
+
+class _StoreRecords(object):
+    """
+    A list like sequence of all annotation records in an
+    :class:`AnnotationStore` (with `extra` records appended).
+    """
+    def __init__(self, store):
+        self.store = store
+        self.extra = []
+
+    def __len__(self):
+        return len(self.store) + len(self.extra)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if index < len(self.store):
+            return self.store.record(index)
+        return self.extra[index - len(self.store)]
+
+    def __getslice__(self, i, j):
+        return self[slice(i, j)]
+
+    def __iter__(self):
+        for i in xrange(len(self.store)):
+            yield self.store.record(i)
+        for record in self.extra:
+            yield record
+
+    def append(self, record):
+        self.extra.append(record)
+
+
+class _StoreIndex(MutableMapping):
+    """
+    A `defaultdict(list)` like mapping of gene names (or term ids) to
+    lists of annotation records in an :class:`AnnotationStore`. The lists
+    are created on first access.
+    """
+    def __init__(self, store, by_gene=True):
+        self.store = store
+        if by_gene:
+            self._names, self._records = store.gene_index, store.gene_records
+        else:
+            self._names, self._records = store.term_index, store.term_records
+        self._lists = {}
+
+    def __getitem__(self, key):
+        if key not in self._lists:
+            self._lists[key] = self.store.records(self._records(key))
+        return self._lists[key]
+
+    def __setitem__(self, key, value):
+        self._lists[key] = value
+
+    def __delitem__(self, key):
+        raise TypeError("Cannot delete from compiled annotations")
+
+    def __contains__(self, key):
+        return key in self._names or key in self._lists
+
+    def __iter__(self):
+        for key in self._names:
+            yield key
+        for key in self._lists:
+            if key not in self._names:
+                yield key
+
+    def __len__(self):
+        return len(self._names) + \
+            len([key for key in self._lists if key not in self._names])
+
+
 @deprecated_members(
     {"GetOntology": "get_ontology", "SetOntology": "set_ontology",
      "ParseFile": "parse_file", "AddAnnotation": "add_annotation",
@@ -673,6 +1712,8 @@ class Annotations(object):
         self._gene_names = None
         self._gene_names_dict = None
         self._alias_mapper = None
+        self._term_gene_indices = {}
+        self._store = None
 
         #: A list of all :class:`AnnotationRecords` instances.
         self.annotations = []
@@ -765,6 +1806,7 @@ class Annotations(object):
         """Set the ontology to use in the annotations mapping.
         """
         self.all_annotations = defaultdict(list)
+        self._term_gene_indices = {}
         self._ontology = ontology
 
     def get_ontology(self):
@@ -797,13 +1839,67 @@ class Annotations(object):
                 raise obiTaxonomy.UnknownSpeciesIdentifier(org + str(code))
             serverfiles.download("GO", filename)
 
-        return cls(path, ontology=ontology, genematcher=genematcher,
-                   progress_callback=progress_callback)
+        return cls.load_compiled(path, ontology=ontology,
+                                 genematcher=genematcher,
+                                 progress_callback=progress_callback)
 
     Load = load
 
+    @classmethod
+    def load_compiled(cls, filename, ontology=None, genematcher=None,
+                      progress_callback=None):
+        """Load the annotations from `filename` using a compiled
+        :class:`AnnotationStore` stored next to it (in
+        `filename + ".compiled"`). The store is (re)built if missing or
+        older than the file.
+
+        """
+        annotations = cls(ontology=ontology, genematcher=genematcher)
+        store = _load_cached(AnnotationStore, filename)
+        if store is None:
+            annotations.parse_file(filename, progress_callback)
+            store = AnnotationStore.from_records(
+                annotations.annotations, annotations.header,
+                annotations.alias_mapper)
+            _save_cached(store, filename)
+        annotations.set_store(store)
+        if annotations.genematcher:
+            annotations.genematcher.set_targets(annotations.gene_names)
+        return annotations
+
+    def set_store(self, store):
+        """Replace the annotations with the annotations in an
+        :class:`AnnotationStore`. The `annotations`, `gene_annotations`
+        and `term_anotations` are then served lazily from the store.
+
+        """
+        self._store = store
+        self.header = store.header
+        self.annotations = _StoreRecords(store)
+        self.gene_annotations = _StoreIndex(store, by_gene=True)
+        self.term_anotations = _StoreIndex(store, by_gene=False)
+        self.all_annotations = defaultdict(list)
+        self._term_gene_indices = {}
+        self._gene_names = set(store.gene_names)
+        self._gene_names_dict = None
+        self._alias_mapper = dict(
+            (alias, store.gene_names[i])
+            for alias, i in zip(map(intern, store.aliases.tolist()),
+                                store.alias_genes)
+            if i >= 0)
+
+    def _compiled_store(self):
+        """Return the :class:`AnnotationStore` if it holds all the
+        annotations (none were added since it was set).
+        """
+        if self._store is not None and not self.annotations.extra:
+            return self._store
+        return None
+
     @deprecated_keywords({"progressCallback": "progress_callback"})
-    def parse_file(self, file, progress_callback=None):
+    def parse_file(self, file, progress_callback=None, evidence_codes=None,
+                   exclude_evidence=None, aspect=None, taxids=None,
+                   exclude_qualifiers=("NOT",)):
         """Parse and load the annotations from file.
 
         `file` can be:
@@ -813,33 +1909,20 @@ class Annotations(object):
             - a path to the actual association file
             - an open file-like object of the association file
 
-        """
-        if isinstance(file, basestring):
-            if os.path.isfile(file) and tarfile.is_tarfile(file):
-                f = tarfile.open(file).extractfile("gene_association")
-            elif os.path.isfile(file) and file.endswith(".gz"):
-                f = gzip.open(file)
-            elif os.path.isfile(file):
-                f = open(file)
-            elif os.path.isdir(file):
-                f = open(os.path.join(file, "gene_association"))
-            else:
-                raise ValueError("Cannot open %r for parsing." % file)
-        else:
-            f = file
-        lines = [line for line in f.read().splitlines() if line.strip()]
-
-        milestones = progress_bar_milestones(len(lines), 100)
-        for i, line in enumerate(lines):
-            if line.startswith("!"):
-                self.header = self.header + line + "\n"
-                continue
-
-            a = AnnotationRecord.from_string(line)
-            self.add_annotation(a)
+        The file is streamed and only the annotations passing the
+        filters are kept (see :func:`iter_annotations`).
 
-            if progress_callback and i in milestones:
-                progress_callback(100.0 * i / len(lines))
+        """
+        header = []
+        for a in iter_annotations(file, evidence_codes=evidence_codes,
+                                  exclude_evidence=exclude_evidence,
+                                  aspect=aspect, taxids=taxids,
+                                  exclude_qualifiers=exclude_qualifiers,
+                                  header=header,
+                                  progress_callback=progress_callback):
+            self._add_record(a)
+        self.header += "".join(line + "\n" for line in header)
+        self._invalidate()
 
     def add_annotation(self, a):
         """Add a single :class:`AnotationRecord` instance to this object.
@@ -849,10 +1932,17 @@ class Annotations(object):
         if not a.geneName or not a.GOId or a.Qualifier == "NOT":
             return
 
+        self._add_record(a)
+        self._invalidate()
+
+    def _add_record(self, a):
         self.gene_annotations[a.geneName].append(a)
         self.annotations.append(a)
         self.term_anotations[a.GOId].append(a)
+
+    def _invalidate(self):
         self.all_annotations = defaultdict(list)
+        self._term_gene_indices = {}
 
         self._gene_names_dict = None
         self._gene_names = None
@@ -887,14 +1977,16 @@ class Annotations(object):
         to `genes`.
 
         """
-        def alias(gene):
-            if self.genematcher:
-                return self.genematcher.umatch(gene)
-            else:
-                return (gene if gene in self.gene_names
-                        else self.alias_mapper.get(gene, None))
+        genes = list(genes)
+        if self.genematcher:
+            aliases = obiGene.umatch_names(self.genematcher, genes)
+        else:
+            aliases = [gene if gene in self.gene_names
+                       else self.alias_mapper.get(gene, None)
+                       for gene in genes]
 
-        return dict([(alias(gene), gene) for gene in genes if alias(gene)])
+        return dict([(alias, gene) for alias, gene in zip(aliases, genes)
+                     if alias])
 
     def _collect_annotations(self, id, visited):
         """ Recursive function collects and caches all annotations for id
@@ -955,6 +2047,24 @@ class Annotations(object):
         return list(set([ann.geneName for ann in annotations
                          if ann.Evidence_Code in evidence_codes]))
 
+    @deprecated_keywords({"evidenceCodes": "evidence_codes"})
+    def term_gene_index(self, evidence_codes=None, aspect=None):
+        """ Return a :class:`TermGeneIndex` of genes annotated by
+        `evidence_codes` and `aspect` to all terms in the ontology.
+
+        The index is built on first use and cached for subsequent calls
+        with the same arguments.
+
+        """
+        self._ensure_ontology()
+        evidence_codes = frozenset(evidence_codes or evidenceDict.keys())
+        aspects_set = frozenset(_aspects_set(aspect))
+        key = (evidence_codes, aspects_set)
+        if key not in self._term_gene_indices:
+            self._term_gene_indices[key] = TermGeneIndex.from_annotations(
+                self, evidence_codes, aspects_set)
+        return self._term_gene_indices[key]
+
     @deprecated_keywords({
         "evidenceCodes": "evidence_codes", "slimsOnly": "slims_only",
         "useFDR": "use_fdr", "progressCallback": "progress_callback"})
@@ -985,65 +2095,34 @@ class Annotations(object):
         else:
             reference = self.gene_names
 
-        if aspect == None:
-            aspects_set = set(["P", "C", "F"])
-        elif isinstance(aspect, basestring):
-            aspects_set = set([aspect])
-        else:
-            aspects_set = aspect
-
-        evidence_codes = set(evidence_codes or evidenceDict.keys())
-        annotations = [ann
-                       for gene in genes for ann in self.gene_annotations[gene]
-                       if ann.Evidence_Code in evidence_codes and
-                       ann.Aspect in aspects_set]
-
-        refAnnotations = set(
-            [ann
-             for gene in reference for ann in self.gene_annotations[gene]
-             if ann.Evidence_Code in evidence_codes and
-             ann.Aspect in aspects_set]
-        )
-
-        annotationsDict = defaultdict(set)
-        for ann in annotations:
-            annotationsDict[ann.GO_ID].add(ann)
-
         self._ensure_ontology()
         if slims_only and not self.ontology.slimsSubset:
             warnings.warn("Unspecified slims subset in the ontology! "
                           "Using 'goslim_generic' subset", UserWarning)
             self.ontology.SetSlimsSubset("goslim_generic")
 
-        terms = annotationsDict.keys()
-        filteredTerms = [term for term in terms if term in self.ontology]
+        index = self.term_gene_index(evidence_codes, aspect)
+        genes_mask = index.mask(genes)
+        mapped_mask = genes_mask & index.mask(reference)
 
-        if len(terms) != len(filteredTerms):
-            termDiff = set(terms) - set(filteredTerms)
-            warnings.warn("%s terms in the annotations were not found in the "
-                          "ontology." % ",".join(map(repr, termDiff)),
-                          UserWarning)
+        # Terms annotated (directly or through sub terms) by any of the
+        # genes, i.e. the super graph of the genes' annotated terms.
+        terms = numpy.flatnonzero(index.counts(genes_mask))
+        mapped_counts = index.counts(mapped_mask)
+        ref_counts = index.counts(index.mask(reference))
+        p_values = prob.p_values(mapped_counts[terms], len(reference),
+                                 ref_counts[terms], len(genes))
 
-        terms = self.ontology.ExtractSuperGraph(filteredTerms)
         res = {}
-
         milestones = progress_bar_milestones(len(terms), 100)
-        for i, term in enumerate(terms):
+        for i, t in enumerate(terms):
+            term = index.terms[t]
             if slims_only and term not in self.ontology.slimsSubset:
                 continue
-            allAnnotations = self.get_all_annotations(term).intersection(refAnnotations)
-##            allAnnotations.intersection_update(refAnnotations)
-            allAnnotatedGenes = set([ann.geneName for ann in allAnnotations])
-            mappedGenes = genes.intersection(allAnnotatedGenes)
-
-            if len(reference) > len(allAnnotatedGenes):
-                mappedReferenceGenes = reference.intersection(allAnnotatedGenes)
-            else:
-                mappedReferenceGenes = allAnnotatedGenes.intersection(reference)
+            mappedGenes = index.term_genes(t, mapped_mask)
             res[term] = ([revGenesDict[g] for g in mappedGenes],
-                         prob.p_value(len(mappedGenes), len(reference),
-                                      len(mappedReferenceGenes), len(genes)),
-                         len(mappedReferenceGenes))
+                         float(p_values[i]),
+                         int(ref_counts[t]))
             if progress_callback and i in milestones:
                 progress_callback(100.0 * i / len(terms))
         if use_fdr:
@@ -1053,6 +2132,94 @@ class Annotations(object):
                         zip(res, stats.FDR([p for _, (_, p, _) in res]))])
         return res
 
+    def get_enriched_terms_batch(self, gene_lists, reference=None,
+                                 evidence_codes=None, slims_only=False,
+                                 aspect=None, prob=stats.Binomial(),
+                                 processes=None, progress_callback=None):
+        """ Score many gene lists against all terms at once. The reference
+        side (gene names, annotations, the term gene index) is shared by
+        all lists.
+
+        Return an :class:`EnrichmentBatch` with `terms` (a list of term
+        ids), `ref_counts` (the number of reference genes annotated to each
+        term) and `counts`, `p_values` and `fdr` arrays of shape
+        (len(gene_lists), len(terms)). Row `i` of `p_values` and `fdr`
+        holds the values :func:`get_enriched_terms` would report for
+        `gene_lists[i]` (without and with `use_fdr`) and is NaN for
+        terms it would not report.
+
+        :param list gene_lists: A list of gene lists.
+        :param reference: Reference genes (all annotated genes by default).
+        :param evidence_codes: List of evidence codes to consider.
+        :param slims_only: If `True` score only slim terms.
+        :param aspect: Which aspects to use ("P", "F", "C" or a set).
+        :param int processes:
+            If given, score the gene lists in a pool of this many
+            processes.
+
+        """
+        if reference:
+            reference = set(self.get_gene_names_translator(reference).keys())
+        else:
+            reference = self.gene_names
+
+        self._ensure_ontology()
+        if slims_only and not self.ontology.slimsSubset:
+            warnings.warn("Unspecified slims subset in the ontology! "
+                          "Using 'goslim_generic' subset", UserWarning)
+            self.ontology.SetSlimsSubset("goslim_generic")
+
+        index = self.term_gene_index(evidence_codes, aspect)
+        ref_mask = index.mask(reference)
+        ref_counts = index.counts(ref_mask)
+        if slims_only:
+            terms_mask = numpy.array(
+                [term in self.ontology.slimsSubset for term in index.terms],
+                dtype=bool)
+        else:
+            terms_mask = numpy.ones(len(index.terms), dtype=bool)
+
+        tasks = []
+        for genes in gene_lists:
+            genes = self.get_gene_names_translator(genes).keys()
+            tasks.append(([index.gene_index[g] for g in genes
+                           if g in index.gene_index], len(genes)))
+
+        state = (index, ref_mask, ref_counts, len(reference), terms_mask,
+                 prob)
+        if processes:
+            pool = multiprocessing.Pool(processes, _enrichment_pool_init,
+                                        (state,))
+            try:
+                rows = pool.imap(_enrichment_pool_row, tasks)
+                rows = self._collect_batch_rows(rows, len(tasks),
+                                                progress_callback)
+            finally:
+                pool.terminate()
+        else:
+            rows = (_enrichment_row(state, *task) for task in tasks)
+            rows = self._collect_batch_rows(rows, len(tasks),
+                                            progress_callback)
+
+        shape = (len(tasks), len(index.terms))
+        counts = numpy.zeros(shape, dtype=numpy.int64)
+        p_values = numpy.empty(shape)
+        fdr = numpy.empty(shape)
+        for i, (c, p, f) in enumerate(rows):
+            counts[i], p_values[i], fdr[i] = c, p, f
+        return EnrichmentBatch(list(index.terms), counts, ref_counts,
+                               p_values, fdr)
+
+    @staticmethod
+    def _collect_batch_rows(rows, count, progress_callback=None):
+        milestones = progress_bar_milestones(count, 100)
+        result = []
+        for i, row in enumerate(rows):
+            result.append(row)
+            if progress_callback and i in milestones:
+                progress_callback(100.0 * i / count)
+        return result
+
     @deprecated_keywords(
         {"directAnnotationOnly": "direct_annotation_only",
          "evidenceCodes": "evidence_codes",
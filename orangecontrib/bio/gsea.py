@@ -1,8 +1,14 @@
 from __future__ import absolute_import
 
 from collections import defaultdict
+import functools
+import itertools
+import multiprocessing
+import os
 import random
 import time
+import warnings
+import cPickle
 
 import numpy
 
@@ -32,13 +38,26 @@ def issequencens(x):
 def mean(l):
     return float(sum(l))/len(l)
 
+class MeasureRanking(object):
+    """
+    Sequentally ranks all attributes with meas (an orange.MeasureAttribute)
+    and returns results in a list. Unlike a closure it can be pickled,
+    so it can be sent to other processes.
+    """
+
+    def __init__(self, meas):
+        self.meas = meas
+
+    def __call__(self, d):
+        return [ self.meas(i,d) for i in range(len(d.domain.attributes)) ]
+
 def rankingFromOrangeMeas(meas):
     """
     Creates a function that sequentally ranks all attributes and returns
     results in a list. Ranking function is build out of 
     orange.MeasureAttribute.
     """
-    return lambda d: [ meas(i,d) for i in range(len(d.domain.attributes)) ]
+    return MeasureRanking(meas)
 
 def orderedPointersCorr(lcor):
     """
@@ -69,7 +88,7 @@ def enrichmentScoreRanked(subset, lcor, ordered, p=1.0, rev2=None):
 
     subset = set(subset)
 
-    if rev2 == None:
+    if rev2 is None:
         def rev(l):
             return numpy.argsort(l)
         rev2 = rev(ordered)
@@ -216,8 +235,277 @@ def enrichmentScore(data, subset, rankingf):
     es,l = enrichmentScoreRanked(subset, lcor, ordered)
     return es,l
 
+#maximal number of array cells processed at once by the vectorized engine
+_MAX_CELLS = 2**22
+
+class SubsetScorer(object):
+    """
+    Computes enrichment scores of many gene sets for many rankings at
+    once. Gene sets (lists of gene indices) are grouped by size into
+    padded index matrices, so the running enrichment scores of a whole
+    group are cumulative sums over a sorted membership matrix.
+
+    The additions are made in the same order as in 
+    :obj:`enrichmentScoreRanked`, so the scores are equal.
+    """
+
+    def __init__(self, subsets, p=1.0, block_cells=2**16):
+        self.p = p
+        subsets = [ numpy.array(list(set(s)), dtype=int) for s in subsets ]
+        self.n_subsets = len(subsets)
+        sizes = numpy.array([ len(s) for s in subsets ], dtype=int)
+        order = numpy.argsort(sizes, kind="mergesort")
+
+        self.blocks = []
+        start = 0
+        while start < len(order):
+            end = start + 1
+            while end < len(order) and \
+                    (end - start + 1) * max(sizes[order[end]], 1) <= block_cells:
+                end += 1
+            ids = order[start:end]
+            width = max(sizes[ids[-1]], 1)
+            genes = numpy.zeros((len(ids), width), dtype=int)
+            valid = numpy.zeros((len(ids), width), dtype=bool)
+            for row, i in enumerate(ids):
+                genes[row, :sizes[i]] = subsets[i]
+                valid[row, :sizes[i]] = True
+            self.blocks.append((ids, genes, valid, sizes[ids]))
+            start = end
+
+    def __call__(self, rankings):
+        """
+        Return a (len(rankings), number of gene sets) array of
+        enrichment scores for a sequence of rankings (correlations
+        of all genes).
+        """
+        rankings = numpy.atleast_2d(numpy.asarray(rankings, dtype=float))
+        nrank, n = rankings.shape
+        es = numpy.zeros((nrank, self.n_subsets))
+        if nrank == 0 or self.n_subsets == 0:
+            return es
+
+        #higher correlations first, ties in the original order
+        order = numpy.argsort(-rankings, axis=1, kind="mergesort")
+        positions = numpy.empty_like(order)
+        positions[numpy.arange(nrank)[:, None], order] = numpy.arange(n)
+        weights = numpy.abs(rankings) ** self.p
+
+        for ids, genes, valid, sizes in self.blocks:
+            step = max(1, _MAX_CELLS // (3 * genes.size))
+            for r in range(0, nrank, step):
+                es[r:r+step, ids] = self._block_scores(positions[r:r+step], 
+                    order[r:r+step], weights[r:r+step], genes, valid, sizes)
+        return es
+
+    @staticmethod
+    def _block_scores(positions, order, weights, genes, valid, sizes):
+        nrank, n = positions.shape
+        nsets, width = genes.shape
+        rows = numpy.arange(nrank)[:, None, None]
+
+        #sum of weights in the iteration order of the set
+        sumcors = numpy.where(valid, weights[rows, genes], 0.0).cumsum(axis=2)[..., -1]
+
+        #ordered positions of the gene set members (padding at the end)
+        hits = numpy.sort(numpy.where(valid, positions[:, genes], n), axis=2)
+        inset = hits < n
+        hitw = weights[rows, order[rows, numpy.minimum(hits, n - 1)]]
+        last = numpy.concatenate(
+            [numpy.zeros((nrank, nsets, 1), dtype=int), hits[..., :-1] + 1], axis=2)
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            notInA = -(1. / (n - sizes))[:, None]
+            inAb = 1. / sumcors
+
+            #running sum: genes not in the set before each member, the
+            #member, ..., genes after the last member
+            steps = numpy.zeros((nrank, nsets, 2 * width + 1))
+            steps[..., 0:-1:2] = numpy.where(inset, notInA * (hits - last), 0.0)
+            steps[..., 1::2] = numpy.where(inset, inAb[..., None] * hitw, 0.0)
+            lastpos = hits[:, numpy.arange(nsets), numpy.maximum(sizes - 1, 0)]
+            steps[:, numpy.arange(nsets), 2 * sizes] = \
+                notInA[:, 0] * (n - numpy.where(sizes > 0, lastpos + 1, 0))
+            csum = numpy.cumsum(steps, axis=2)
+
+        maxSum = numpy.maximum(csum.max(axis=2), 0.0)
+        minSum = numpy.minimum(csum.min(axis=2), 0.0)
+        es = numpy.where(numpy.abs(maxSum) > numpy.abs(minSum), maxSum, minSum)
+        es[sumcors == 0] = 0.0
+        return es
+
+def shuffledLocations(n, seed):
+    """
+    Return the locations random.Random(seed).shuffle uses for a
+    list of length n: shuffled[i] == l[locations[i]].
+    """
+    locations = range(n)
+    random.Random(seed).shuffle(locations)
+    return numpy.array(locations, dtype=int)
+
+def permutationSeeds(n):
+    """ Seeds of the n fixed permutations. """
+    return [ 2000+i for i in range(n) ]
+
+class GenePermutations(object):
+    """
+    Rankings with permuted gene order (as shuffleList).
+    """
+
+    def __init__(self, rankings):
+        self.rankings = numpy.asarray(rankings, dtype=float)
+
+    def __call__(self, seeds):
+        return numpy.array([ self.rankings[shuffledLocations(len(self.rankings), s)] 
+            for s in seeds ]).reshape(len(seeds), len(self.rankings))
+
+class ClassPermutations(object):
+    """
+    Rankings of genes (attributes) with permuted class values (as
+    shuffleClass) computed with rankingf. rankingf has to be picklable
+    (as rankingFromOrangeMeas rankings are) to score the permutations
+    in other processes (see nullEnrichmentScores).
+    """
+
+    def __init__(self, data, rankingf):
+        self.data = data
+        self.rankingf = rankingf
+
+    def __call__(self, seeds):
+        return numpy.array([ self.rankingf(shuffleClass(self.data, s)) 
+            for s in seeds ], dtype=float).reshape(len(seeds), -1)
+
+class SignalToNoisePermutations(object):
+    """
+    Vectorized MA_signalToNoise rankings of all attributes for the 
+    original and permuted (as shuffleClass) class values.
+    """
+
+    def __init__(self, data, a=None, b=None):
+        cv = data.domain.class_var
+        a = cv.values[0] if a is None else a
+        b = cv.values[1] if b is None else b
+
+        X = data.toNumpyMA("a")[0]
+        valid = ~numpy.ma.getmaskarray(X)
+        #center the columns to reduce the cancellation in variances
+        center = numpy.asarray(X.mean(axis=0).filled(0.0), dtype=float)
+        values = numpy.where(valid, X.filled(0.0) - center, 0.0)
+
+        self.center = center
+        self.valid = valid.astype(float)
+        self.values = values
+        self.squares = values ** 2
+        labels = [ ex[-1].value for ex in data ]
+        self.codes = numpy.array([ 0 if l == a else 1 if l == b else -1 
+            for l in labels ], dtype=int)
+
+    def rankings(self, codes):
+        """ Rankings for a (permutations, examples) matrix of class codes. """
+        def stats(sel):
+            count = numpy.dot(sel, self.valid)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                mean = numpy.dot(sel, self.values) / count
+                var = (numpy.dot(sel, self.squares) - count * mean ** 2) / (count - 1)
+                std = numpy.sqrt(numpy.maximum(var, 0.0))
+            mean = mean + self.center
+            #minmally 0.2*|mi|, where mi=0 is adjusted to mi=1
+            return mean, numpy.maximum(std, 0.2 * numpy.abs(numpy.where(mean == 0, 1.0, mean)))
+
+        codes = numpy.atleast_2d(codes)
+        ma, sa = stats((codes == 0).astype(float))
+        mb, sb = stats((codes == 1).astype(float))
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            return (ma - mb) / (sa + sb)
+
+    def __call__(self, seeds):
+        codes = numpy.empty((len(seeds), len(self.codes)), dtype=int)
+        for i, s in enumerate(seeds):
+            codes[i, shuffledLocations(len(self.codes), s)] = self.codes
+        return self.rankings(codes)
+
+def permutationShards(seeds, shardSize=32):
+    """
+    Split the permutation seeds into shards of fixed size. Each shard
+    is scored independently, so the results do not depend on how the
+    shards are distributed among workers.
+    """
+    return [ seeds[i:i+shardSize] for i in range(0, len(seeds), shardSize) ]
+
+def nullShard(state, seeds):
+    """
+    Return enrichment scores of all gene sets for the permutations
+    with the given seeds. state is a (permutations, scorer) tuple.
+    """
+    permutations, scorer = state
+    return scorer(permutations(seeds))
+
+def _picklable(obj):
+    try:
+        cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return False
+    return True
+
+_null_state = None
+
+def _null_pool_init(state):
+    global _null_state
+    _null_state = state
+
+def _null_pool_shard(seeds):
+    return nullShard(_null_state, seeds)
+
+def nullEnrichmentScores(permutations, scorer, seeds, callback=None, 
+        processes=None, mapf=None, shardSize=32):
+    """
+    Return a (len(seeds), number of gene sets) array of enrichment
+    scores for permuted rankings. permutations(seeds) returns the
+    permuted rankings for a list of seeds.
+
+    The seeds are split into shards (see permutationShards), which are
+    scored in a pool of processes workers if given, or with 
+    mapf(function, shards) (any map-like function, for example
+    of a distributed work queue). The callback is called once per
+    permutation as the shards complete.
+
+    With mapf, or processes on platforms without fork, permutations
+    and scorer are pickled. Permutations that can not be pickled (for
+    example ClassPermutations with a lambda or a nested ranking
+    function) are scored serially with a warning.
+    """
+    shards = permutationShards(seeds, shardSize)
+    state = (permutations, scorer)
+    pool = None
+    pickled = mapf is not None or \
+        (processes and len(shards) > 1 and not hasattr(os, "fork"))
+    if pickled and not _picklable(state):
+        warnings.warn("The permutations can not be pickled; "
+                      "computing them in this process.", RuntimeWarning)
+        processes = mapf = None
+    if mapf is not None:
+        results = mapf(functools.partial(nullShard, state), shards)
+    elif processes and len(shards) > 1:
+        pool = multiprocessing.Pool(processes, _null_pool_init, (state,))
+        results = pool.imap(_null_pool_shard, shards)
+    else:
+        results = (nullShard(state, shard) for shard in shards)
+
+    nulls = numpy.zeros((len(seeds), scorer.n_subsets))
+    try:
+        start = 0
+        for shard, res in itertools.izip(shards, results):
+            nulls[start:start+len(shard)] = res
+            start += len(shard)
+            for _ in shard:
+                runOptCallbacks(callback)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return nulls
+
 def gseaE(data, subsets, rankingf=None, \
-        n=100, permutation="class", callback=None):
+        n=100, permutation="class", callback=None, processes=None, mapf=None):
     """
     Run GSEA algorithm on an example table.
 
@@ -228,51 +516,36 @@ def gseaE(data, subsets, rankingf=None, \
     n: number of random permutations to sample null distribution.
     permutation: "class" for permutating class, else permutate attribute 
         order.
+    processes, mapf: run the permutations in parallel (see
+        nullEnrichmentScores). The results do not depend on it.
 
     """
 
+    s2n = None
     if not rankingf:
+        if iset(data):
+            s2n = SignalToNoisePermutations(data)
         rankingf=rankingFromOrangeMeas(MA_signalToNoise())
 
-    enrichmentScores = []
- 
-    lcor = rankingf(data)
-    #print lcor
-
-    ordered = orderedPointersCorr(lcor)
-
-    def rev(l):
-        return numpy.argsort(l)
-
-    rev2 = rev(ordered)
+    if s2n is not None:
+        lcor = s2n.rankings(s2n.codes)[0]
+    else:
+        lcor = rankingf(data)
 
-    for subset in subsets:
-        es = enrichmentScoreRanked(subset, lcor, ordered, rev2=rev2)[0]
-        enrichmentScores.append(es)
+    scorer = SubsetScorer(subsets)
+    enrichmentScores = scorer([lcor])[0]
 
     runOptCallbacks(callback)
 
-    #print "PERMUTATION", permutation
-
-    enrichmentNulls = [ [] for a in range(len(subsets)) ]
-
-    for i in range(n):
-
-        if permutation == "class":
-            d2 = shuffleClass(data, 2000+i) #fixed permutation
-            r2 = rankingf(d2)
-        else:
-            r2 = shuffleList(lcor, random.Random(2000+i))
-
-        ordered2 = orderedPointersCorr(r2)
-        rev22 = rev(ordered2)
-        for si,subset in enumerate(subsets):
-            esn = enrichmentScoreRanked(subset, r2, ordered2, rev2=rev22)[0]
-            enrichmentNulls[si].append(esn)
+    if permutation == "class":
+        permutations = s2n if s2n is not None else ClassPermutations(data, rankingf)
+    else:
+        permutations = GenePermutations(lcor)
 
-        runOptCallbacks(callback)
+    enrichmentNulls = nullEnrichmentScores(permutations, scorer, 
+        permutationSeeds(n), callback=callback, processes=processes, mapf=mapf)
 
-    return gseaSignificance(enrichmentScores, enrichmentNulls)
+    return gseaSignificance(enrichmentScores, enrichmentNulls.T)
 
 
 def runOptCallbacks(callback):
@@ -282,108 +555,65 @@ def runOptCallbacks(callback):
         except:
             callback()            
 
-def gseaR(rankings, subsets, n, callback=None):
+def gseaR(rankings, subsets, n, callback=None, processes=None, mapf=None):
     """
     """
-    enrichmentScores = []
-    ordered = orderedPointersCorr(rankings)
-    
-    def rev(l):
-        return numpy.argsort(l)
-
-    rev2 = rev(ordered)
-
-    for subset in subsets:
-
-        es = enrichmentScoreRanked(subset, rankings, ordered, rev2=rev2)[0]
-        enrichmentScores.append(es)
+    scorer = SubsetScorer(subsets)
+    enrichmentScores = scorer([rankings])[0]
     
     runOptCallbacks(callback)
 
-    enrichmentNulls = [ [] for a in range(len(subsets)) ]
-
-    for i in range(n):
-        
-        r2 = shuffleList(rankings, random.Random(2000+i))
-        ordered2 = orderedPointersCorr(r2)
-        rev22 = rev(ordered2)
-
-        for si,subset in enumerate(subsets):
-
-            esn = enrichmentScoreRanked(subset, r2, ordered2, rev2=rev22)[0]
-            enrichmentNulls[si].append(esn)
-
-        runOptCallbacks(callback)
+    enrichmentNulls = nullEnrichmentScores(GenePermutations(rankings), scorer,
+        permutationSeeds(n), callback=callback, processes=processes, mapf=mapf)
 
-    return gseaSignificance(enrichmentScores, enrichmentNulls)
+    return gseaSignificance(enrichmentScores, enrichmentNulls.T)
 
 
 def gseaSignificance(enrichmentScores, enrichmentNulls):
-
-    #print enrichmentScores
-
-    import time
-
-    tb1 = time.time()
-
-    enrichmentPVals = []
-    nEnrichmentScores = []
-    nEnrichmentNulls = []
-
-    for i in range(len(enrichmentScores)):
-        es = enrichmentScores[i]
-        enrNull = enrichmentNulls[i]
-        #print es, enrNull
-
-        enrichmentPVals.append(gseapval(es, enrNull))
-
-        #normalize the ES(S,pi) and the observed ES(S), separetely rescaling
-        #the positive and negative scores by divident by the mean of the 
-        #ES(S,pi)
-
-        #print es, enrNull
-
-        def normalize(s):
-            try:
-                if s == 0:
-                    return 0.0
-                if s >= 0:
-                    meanPos = mean([a for a in enrNull if a >= 0])
-                    #print s, meanPos
-                    return s/meanPos
-                else:
-                    meanNeg = mean([a for a in enrNull if a < 0])
-                    #print s, meanNeg
-                    return -s/meanNeg
-            except:
-                return 0.0 #return if according mean value is uncalculable
-
-
-        nes = normalize(es)
-        nEnrichmentScores.append(nes)
-        
-        nenrNull = [ normalize(s) for s in enrNull ]
-        nEnrichmentNulls.append(nenrNull)
- 
-
-    #print "First part", time.time() - tb1
-
-    #FDR computation
-    #create a histogram of all NES(S,pi) over all S and pi
-    vals = reduce(lambda x,y: x+y, nEnrichmentNulls, [])
-
-
-    def shorten(l, p=10000):
-        """
-        Take each len(l)/p element, if len(l)/p >= 2.
-        """
-        e = len(l)/p
-        if e <= 1:
-            return l
-        else:
-            return [ l[i] for i in xrange(0, len(l), e) ]
-
-    #vals = shorten(vals) -> this can speed up second part. is it relevant TODO?
+    """
+    Return (ES, NES, p-value, FDR) tuples for enrichment scores of gene
+    sets and their null distributions (a row of enrichmentNulls for
+    each gene set).
+    """
+    es = numpy.asarray(enrichmentScores, dtype=float)
+    nulls = numpy.asarray(enrichmentNulls, dtype=float).reshape(len(es), -1)
+    neg = es < 0
+    nullPos = nulls >= 0
+    nullNeg = ~nullPos
+
+    #estimate nominal p-value for S from esnull by using the positive
+    #or negative portion of the distribution corresponding to the sign 
+    #of the observed ES(S) (see gseapval)
+    higher = numpy.where(neg[:, None], nulls <= es[:, None], nulls >= es[:, None])
+    portion = numpy.where(neg, nullNeg.sum(axis=1), nullPos.sum(axis=1))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        enrichmentPVals = numpy.where(portion > 0, 
+            higher.sum(axis=1) / portion.astype(float), 1.0)
+
+    #normalize the ES(S,pi) and the observed ES(S), separetely rescaling
+    #the positive and negative scores by divident by the mean of the 
+    #ES(S,pi); 0.0 if the according mean value is uncalculable.
+    #Sums are sequential, as in mean().
+    def partMean(part):
+        if nulls.shape[1] == 0:
+            return numpy.zeros(len(es)), numpy.zeros(len(es), dtype=int)
+        return numpy.where(part, nulls, 0.0).cumsum(axis=1)[:, -1], part.sum(axis=1)
+
+    sumPos, nPos = partMean(nullPos)
+    sumNeg, nNeg = partMean(nullNeg)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        meanPos = sumPos / nPos
+        meanNeg = sumNeg / nNeg
+
+    def normalize(s, meanPos, meanNeg, nPos, nNeg):
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            pos = numpy.where((nPos > 0) & (meanPos != 0), s / meanPos, 0.0)
+            neg = numpy.where(nNeg > 0, -s / meanNeg, 0.0)
+        return numpy.where(s == 0, 0.0, numpy.where(s >= 0, pos, neg))
+
+    nEnrichmentScores = normalize(es, meanPos, meanNeg, nPos, nNeg)
+    nEnrichmentNulls = normalize(nulls, meanPos[:, None], meanNeg[:, None], 
+        nPos[:, None], nNeg[:, None])
 
     """
     Use this null distribution to compute an FDR q value, for a given NES(S) =
@@ -392,80 +622,30 @@ def gseaSignificance(enrichmentScores, enrichmentNulls):
     observed S wih NES(S) >= 0, whose NES(S) >= NES*, and similarly if NES(S)
     = NES* <= 0.
     """
-
-    nvals = numpy.array(sorted(vals))
-    nnes = numpy.array(sorted(nEnrichmentScores))
-
-    #print "LEN VALS", len(vals), len(nEnrichmentScores)
-
-    fdrs = []
-
-    import operator
-
-    for i in range(len(enrichmentScores)):
-
-        nes = nEnrichmentScores[i]
-
-        """
-        #Strighfoward but slow implementation follows in comments.
-        #Useful as code description.
-        
-        if nes >= 0:
-            op0 = operator.ge
-            opn = operator.ge
-        else:
-            op0 = operator.lt
-            opn = operator.le
-
-        allPos = [a for a in vals if op0(a,0)]
-        allHigherAndPos = [a for a in allPos if opn(a,nes) ]
-
-        nesPos = [a for a in nEnrichmentScores if op0(a,0) ]
-        nesHigherAndPos = [a for a in nesPos if opn(a,nes) ]
-
-        top = len(allHigherAndPos)/float(len(allPos)) #p value
-        down = len(nesHigherAndPos)/float(len(nesPos))
-        
-        l1 = [ len(allPos), len(allHigherAndPos), len(nesPos), len(nesHigherAndPos)]
-
-        allPos = allHigherAndPos = nesPos =  nesHigherAndPos = 1
-
-        """
-
-        #this could be speed up twice with the same accuracy! 
-        if nes >= 0:
-            allPos = int(len(vals) - numpy.searchsorted(nvals, 0, side="left"))
-            allHigherAndPos = int(len(vals) - numpy.searchsorted(nvals, nes, side="left"))
-            nesPos = len(nnes) - int(numpy.searchsorted(nnes, 0, side="left"))
-            nesHigherAndPos = len(nnes) - int(numpy.searchsorted(nnes, nes, side="left"))
-        else:
-            allPos = int(numpy.searchsorted(nvals, 0, side="left"))
-            allHigherAndPos = int(numpy.searchsorted(nvals, nes, side="right"))
-            nesPos = int(numpy.searchsorted(nnes, 0, side="left"))
-            nesHigherAndPos = int(numpy.searchsorted(nnes, nes, side="right"))
-           
-        """
-        #Comparing results
-        l2 = [ allPos, allHigherAndPos, nesPos, nesHigherAndPos ]
-        diffs = [ l1[i]-l2[i] for i in range(len(l1)) ]
-        sumd = sum( [ abs(a) for a in diffs ] )
-        if sumd > 0:
-            print nes > 0
-            print "orig", l1
-            print "modi", l2
-        """
-
-        try:
-            top = allHigherAndPos/float(allPos) #p value
-            down = nesHigherAndPos/float(nesPos)
-
-            fdrs.append(top/down)
-        except:
-            fdrs.append(1000000000.0)
-    
-    #print "Whole part", time.time() - tb1
-
-    return zip(enrichmentScores, nEnrichmentScores, enrichmentPVals, fdrs)
+    nvals = numpy.sort(nEnrichmentNulls, axis=None)
+    nnes = numpy.sort(nEnrichmentScores)
+    nes = nEnrichmentScores
+    pos = nes >= 0
+
+    allPos = numpy.where(pos, len(nvals) - numpy.searchsorted(nvals, 0, side="left"),
+        numpy.searchsorted(nvals, 0, side="left"))
+    allHigherAndPos = numpy.where(pos, 
+        len(nvals) - numpy.searchsorted(nvals, nes, side="left"),
+        numpy.searchsorted(nvals, nes, side="right"))
+    nesPos = numpy.where(pos, len(nnes) - numpy.searchsorted(nnes, 0, side="left"),
+        numpy.searchsorted(nnes, 0, side="left"))
+    nesHigherAndPos = numpy.where(pos, 
+        len(nnes) - numpy.searchsorted(nnes, nes, side="left"),
+        numpy.searchsorted(nnes, nes, side="right"))
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        top = allHigherAndPos / allPos.astype(float) #p value
+        down = nesHigherAndPos / nesPos.astype(float)
+        fdrs = top / down
+    fdrs = numpy.where((allPos > 0) & (nesPos > 0) & (down != 0), fdrs, 1000000000.0)
+
+    return zip(es.tolist(), nEnrichmentScores.tolist(), enrichmentPVals.tolist(), 
+        fdrs.tolist())
 
 
 def nth(l,n): return [ a[n] for a in l ]
@@ -895,11 +1075,14 @@ class GSEA(object):
         to a self.genesets: key is genesetname, it's values are individual
         genes and match results.
         """
-        for g in obiGeneSets.GeneSets(genesets):
-            genes = g.genes
-            datamatch = filter(lambda x: x[1] != None, 
-                [ (gene, self.gm.umatch(gene)) for gene in genes])
-            self.genesets[g] = datamatch
+        genesets = list(obiGeneSets.GeneSets(genesets))
+        #match genes of all gene sets at once
+        genes = list(set(gene for g in genesets for gene in g.genes))
+        matched = dict((gene, target) for gene, target in
+            zip(genes, obiGene.umatch_names(self.gm, genes)) if target)
+        for g in genesets:
+            self.genesets[g] = [ (gene, matched[gene]) for gene in g.genes 
+                if gene in matched ]
 
     def selectGenesets(self, minSize=3, maxSize=1000, minPart=0.1):
         """ Returns a list of gene sets that have sizes in limits """
@@ -930,7 +1113,14 @@ class GSEA(object):
         """
         return dict( (gs, self.genesIndices(nth(self.genesets[gs],1))) for gs in gsets)
 
-    def compute(self, minSize=3, maxSize=1000, minPart=0.1, n=100, callback=None, rankingf=None, permutation="class"):
+    def compute(self, minSize=3, maxSize=1000, minPart=0.1, n=100, callback=None, rankingf=None, permutation="class",
+            processes=None, mapf=None):
+        """
+        Compute enrichment of selected gene sets. Permutations are seeded
+        individually and scored in fixed shards, either serially, in a pool
+        of processes or with a map-like function mapf (see 
+        nullEnrichmentScores); the results are the same in all cases.
+        """
 
         subsetsok = self.selectGenesets(minSize=minSize, maxSize=maxSize, minPart=minPart)
 
@@ -944,10 +1134,12 @@ class GSEA(object):
             return {} # quick return if no genesets
 
         if len(itOrFirst(self.data)) > 1:
-            gseal = gseaE(self.data, nth(gsetsnumit,1), n=n, callback=callback, permutation=permutation, rankingf=rankingf)
+            gseal = gseaE(self.data, nth(gsetsnumit,1), n=n, callback=callback, permutation=permutation, rankingf=rankingf,
+                processes=processes, mapf=mapf)
         else:
             rankings = [ self.data[0][at].native() for at in self.data.domain.attributes ]
-            gseal = gseaR(rankings, nth(gsetsnumit,1), n, callback=None)
+            gseal = gseaR(rankings, nth(gsetsnumit,1), n, callback=callback,
+                processes=processes, mapf=mapf)
 
         res = {}
 
@@ -965,7 +1157,7 @@ class GSEA(object):
         return res
 
 def direct(data, gene_sets, matcher, min_size=3, max_size=1000, min_part=0.1,
-    gene_desc=None, n=100, callback=None):
+    gene_desc=None, n=100, callback=None, processes=None):
     """ Gene Set Enrichment analysis for pre-computed correlations
     between genes and phenotypes. 
     
@@ -980,11 +1172,12 @@ def direct(data, gene_sets, matcher, min_size=3, max_size=1000, min_part=0.1,
 
     assert len(data.domain.attributes) == 1 or len(data) == 1
     return runGSEA(data, geneSets=gene_sets, matcher=matcher, minSize=min_size, 
-        maxSize=max_size, minPart=min_part, n=n, geneVar=gene_desc, callback=callback)
+        maxSize=max_size, minPart=min_part, n=n, geneVar=gene_desc, callback=callback,
+        processes=processes)
 
 def run(data, gene_sets, matcher, min_size=3, max_size=1000, min_part=0.1,
     at_least=3, phenotypes=None, gene_desc=None, phen_desc=None, n=100, 
-    permutation="phenotype", callback=None, rankingf=None):
+    permutation="phenotype", callback=None, rankingf=None, processes=None):
     """ Run Gene Set Enrichment Analysis.
 
     :param Orange.data.Table data: Gene expression data.  
@@ -1015,6 +1208,8 @@ def run(data, gene_sets, matcher, min_size=3, max_size=1000, min_part=0.1,
         specifies a sample, then the user should pass the meta variable
         containing the gene names. Defaults to attribute names if each
         example specifies one sample.
+    :param int processes: If given, compute the permutations in a pool
+        of this many processes. The results are the same as without it.
 
     :return: | a dictionary where key is a gene set and values are:
         | { es: enrichment score, 
@@ -1033,19 +1228,19 @@ def run(data, gene_sets, matcher, min_size=3, max_size=1000, min_part=0.1,
     return runGSEA(data, geneSets=gene_sets, matcher=matcher, minSize=min_size, 
         maxSize=max_size, minPart=min_part, n=n, permutation=permutation, 
         geneVar=gene_desc, callback=callback, phenVar=phen_desc, 
-        classValues=phenotypes)
+        classValues=phenotypes, processes=processes)
 
 def runGSEA(data, organism=None, classValues=None, geneSets=None, n=100, 
         permutation="class", minSize=3, maxSize=1000, minPart=0.1, atLeast=3, 
         matcher=None, geneVar=None, phenVar=None, caseSensitive=False, 
-        rankingf=None, callback=None):
+        rankingf=None, callback=None, processes=None):
     gso = GSEA(data, organism=organism, matcher=matcher, 
         classValues=classValues, atLeast=atLeast, caseSensitive=caseSensitive,
         geneVar=geneVar, phenVar=phenVar)
     gso.addGenesets(geneSets)
     res1 = gso.compute(n=n, permutation=permutation, minSize=minSize,
         maxSize=maxSize, minPart=minPart, rankingf=rankingf,
-        callback=callback)
+        callback=callback, processes=processes)
     return res1
 
 def etForAttribute(datal,a):
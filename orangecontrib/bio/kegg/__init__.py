@@ -56,12 +56,11 @@ import os
 import sys
 import threading
 
-from collections import defaultdict
-from itertools import chain
 from datetime import datetime
 from contextlib import contextmanager
 
 from .. import utils, taxonomy
+from ..utils.compiled import LOAD_ERRORS
 from . import databases
 from . import entry
 
@@ -69,7 +68,9 @@ from .brite import BriteEntry, Brite
 
 from . import api
 from . import conf
+from . import caching
 from . import pathway
+from . import snapshot
 
 from functools import reduce
 
@@ -138,32 +139,55 @@ class Organism(object):
             from the KEGG Genes DBLINKS entries.
 
         """
-        definitions = self.api.list(self.org_code)
-        ncbi_geneid = self.api.conv(self.org_code, "ncbi-geneid")
-        ncbi_gi = self.api.conv(self.org_code, "ncbi-gi")
+        aliases = snapshot.organism_gene_aliases(self.api, self.org_code)
+        return [set([entry_id]).union(names)
+                for entry_id, names in aliases.iteritems()]
 
-        aliases = defaultdict(set)
+    def snapshot(self, refresh=False):
+        """
+        Return an :class:`~.snapshot.OrganismSnapshot` for this organism.
 
-        for entry_id, definition in definitions:
-            # genes entry id without the organism code
-            aliases[entry_id].add(entry_id.split(":", 1)[1])
-            # all names in the NAME field (KEGG API list returns
-            # 'NAME; DEFINITION') fields for genes
-            names = definition.split(";")[0].split(",")
-            aliases[entry_id].update([name.strip() for name in names])
+        The snapshot is built with bulk KEGG api calls and saved locally
+        on first use or when the KEGG organism release changes (or if
+        `refresh` is True). When KEGG is not reachable a previously
+        saved snapshot is used.
 
-        for source_id, target_id in chain(ncbi_geneid, ncbi_gi):
-            aliases[target_id].add(source_id.split(":", 1)[1])
+        """
+        if getattr(self, "_snapshot", None) is not None and not refresh:
+            return self._snapshot
 
-        return [set([entry_id]).union(names)
-                for entry_id, names in aliases.iteritems()]
+        path = snapshot.snapshot_path(self.org_code)
+        try:
+            release = self.api.info(self.org_code).release
+        except IOError:
+            # offline
+            release = None
+
+        compiled = None
+        if not refresh:
+            try:
+                compiled = snapshot.OrganismSnapshot.load(path)
+            except LOAD_ERRORS:
+                compiled = None
+            if compiled is not None and release is not None and \
+                    compiled.key != release:
+                compiled = None
+
+        if compiled is None:
+            compiled = snapshot.OrganismSnapshot.from_api(
+                self.api, self.org_code, release)
+            caching.touch_dir(os.path.dirname(path))
+            compiled.save(path, key=release)
+
+        self._snapshot = compiled
+        return compiled
 
     def pathways(self, with_ids=None):
         """
         Return a list of all pathways for this organism.
         """
         if with_ids is not None:
-            return self.api.get_pathways_by_genes(with_ids)
+            return self.snapshot().pathways_by_genes(with_ids)
         else:
             return [p.entry_id for p in self.api.list_pathways(self.org_code)]
 
@@ -192,39 +216,13 @@ class Organism(object):
         as items.
 
         """
-        if reference is None:
-            reference = self.genes.keys()
-        reference = set(reference)
-
-        allPathways = defaultdict(lambda: [[], 1.0, []])
-        milestones = Orange.utils.progress_bar_milestones(len(genes), 100)
-        pathways_db = KEGGPathways()
-
-        pathways_for_gene = []
-        for i, gene in enumerate(genes):
-            pathways_for_gene.append(self.pathways([gene]))
-            if callback and i in milestones:
-                callback(i * 50.0 / len(genes))
-
-        # pre-cache for speed
-        pathways_db.pre_cache([pid for pfg in pathways_for_gene
-                               for pid in pfg])
-        for i, (gene, pathways) in enumerate(zip(genes, pathways_for_gene)):
-            for pathway in pathways:
-                if pathways_db.get_entry(pathway).gene:
-                    allPathways[pathway][0].append(gene)
-            if callback and i in milestones:
-                callback(50.0 + i * 50.0 / len(genes))
-
-        pItems = allPathways.items()
-
-        for i, (p_id, entry) in enumerate(pItems):
-            pathway = pathways_db.get_entry(p_id)
-            entry[2].extend(reference.intersection(pathway.gene or []))
-            entry[1] = prob.p_value(len(entry[0]), len(reference),
-                                    len(entry[2]), len(genes))
-        return dict([(pid, (genes, p, len(ref)))
-                     for pid, (genes, p, ref) in allPathways.items()])
+        compiled = self.snapshot()
+        if callback:
+            callback(50.0)
+        enriched = compiled.enriched_pathways(genes, reference, prob)
+        if callback:
+            callback(100.0)
+        return enriched
 
     def get_genes_by_enzyme(self, enzyme):
         enzyme = KEGGEnzyme().get_entry(enzyme)
@@ -241,14 +239,7 @@ class Organism(object):
 
     def get_pathways_by_genes(self, gene_ids):
         """ Pathways that include all genes in gene_ids. """
-        l = self.api.get_genes_pathway_organism(self.org_code)
-        gene_ids = set(gene_ids)
-        gtp = defaultdict(set)
-        for a,b in l:
-            gtp[a].add(b)
-        pathways = [ gtp[g] for g in gene_ids ]
-        pathways = reduce(set.intersection, pathways)
-        return sorted(pathways)
+        return self.snapshot().pathways_by_genes(gene_ids)
 
     def get_pathways_by_enzymes(self, enzyme_ids):
         enzyme_ids = set(enzyme_ids)
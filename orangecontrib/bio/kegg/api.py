@@ -4,6 +4,7 @@ KEGG api interface.
 """
 from __future__ import absolute_import
 
+import re
 from datetime import datetime
 from contextlib import closing
 from operator import itemgetter
@@ -351,11 +352,30 @@ except ImportError:
     from Orange.utils import lru_cache
 
 
+def release_namespace(arg):
+    """
+    Return the database (release namespace) of a cached call argument
+    (e.g. 'hsa' for 'hsa:672', 'path' for 'path:hsa00010' and 'pathway'
+    for 'pathway/hsa').
+    """
+    return re.split("[:/]", arg, 1)[0]
+
+
 class CachedKeggApi(KeggApi):
+    """
+    KEGG api with calls cached in a local sqlite3 database.
+
+    Cached entries are valid for the release of their database set with
+    :func:`set_release` (or :func:`set_default_release` for all
+    databases) or, if the release is not known, by the
+    `conf.params["cache.invalidate"]` policy.
+
+    """
     def __init__(self, store=None):
         KeggApi.__init__(self)
         if store is None:
             self.store = {}
+        self.releases = {}
 
     # Needed API for cached decorator.
     def cache_store(self):
@@ -366,11 +386,40 @@ class CachedKeggApi(KeggApi):
                                                  "kegg_api_cache_2.sqlite3"))
 
     def last_modified(self, args, kwargs=None):
+        if args and isinstance(args[0], six.string_types):
+            release = self.releases.get(release_namespace(args[0]))
+            if release:
+                return release
         return getattr(self, "default_release", "")
 
     def set_default_release(self, release):
         self.default_release = release
 
+    def set_release(self, db, release):
+        """
+        Set the `release` string of database `db` ('hsa', 'path', 'cpd',
+        ...). Entries cached from a different release are invalid and
+        will be retrieved again.
+        """
+        self.releases[db] = release
+
+    def cache_stats(self):
+        """
+        Return a dictionary with cache `hits`, `misses` and `stale`
+        (invalid but used when KEGG was not reachable) counts of this
+        instance and the number of `entries` and `size` in bytes of the
+        cache store.
+        """
+        stats = caching.cache_stats(self)
+        with closing(self.cache_store()) as store:
+            entries = len(store)
+            filename = store.filename
+        size = sum(os.path.getsize(f)
+                   for f in [filename, filename + "-wal"]
+                   if os.path.exists(f))
+        return {"hits": stats.hits, "misses": stats.misses,
+                "stale": stats.stale, "entries": entries, "size": size}
+
     @cached_method
     def list_organisms(self):
         return KeggApi.list_organisms(self)
@@ -403,57 +452,77 @@ class CachedKeggApi(KeggApi):
             raise ValueError("Can batch at most 10 ids at a time.")
 
         get = self.get
-        uncached = []
-        unmatched = set()
+        keys = dict((id, get.key_from_args((id,))) for id in ids)
 
         with closing(get.cache_store()) as store:
-            # Which ids are already cached
-            # TODO: Invalidate entries by release string.
-            for id in ids:
-                key = get.key_from_args((id,))
-                if not get.key_has_valid_cache(key, store):
-                    uncached.append(id)
-
+            # Which ids are already cached (from the current release)
+            cached = store.get_many(set(keys.values()))
+            uncached = [id for id in ids
+                        if keys[id] not in cached or
+                        not get.is_entry_valid(cached[keys[id]], (id,))]
+
+        stats = caching.cache_stats(self)
+        stats.hits += len(ids) - len(uncached)
         if uncached:
-            # in case there are duplicate ids
-            uncached = sorted(set(uncached))
-
-            rval = KeggApi.get(self, uncached)
-
-            if rval is not None:
-                entries = rval.split("///\n")
-            else:
-                entries = []
-
-            if entries and not entries[-1].strip():
-                # Delete the last single newline entry if present
-                del entries[-1]
-
-            if len(entries) != len(uncached):
-                new_uncached, entries = match_by_ids(uncached, entries)
-                unmatched = set(uncached) - set(new_uncached)
-                uncached = new_uncached
-                warnings.warn("Unable to match entries for keys: %s." %
-                              ", ".join(map(repr, unmatched)))
-
+            try:
+                new = self._fetch(uncached)
+            except IOError:
+                if not all(keys[id] in cached for id in uncached):
+                    raise
+                # Could not refresh (e.g. offline), use the old entries.
+                stats.stale += len(uncached)
+                new = {}
+            stats.misses += len(new)
             with closing(get.cache_store()) as store:
-                for id, entry in zip(uncached, entries):
-                    key = get.key_from_args((id,))
-                    if entry is not None:
-                        entry = entry + "///\n"
-                    store[key] = cache_entry(entry, mtime=datetime.now())
+                store.put_many(new)
+            cached.update(new)
 
         # Finally join all the results, but drop all None objects
-
-        with closing(get.cache_store()):
-            keys = [get.key_from_args((id,)) for id in ids]
-            entries = [store[key].value for key in keys]
-
+        entries = [cached[keys[id]].value for id in ids
+                   if keys[id] in cached]
         entries = filter(lambda e: e is not None, entries)
 
         rval = "".join(entries)
         return rval
 
+    def _fetch(self, ids):
+        """
+        Retrieve the entries for `ids` from the server (bypassing the cache)
+        and return a dict mapping their `get` cache keys to `cache_entry`
+        instances ready to be stored.
+
+        """
+        get = self.get
+        # in case there are duplicate ids
+        ids = sorted(set(ids))
+
+        rval = KeggApi.get(self, ids)
+
+        if rval is not None:
+            entries = rval.split("///\n")
+        else:
+            entries = []
+
+        if entries and not entries[-1].strip():
+            # Delete the last single newline entry if present
+            del entries[-1]
+
+        if len(entries) != len(ids):
+            matched, entries = match_by_ids(ids, entries)
+            unmatched = set(ids) - set(matched)
+            ids = matched
+            warnings.warn("Unable to match entries for keys: %s." %
+                          ", ".join(map(repr, unmatched)))
+
+        now = datetime.now()
+        fetched = {}
+        for id, entry in zip(ids, entries):
+            if entry is not None:
+                entry = entry + "///\n"
+            fetched[get.key_from_args((id,))] = cache_entry(
+                entry, mtime=now, release=self.last_modified((id,)) or None)
+        return fetched
+
     @cached_method
     def conv(self, target_db, source):
         return KeggApi.conv(self, target_db, source)
@@ -3,13 +3,15 @@ Caching framework for cached kegg api calls.
 
 """
 import os
+import shutil
 import sqlite3
+import threading
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 from datetime import datetime, date, timedelta
 from . import conf
@@ -36,21 +38,55 @@ class Store(object):
 
 
 class Sqlite3Store(Store, DictMixin):
+    """
+    A persistent key/value store in an sqlite3 database.
+
+    Connections are pooled per process and thread (see :func:`connection`),
+    so opening a store is cheap. Values are stored as binary pickles.
+    Writes are committed immediately unless made inside a
+    :func:`transaction` block or with :func:`put_many`.
 
+    """
     def __init__(self, filename):
+        Store.__init__(self)
         self.filename = filename
-        self.con = sqlite3.connect(filename)
-        self.con.execute("""
-            CREATE TABLE IF NOT EXISTS cache
-                (key TEXT UNIQUE,
-                 value TEXT
-                )
-        """)
-        self.con.execute("""
-            CREATE INDEX IF NOT EXISTS cache_index
-            ON cache (key)
-        """)
-        self.con.commit()
+        self.con = connection(filename)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group all writes in the block into a single transaction.
+
+        The transaction belongs to the pooled connection, so writes through
+        other stores on the same database (in this thread) are part of it.
+        """
+        con = self.con
+        con.transaction_depth += 1
+        try:
+            yield self
+        except:
+            con.transaction_depth -= 1
+            if not con.transaction_depth:
+                con.rollback()
+            raise
+        else:
+            con.transaction_depth -= 1
+            if not con.transaction_depth:
+                con.commit()
+
+    def _commit(self):
+        if not self.con.transaction_depth:
+            self.con.commit()
+
+    @staticmethod
+    def _loads(pickle_str):
+        if not six.PY3:
+            pickle_str = str(pickle_str)
+        return pickle.loads(pickle_str)
+
+    @staticmethod
+    def _dumps(value):
+        return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
 
     def __getitem__(self, key):
         cur = self.con.execute("""
@@ -62,28 +98,69 @@ class Sqlite3Store(Store, DictMixin):
         if not r:
             raise KeyError(key)
         else:
-            pickle_str = r[0][0]
-            if not six.PY3:
-                pickle_str = str(pickle_str)
             try:
-                return pickle.loads(pickle_str)
+                return self._loads(r[0][0])
             except Exception:
                 raise KeyError(key)
 
     def __setitem__(self, key, value):
-        value = pickle.dumps(value)
         self.con.execute("""
             INSERT OR REPLACE INTO cache
             VALUES (?, ?)
-        """, (key, value))
-        self.con.commit()
+        """, (key, self._dumps(value)))
+        self._commit()
 
     def __delitem__(self, key):
-        self.con.execute("""
+        cur = self.con.execute("""
             DELETE FROM cache
             WHERE key=?
         """, (key,))
-        self.con.commit()
+        self._commit()
+        if not cur.rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        cur = self.con.execute("""
+            SELECT 1
+            FROM cache
+            WHERE key=?
+        """, (key,))
+        return cur.fetchone() is not None
+
+    has_key = __contains__
+
+    def get_many(self, keys):
+        """
+        Return a dict of `key: value` for all `keys` present in the store.
+        """
+        keys = list(keys)
+        items = {}
+        for start in range(0, len(keys), _MAX_VARIABLES):
+            chunk = keys[start: start + _MAX_VARIABLES]
+            cur = self.con.execute("""
+                SELECT key, value
+                FROM cache
+                WHERE key IN (%s)
+            """ % ", ".join("?" * len(chunk)), chunk)
+            for key, pickle_str in cur:
+                try:
+                    items[str(key)] = self._loads(pickle_str)
+                except Exception:
+                    pass
+        return items
+
+    def put_many(self, items):
+        """
+        Store all `(key, value)` pairs from `items` (a dict or a sequence
+        of pairs) in a single transaction.
+        """
+        if isinstance(items, dict):
+            items = six.iteritems(items)
+        with self.transaction():
+            self.con.executemany("""
+                INSERT OR REPLACE INTO cache
+                VALUES (?, ?)
+            """, ((key, self._dumps(value)) for key, value in items))
 
     def keys(self):
         cur = self.con.execute("""
@@ -93,43 +170,196 @@ class Sqlite3Store(Store, DictMixin):
         return [str(r[0]) for r in cur.fetchall()]
 
     def close(self):
-        pass
+        # The connection is owned by the pool; only flush pending writes.
+        self._commit()
 
     def __len__(self):
-        return None
+        cur = self.con.execute("""
+            SELECT COUNT(*)
+            FROM cache
+        """)
+        return cur.fetchone()[0]
 
     def __iter__(self):
-        return None
+        return iter(self.keys())
+
+
+# Max. number of bound parameters in a single sqlite3 statement.
+_MAX_VARIABLES = 500
+
+_pool = threading.local()
+
+
+class _Connection(sqlite3.Connection):
+    # Nesting depth of Sqlite3Store.transaction blocks on this connection.
+    transaction_depth = 0
+
+
+def connection(filename):
+    """
+    Return a pooled sqlite3 connection to a cache database `filename`.
+
+    A connection is opened once per process and thread (sqlite3 connections
+    can not be shared between threads or across a fork), in WAL journal
+    mode so readers do not block a writer.
+
+    """
+    pid = os.getpid()
+    if getattr(_pool, "pid", None) != pid:
+        _pool.pid = pid
+        _pool.connections = {}
+    filename = os.path.abspath(os.path.expanduser(filename))
+    con = _pool.connections.get(filename)
+    if con is None:
+        con = sqlite3.connect(filename, timeout=60, factory=_Connection)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS cache
+                (key TEXT UNIQUE,
+                 value TEXT
+                )
+        """)
+        con.execute("""
+            CREATE INDEX IF NOT EXISTS cache_index
+            ON cache (key)
+        """)
+        con.commit()
+        _pool.connections[filename] = con
+    return con
+
 
+def close_connections():
+    """
+    Close all pooled connections of the calling thread.
+    """
+    if getattr(_pool, "pid", None) == os.getpid():
+        for con in _pool.connections.values():
+            con.close()
+    _pool.pid = None
+    _pool.connections = {}
 
 
 class DictStore(Store, DictMixin):
+    """
+    An in memory store with the same interface as :class:`Sqlite3Store`.
+    """
     def __init__(self):
         Store.__init__(self)
+        self._data = {}
+
+    @contextmanager
+    def transaction(self):
+        yield self
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        return list(self._data)
+
+    def get_many(self, keys):
+        return dict((key, self._data[key]) for key in keys
+                    if key in self._data)
+
+    def put_many(self, items):
+        self._data.update(items)
 
     def close(self):
         pass
 
     def __len__(self):
-        return None
+        return len(self._data)
 
     def __iter__(self):
-        return None
-
+        return iter(self.keys())
 
 
 class cache_entry(object):
-    def __init__(self, value, mtime=None, expires=None):
+    #: Release of the database the value was retrieved from (if known).
+    release = None
+
+    def __init__(self, value, mtime=None, expires=None, release=None):
         self.value = value
         self.mtime = mtime
         self.expires = expires
+        self.release = release
 
 _SESSION_START = datetime.now()
 
 
+def is_fresh(mtime, policy=None):
+    """
+    Is an entry cached at `mtime` still valid under the invalidation
+    `policy` (one of "always", "session", "daily", "weekly" or "never";
+    by default `conf.params["cache.invalidate"]`).
+    """
+    if policy is None:
+        policy = conf.params["cache.invalidate"]
+
+    # Need to check datetime first (it subclasses date)
+    if isinstance(mtime, datetime):
+        pass
+    elif isinstance(mtime, date):
+        mtime = datetime(mtime.year, mtime.month, mtime.day, 1, 1, 1)
+    else:
+        return False
+
+    if policy == "always":
+        return False
+    elif policy == "session":
+        return mtime >= _SESSION_START
+    elif policy == "daily":
+        return mtime >= datetime.now().replace(hour=0, minute=0,
+                                               second=0, microsecond=0)
+    elif policy == "weekly":
+        return mtime >= datetime.now() - timedelta(7)
+    else:
+        return True
+
+
+class CacheStats(object):
+    """
+    Cache hit/miss counters of an object with cached methods.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        #: Invalid entries returned because the value could not be
+        #: retrieved (e.g. when offline).
+        self.stale = 0
+
+    def __repr__(self):
+        return "CacheStats(hits=%i, misses=%i, stale=%i)" % \
+            (self.hits, self.misses, self.stale)
+
+
+def cache_stats(instance):
+    """
+    Return the :class:`CacheStats` of an `instance` with cached methods.
+    """
+    if "_cache_stats" not in instance.__dict__:
+        instance._cache_stats = CacheStats()
+    return instance._cache_stats
+
+
 class cached_wrapper(object):
     """
-    TODO: needs documentation
+    A method bound to an `instance` whose results are cached in a store
+    returned by `cache_store` (keyed by the method name and arguments).
+
+    An entry is valid if it was retrieved from the current release (as
+    returned by `instance.last_modified(args)`) or, if the release is not
+    known, if it is fresh by the `conf.params["cache.invalidate"]` policy.
     """
     def __init__(self, function, instance, class_, cache_store,
                  last_modified=None):
@@ -154,7 +384,8 @@ class cached_wrapper(object):
             del store[key]
 
     def last_modified_from_args(self, args, kwargs=None):
-        if self.instance is not None:
+        if self.instance is not None and \
+                hasattr(self.instance, "last_modified"):
             return self.instance.last_modified(args)
 
     def invalidate_args(self, args):
@@ -162,7 +393,7 @@ class cached_wrapper(object):
 
     def invalidate_all(self):
         prefix = self.key_from_args(()).rstrip(",)")
-        with self.cache_store() as store:
+        with closing(self.cache_store()) as store, store.transaction():
             for key in store:
                 if key.startswith(prefix):
                     del store[key]
@@ -173,62 +404,51 @@ class cached_wrapper(object):
             timestamp = datetime.now()
 
         with closing(self.cache_store()) as store:
-            store[key] = cache_entry(value, mtime=timestamp)
+            store[key] = cache_entry(
+                value, mtime=timestamp,
+                release=self.last_modified_from_args(args) or None)
+
+    @property
+    def stats(self):
+        return cache_stats(self.instance)
 
     def __call__(self, *args):
         key = self.key_from_args(args)
         with closing(self.cache_store()) as store:
-            if self.key_has_valid_cache(key, store):
-                rval = store[key].value
-            else:
+            entry = store.get(key)
+            if entry is not None and self.is_entry_valid(entry, args):
+                self.stats.hits += 1
+                return entry.value
+
+            try:
                 rval = self.function(self.instance, *args)
-                store[key] = cache_entry(rval, datetime.now(), None)
+            except IOError:
+                if entry is None:
+                    raise
+                # Could not refresh (e.g. offline), use the old value.
+                self.stats.stale += 1
+                return entry.value
+
+            self.stats.misses += 1
+            store[key] = cache_entry(
+                rval, datetime.now(), None,
+                release=self.last_modified_from_args(args) or None)
 
         return rval
 
-    def key_has_valid_cache(self, key, store):
+    def key_has_valid_cache(self, key, store, args=None):
         if key not in store:
             return False
         else:
             entry = store[key]
-            return self.is_entry_valid(entry, None)
+            return self.is_entry_valid(entry, args)
 
     def is_entry_valid(self, entry, args):
-        # For now always return True, the caching architecture needs to be
-        # completely reworked
-        return True
-
-        # Need to check datetime first (it subclasses date)
-        if isinstance(entry.mtime, datetime):
-            mtime = entry.mtime
-        elif isinstance(entry.mtime, date):
-            mtime = datetime(entry.mtime.year, entry.mtime.month,
-                             entry.mtime.day, 1, 1, 1)
+        release = self.last_modified_from_args(args)
+        if release:
+            return entry.release == release
         else:
-            return False
-
-        last_modified = self.last_modified_from_args(args)
-
-        if isinstance(last_modified, date):
-            last_modified = datetime(last_modified.year, last_modified.month,
-                                     last_modified.day, 1, 1, 1)
-        elif isinstance(last_modified, str):
-            # Could have different format
-            mtime = mtime.strftime("%Y %m %d %H %M %S")
-
-        elif last_modified is None:
-            if conf.params["cache.invalidate"] == "always":
-                return False
-            elif conf.params["cache.invalidate"] == "session":
-                last_modified = _SESSION_START
-            elif conf.params["cache.invalidate"] == "daily":
-                last_modified = datetime.now().replace(hour=0, minute=0,
-                                                       second=0, microsecond=0)
-            elif conf.params["cache.invalidate"] == "weekly":
-                last_modified = datetime.now() - timedelta(7)
-            else:  # ???
-                pass
-        return last_modified <= mtime
+            return is_fresh(entry.mtime)
 
 
 class cached_method(object):
@@ -244,9 +464,9 @@ class cached_method(object):
     def get_cache_store(self, instance, owner):
         if hasattr(instance, "cache_store"):
             return instance.cache_store
-        elif not hasattr("_cached_method_cache"):
+        elif not hasattr(instance, "_cached_method_cache"):
             instance._cached_method_cache = DictStore()
-        return instance._cached_method_cache
+        return lambda: instance._cached_method_cache
 
 
 class bget_cached_method(cached_method):
@@ -288,3 +508,6 @@ def clear_cache():
 
     for png_filename in glob.glob(os.path.join(path, "*.png")):
         os.remove(png_filename)
+
+    for compiled_dirname in glob.glob(os.path.join(path, "*.compiled")):
+        shutil.rmtree(compiled_dirname)
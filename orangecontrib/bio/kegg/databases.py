@@ -6,7 +6,13 @@ DBGET Database Interface
 from __future__ import absolute_import
 
 import re
+import time
+from bisect import bisect_left
 from contextlib import closing
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import six
 
 from . import entry
 from .entry import fields
@@ -40,6 +46,68 @@ def chain_iter(chains_iter):
             yield element
 
 
+#: Number of fetched entries committed to the cache store in one transaction
+#: by :func:`DBDataBase.pre_cache`.
+_PRE_CACHE_COMMIT_SIZE = 200
+
+
+class PreCacheStats(namedtuple("PreCacheStats",
+                               ["requested", "fetched", "elapsed"])):
+    """
+    Progress of :func:`DBDataBase.pre_cache`: the number of `requested`
+    uncached entries, the number `fetched` so far and the `elapsed` time
+    in seconds.
+    """
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """Fetched entries per second."""
+        return self.fetched / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class KeyIndex(object):
+    """
+    An ordered sequence of database keys with constant time membership
+    and position lookup (through a hash index) and prefix search (by
+    bisection of the sorted keys).
+
+    """
+    def __init__(self, keys=()):
+        self.keys = list(keys)
+        self.positions = {}
+        for i, key in enumerate(self.keys):
+            self.positions.setdefault(key, i)
+        self._sorted = None
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def index(self, key):
+        """
+        Return the position of `key` (raise :class:`KeyError` if missing).
+        """
+        return self.positions[key]
+
+    def with_prefix(self, prefix):
+        """
+        Return a sorted list of all keys starting with `prefix`.
+        """
+        if self._sorted is None:
+            self._sorted = sorted(self.positions)
+        keys = self._sorted
+        end = start = bisect_left(keys, prefix)
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+        return keys[start: end]
+
+
 # TODO: DBDataBase should be able to be constructed from a flat text
 # entry file. The precache etc. should be moved in caching api, that creates
 # simple file system hierarchy where the flat database is saved (with db
@@ -73,8 +141,6 @@ class DBDataBase(object):
 
         self.api = api.CachedKeggApi()
         self._info = None
-        #TODO invalidate cache by KEGG release
-        #self.api.set_default_release(self.info.release)
         self._keys = []
 
     @property
@@ -84,6 +150,24 @@ class DBDataBase(object):
         return self._info
 
 
+    def set_release(self, release=None):
+        """
+        Make cached entries of this database valid only if they were
+        retrieved from `release` (by default the current KEGG release).
+        """
+        if release is None:
+            release = self.info.release
+        self.api.set_release(self.DB, release)
+
+    def refresh(self, release=None, **kwargs):
+        """
+        Set the database `release` (see :func:`set_release`) and retrieve
+        again all cached entries from a different release. Other entries
+        are left as they are. `kwargs` are passed to :func:`pre_cache`.
+        """
+        self.set_release(release)
+        return self.pre_cache(self.keys(), **kwargs)
+
     def keys(self):
         """
         Return a list of database keys. These are unique KEGG identifiers
@@ -92,12 +176,27 @@ class DBDataBase(object):
         """
         return list(self._keys)
 
+    def _get_keys(self):
+        return self._key_index.keys
+
+    def _set_keys(self, keys):
+        self._key_index = KeyIndex(keys)
+
+    #: Database keys (setting them rebuilds the :class:`KeyIndex`).
+    _keys = property(_get_keys, _set_keys)
+
     def iterkeys(self):
         """
         Return an iterator over the `keys`.
         """
         return iter(self._keys)
 
+    def keys_with_prefix(self, prefix):
+        """
+        Return a sorted list of database keys starting with `prefix`.
+        """
+        return self._key_index.with_prefix(prefix)
+
     def items(self):
         """
         Return a list of all (key, :obj:`DBDataBase.ENTRY_TYPE` instance)
@@ -152,13 +251,13 @@ class DBDataBase(object):
             return e
 
     def __contains__(self, key):
-        return key in set(self.keys())
+        return key in self._key_index
 
     def __len__(self):
-        return len(self.keys())
+        return len(self._key_index)
 
     def __iter__(self):
-        return iter(self.keys())
+        return iter(self._key_index)
 
     def get_text(self, key):
         """
@@ -184,12 +283,21 @@ class DBDataBase(object):
         res = self.api.find(self.DB, name).splitlines()
         return [r.split(" ", 1)[0] for r in res]
 
-    def pre_cache(self, keys=None, batch_size=10, progress_callback=None):
+    def pre_cache(self, keys=None, batch_size=10, progress_callback=None,
+                  max_workers=1, stats_callback=None):
         """
         Retrieve all the entries for `keys` and cache them locally for faster
         subsequent retrieval. If `keys` is ``None`` then all entries will be
         retrieved.
 
+        With `max_workers` > 1 up to that many batch requests are kept in
+        flight concurrently. Fetched entries are committed to the cache
+        store in bulk as batches complete, so an interrupted call resumes
+        where it stopped when called again. `progress_callback` is called
+        with the percentage of completed batches and `stats_callback`
+        (if given) with the current :class:`PreCacheStats`, which are also
+        returned.
+
         """
         if not isinstance(self.api, api.CachedKeggApi):
             raise TypeError("Not an instance of api.CachedKeggApi")
@@ -197,6 +305,9 @@ class DBDataBase(object):
         if batch_size > 10 or batch_size < 1:
             raise ValueError("Invalid batch_size")
 
+        if max_workers < 1:
+            raise ValueError("Invalid max_workers")
+
         if keys is None:
             keys = self.keys()
 
@@ -206,22 +317,53 @@ class DBDataBase(object):
 
         # drop all keys with a valid cache entry to minimize the number
         # of 'get' requests.
+        uncached = []
         with closing(get.cache_store()) as store:
-            def is_uncached(key):
-                return not get.key_has_valid_cache(get.key_from_args((key,)),
-                                                   store)
-            keys = filter(is_uncached, keys)
-
-        start = 0
-
-        while start < len(keys):
-            batch = keys[start: start + batch_size]
-            self.api.get(batch)
-
-            if progress_callback:
-                progress_callback(100.0 * start / len(keys))
+            for chunk in batch_iter(keys, 500):
+                cached = store.get_many(
+                    [get.key_from_args((key,)) for key in chunk])
+                for key in chunk:
+                    entry = cached.get(get.key_from_args((key,)))
+                    if entry is None or not get.is_entry_valid(entry, (key,)):
+                        uncached.append(key)
+
+        batches = list(batch_iter(uncached, batch_size))
+        start = time.time()
+        stats = PreCacheStats(len(uncached), 0, 0.0)
+        if not batches:
+            return stats
+
+        if max_workers > 1:
+            pool = ThreadPool(min(max_workers, len(batches)))
+            results = pool.imap_unordered(self.api._fetch, batches)
+        else:
+            pool = None
+            results = six.moves.map(self.api._fetch, batches)
 
-            start += batch_size
+        pending = {}
+        try:
+            with closing(get.cache_store()) as store:
+                for i, fetched in enumerate(results):
+                    pending.update(fetched)
+                    if len(pending) >= _PRE_CACHE_COMMIT_SIZE:
+                        store.put_many(pending)
+                        pending = {}
+
+                    stats = PreCacheStats(len(uncached),
+                                          stats.fetched + len(fetched),
+                                          time.time() - start)
+                    if progress_callback:
+                        progress_callback(100.0 * (i + 1) / len(batches))
+                    if stats_callback:
+                        stats_callback(stats)
+        finally:
+            if pending:
+                with closing(get.cache_store()) as store:
+                    store.put_many(pending)
+            if pool is not None:
+                pool.terminate()
+
+        return stats
 
     def batch_get(self, keys):
         """
@@ -326,6 +468,8 @@ class Genome(DBDataBase):
         DBDataBase.__init__(self)
         self._org_list = self.api.list_organisms()
         self._keys = [org.entry_id for org in self._org_list]
+        self._org_code_index = dict((org.org_code, org.entry_id)
+                                    for org in reversed(self._org_list))
 
     def _key_to_gn_entry_id(self, key):
         res = self.find(key)
@@ -352,10 +496,9 @@ class Genome(DBDataBase):
         identifier (T + 5 digit number).
 
         """
-        for org in self._org_list:
-            if org.org_code == code:
-                return org.entry_id
-        else:
+        try:
+            return self._org_code_index[code]
+        except KeyError:
             raise ValueError("Unknown organism code '%s'" % code)
 
     def search(self, string, relevance=False):
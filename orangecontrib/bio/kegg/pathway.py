@@ -7,16 +7,23 @@ KEGG Pathway
 from __future__ import absolute_import
 
 import os
+import hashlib
 import requests
 
 import xml.parsers
 from xml.dom import minidom
+from xml.etree import cElementTree as ElementTree
 
 from contextlib import closing
+from collections import namedtuple
+
+import numpy
 
 from . import conf
 from . import caching
 from . import api
+from ..utils.compiled import save_arrays, load_arrays, LOAD_ERRORS, \
+    csr_from_lists
 
 
 def cached_method(func, cache_name="_cached_method_cache", store=None):
@@ -151,6 +158,18 @@ class Pathway(object):
             components = dom_element.getElementsByTagName("component")
             self.components = [node.getAttribute("id") for node in components]
 
+        @classmethod
+        def from_element(cls, element):
+            """Create an entry from an `ElementTree` element."""
+            self = cls.__new__(cls)
+            self.__dict__.update(element.attrib)
+            graphics = element.find("graphics")
+            self.graphics = dict(graphics.attrib) \
+                if graphics is not None else {}
+            self.components = [node.get("id")
+                               for node in element.iter("component")]
+            return self
+
     class reaction(object):
         def __init__(self, dom_element):
             self.__dict__.update(dom_element.attributes.items())
@@ -159,16 +178,55 @@ class Pathway(object):
             self.products = [node.getAttribute("name") for node in
                              dom_element.getElementsByTagName("product")]
 
+        @classmethod
+        def from_element(cls, element):
+            """Create a reaction from an `ElementTree` element."""
+            self = cls.__new__(cls)
+            self.__dict__.update(element.attrib)
+            self.substrates = [node.get("name")
+                               for node in element.iter("substrate")]
+            self.products = [node.get("name")
+                             for node in element.iter("product")]
+            return self
+
     class relation(object):
         def __init__(self, dom_element):
             self.__dict__.update(dom_element.attributes.items())
             self.subtypes = [node.attributes.items() for node in
                              dom_element.getElementsByTagName("subtype")]
 
+        @classmethod
+        def from_element(cls, element):
+            """Create a relation from an `ElementTree` element."""
+            self = cls.__new__(cls)
+            self.__dict__.update(element.attrib)
+            self.subtypes = [node.items()
+                             for node in element.iter("subtype")]
+            return self
+
+    @cached_method
+    def kgml(self):
+        """
+        Return the parsed KGML file as a :class:`KGML` tuple (see
+        :func:`parse_kgml`) or ``None`` if the file is not valid (the
+        invalid cached file is removed, so it is downloaded again).
+        """
+        with closing(self._get_kgml()) as f:
+            try:
+                return parse_kgml(f)
+            except ElementTree.ParseError:
+                pass
+        try:
+            os.remove(self._local_kgml_filename())
+        except OSError:
+            pass
+        return None
+
     @cached_method
     def pathway_attributes(self):
-        if self.pathway_dom():
-            return dict(self.pathway_dom().attributes.items())
+        kgml = self.kgml()
+        if kgml is not None:
+            return kgml.attributes
         else:
             return None
 
@@ -224,27 +282,18 @@ class Pathway(object):
 
     @cached_method
     def entries(self):
-        dom = self.pathway_dom()
-        if dom:
-            return [self.entry(e) for e in dom.getElementsByTagName("entry")]
-        else:
-            return []
+        kgml = self.kgml()
+        return list(kgml.entries) if kgml is not None else []
 
     @cached_method
     def reactions(self):
-        dom = self.pathway_dom()
-        if dom:
-            return [self.reaction(e) for e in dom.getElementsByTagName("reaction")]
-        else:
-            return []
+        kgml = self.kgml()
+        return list(kgml.reactions) if kgml is not None else []
 
     @cached_method
     def relations(self):
-        dom = self.pathway_dom()
-        if dom:
-            return [self.relation(e) for e in dom.getElementsByTagName("relation")]
-        else:
-            return []
+        kgml = self.kgml()
+        return list(kgml.relations) if kgml is not None else []
 
     def __iter__(self):
         """
@@ -336,3 +385,340 @@ class Pathway(object):
         """
         kegg = api.CachedKeggApi()
         return kegg.list_pathways(organism)
+
+
+#: A parsed KGML file: the `pathway` element attributes and lists of
+#: :class:`Pathway.entry`, :class:`Pathway.reaction` and
+#: :class:`Pathway.relation` instances.
+KGML = namedtuple("KGML", ["attributes", "entries", "reactions", "relations"])
+
+
+def parse_kgml(source):
+    """
+    Parse a KGML file (a filename or an open file) with an incremental
+    (`iterparse`) parser and return a :class:`KGML` tuple. Elements are
+    discarded as soon as they are read, so no document tree is kept.
+    """
+    attributes = {}
+    entries, reactions, relations = [], [], []
+    for event, element in ElementTree.iterparse(source,
+                                                events=("start", "end")):
+        if event == "start":
+            if element.tag == "pathway":
+                attributes = dict(element.attrib)
+            continue
+        if element.tag == "entry":
+            entries.append(Pathway.entry.from_element(element))
+        elif element.tag == "reaction":
+            reactions.append(Pathway.reaction.from_element(element))
+        elif element.tag == "relation":
+            relations.append(Pathway.relation.from_element(element))
+        else:
+            continue
+        element.clear()
+    return KGML(attributes, entries, reactions, relations)
+
+
+def _categories(values):
+    """
+    Return a sorted list of distinct `values` and a `uint8` array of
+    their indices in it.
+    """
+    categories = sorted(set(values))
+    if len(categories) > 255:
+        raise ValueError("Too many categories")
+    index = dict((c, i) for i, c in enumerate(categories))
+    return categories, numpy.array([index[v] for v in values],
+                                   dtype=numpy.uint8)
+
+
+def _coordinate(graphics, name):
+    try:
+        return float(graphics[name])
+    except (KeyError, ValueError):
+        return numpy.nan
+
+
+class PathwayGraph(object):
+    """
+    A compiled graph of one or more KEGG pathways.
+
+    Every KGML entry is a node, every relation a directed edge between
+    two nodes and every reaction a list of substrate and product names.
+    KEGG names (e.g. 'hsa:672', 'cpd:C00031') are interned to indices
+    into the sorted `names` table; nodes list their names in CSR arrays
+    (`node_name_indptr`, `node_name_ids`), so nodes of different pathways
+    with shared names merge into a single graph over names (see
+    :func:`neighbours` and :func:`merged_edges`).
+
+    Node and edge types, relation subtypes and reaction types are stored
+    as `uint8` codes into the `node_types`, `edge_types`, `subtypes` and
+    `reaction_types` lists. Like :class:`~.snapshot.OrganismSnapshot` a
+    graph is saved as a directory of memory mapped `.npy` files.
+
+    """
+    #: Graph format version.
+    version = 1
+
+    _ARRAYS = ["pathways", "pathway_titles", "names",
+               "node_pathway", "node_entry", "node_type", "node_label",
+               "node_x", "node_y", "node_name_indptr", "node_name_ids",
+               "edge_pathway", "edge_source", "edge_target", "edge_type",
+               "edge_subtype_indptr", "edge_subtypes",
+               "reaction_pathway", "reaction_node", "reaction_type",
+               "reaction_name_indptr", "reaction_name_ids",
+               "reaction_substrate_indptr", "reaction_substrates",
+               "reaction_product_indptr", "reaction_products"]
+
+    _CATEGORIES = ["node_types", "edge_types", "subtypes", "reaction_types"]
+
+    def __init__(self, arrays, meta):
+        for name in self._ARRAYS:
+            setattr(self, name, arrays[name])
+        for name in self._CATEGORIES:
+            setattr(self, name, meta[name])
+        self.key = meta.get("key")
+        self.pathway_ids = self.pathways.tolist()
+        self.pathway_index = dict((p, i)
+                                  for i, p in enumerate(self.pathway_ids))
+        self.name_list = map(intern, self.names.tolist())
+        self.name_index = dict((n, i) for i, n in enumerate(self.name_list))
+        self._name_nodes = None
+
+    @classmethod
+    def from_kgml(cls, kgmls):
+        """
+        Compile a graph from a sequence of :class:`KGML` tuples.
+        """
+        kgmls = list(kgmls)
+        names = set()
+        for kgml in kgmls:
+            for e in kgml.entries:
+                names.update(e.name.split())
+            for r in kgml.reactions:
+                names.update(r.name.split())
+                names.update(r.substrates)
+                names.update(r.products)
+        names = sorted(names)
+        name_index = dict((n, i) for i, n in enumerate(names))
+
+        nodes, edges, reactions = [], [], []
+        for p, kgml in enumerate(kgmls):
+            entry_nodes = {}
+            for e in kgml.entries:
+                entry_nodes[e.id] = len(nodes)
+                nodes.append((p, e))
+            for r in kgml.relations:
+                if r.entry1 in entry_nodes and r.entry2 in entry_nodes:
+                    edges.append((p, entry_nodes[r.entry1],
+                                  entry_nodes[r.entry2], r))
+            for r in kgml.reactions:
+                reactions.append((p, entry_nodes.get(r.id, -1), r))
+
+        node_types, node_type = _categories([e.type for _, e in nodes])
+        edge_types, edge_type = _categories([r.type for _, _, _, r in edges])
+        edge_subtypes = [[dict(s)["name"] for s in r.subtypes
+                          if "name" in dict(s)] for _, _, _, r in edges]
+        subtypes = sorted(set(n for names in edge_subtypes for n in names))
+        subtype_index = dict((s, i) for i, s in enumerate(subtypes))
+        reaction_types, reaction_type = _categories(
+            [getattr(r, "type", "") for _, _, r in reactions])
+
+        arrays = {
+            "pathways": numpy.array(
+                [kgml.attributes.get("name", "") for kgml in kgmls],
+                dtype=str),
+            "pathway_titles": numpy.array(
+                [kgml.attributes.get("title", "") for kgml in kgmls],
+                dtype=str),
+            "names": numpy.array(names, dtype=str),
+            "node_pathway": numpy.array([p for p, _ in nodes],
+                                        dtype=numpy.int32),
+            "node_entry": numpy.array([int(e.id) for _, e in nodes],
+                                      dtype=numpy.int32),
+            "node_type": node_type,
+            "node_label": numpy.array(
+                [e.graphics.get("name", "") for _, e in nodes], dtype=str),
+            "node_x": numpy.array([_coordinate(e.graphics, "x")
+                                   for _, e in nodes], dtype=float),
+            "node_y": numpy.array([_coordinate(e.graphics, "y")
+                                   for _, e in nodes], dtype=float),
+            "edge_pathway": numpy.array([p for p, _, _, _ in edges],
+                                        dtype=numpy.int32),
+            "edge_source": numpy.array([s for _, s, _, _ in edges],
+                                       dtype=numpy.int32),
+            "edge_target": numpy.array([t for _, _, t, _ in edges],
+                                       dtype=numpy.int32),
+            "edge_type": edge_type,
+            "reaction_pathway": numpy.array([p for p, _, _ in reactions],
+                                            dtype=numpy.int32),
+            "reaction_node": numpy.array([n for _, n, _ in reactions],
+                                         dtype=numpy.int32),
+            "reaction_type": reaction_type,
+        }
+        arrays["node_name_indptr"], arrays["node_name_ids"] = \
+            csr_from_lists([[name_index[n] for n in e.name.split()]
+                            for _, e in nodes])
+        arrays["edge_subtype_indptr"], arrays["edge_subtypes"] = \
+            csr_from_lists([[subtype_index[n] for n in names]
+                            for names in edge_subtypes], dtype=numpy.uint8)
+        arrays["reaction_name_indptr"], arrays["reaction_name_ids"] = \
+            csr_from_lists([[name_index[n] for n in r.name.split()]
+                            for _, _, r in reactions])
+        arrays["reaction_substrate_indptr"], arrays["reaction_substrates"] = \
+            csr_from_lists([[name_index[n] for n in r.substrates]
+                            for _, _, r in reactions])
+        arrays["reaction_product_indptr"], arrays["reaction_products"] = \
+            csr_from_lists([[name_index[n] for n in r.products]
+                            for _, _, r in reactions])
+        meta = {"node_types": node_types, "edge_types": edge_types,
+                "subtypes": subtypes, "reaction_types": reaction_types}
+        return cls(arrays, meta)
+
+    def node_names(self, node):
+        """
+        Return a list of KEGG names of `node`.
+        """
+        ids = self.node_name_ids[self.node_name_indptr[node]:
+                                 self.node_name_indptr[node + 1]]
+        return [self.name_list[i] for i in ids]
+
+    def nodes_by_name(self, name):
+        """
+        Return an array of all nodes (in all pathways) with `name`.
+        """
+        if self._name_nodes is None:
+            nodes = numpy.repeat(numpy.arange(len(self.node_pathway)),
+                                 numpy.diff(self.node_name_indptr))
+            order = numpy.argsort(self.node_name_ids, kind="mergesort")
+            indptr = numpy.searchsorted(self.node_name_ids[order],
+                                        numpy.arange(len(self.names) + 1))
+            self._name_nodes = (indptr, nodes[order])
+        if name not in self.name_index:
+            return numpy.zeros(0, dtype=int)
+        i = self.name_index[name]
+        indptr, nodes = self._name_nodes
+        return nodes[indptr[i]: indptr[i + 1]]
+
+    def pathway_nodes(self, pathway_id):
+        """
+        Return an array of the nodes of `pathway_id`.
+        """
+        return numpy.flatnonzero(
+            self.node_pathway == self.pathway_index[pathway_id])
+
+    def names_of_type(self, type, pathway_id=None):
+        """
+        Return a sorted list of names of all nodes of `type` (e.g.
+        'gene', 'compound'), in all pathways or in `pathway_id`.
+        """
+        if type not in self.node_types:
+            return []
+        mask = self.node_type == self.node_types.index(type)
+        if pathway_id is not None:
+            mask &= self.node_pathway == self.pathway_index[pathway_id]
+        nodes = numpy.flatnonzero(mask)
+        starts = self.node_name_indptr[nodes]
+        ends = self.node_name_indptr[nodes + 1]
+        ids = numpy.unique(numpy.concatenate(
+            [self.node_name_ids[s: e] for s, e in zip(starts, ends)] or
+            [numpy.zeros(0, dtype=numpy.int32)]))
+        return [self.name_list[i] for i in ids]
+
+    def merged_edges(self, edge_types=None):
+        """
+        Return a sorted list of distinct `(source_name, target_name,
+        edge_type)` tuples: relations of all pathways with nodes replaced
+        by their names. Restrict to `edge_types` if given.
+        """
+        edges = numpy.arange(len(self.edge_source))
+        if edge_types is not None:
+            codes = [i for i, t in enumerate(self.edge_types)
+                     if t in edge_types]
+            edges = edges[numpy.in1d(self.edge_type[edges], codes)]
+        merged = set()
+        for e in edges:
+            edge_type = self.edge_types[self.edge_type[e]]
+            for source in self.node_names(self.edge_source[e]):
+                for target in self.node_names(self.edge_target[e]):
+                    merged.add((source, target, edge_type))
+        return sorted(merged)
+
+    def neighbours(self, name):
+        """
+        Return a sorted list of names linked to `name` by a relation
+        (in either direction) in any of the pathways.
+        """
+        nodes = self.nodes_by_name(name)
+        linked = numpy.concatenate(
+            [self.edge_target[numpy.in1d(self.edge_source, nodes)],
+             self.edge_source[numpy.in1d(self.edge_target, nodes)]])
+        names = set()
+        for node in numpy.unique(linked):
+            names.update(self.node_names(node))
+        names.discard(name)
+        return sorted(names)
+
+    def save(self, path, key=None):
+        """
+        Save the graph into a directory `path`.
+        """
+        meta = dict((name, getattr(self, name)) for name in self._CATEGORIES)
+        meta["key"] = key
+        save_arrays(path, self, meta)
+        self.key = key
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load a graph saved with :func:`save` memory mapping its arrays.
+        """
+        return cls(*load_arrays(path, cls, mmap_mode))
+
+
+def organism_graph(org, local_cache=None, progress_callback=None):
+    """
+    Return a :class:`PathwayGraph` of all pathways of KEGG organism `org`.
+
+    The graph is compiled from the (downloaded if needed) KGML files once
+    and saved in the cache directory; it is recompiled when the list of
+    pathways or their local KGML files change.
+
+    """
+    if local_cache is None:
+        local_cache = conf.params["cache.path"]
+    caching.touch_dir(local_cache)
+    pathways = [Pathway(d.entry_id, local_cache=local_cache)
+                for d in Pathway.list(org)]
+
+    # make sure all KGML files are available locally
+    for i, p in enumerate(pathways):
+        p._get_kgml().close()
+        if progress_callback:
+            progress_callback(50.0 * (i + 1) / len(pathways))
+
+    def stat(filename):
+        st = os.stat(filename)
+        return (os.path.basename(filename), st.st_size, int(st.st_mtime))
+
+    key = "v%i.%s" % (PathwayGraph.version, hashlib.sha1(
+        repr([stat(p._local_kgml_filename()) for p in pathways])
+    ).hexdigest())
+    path = os.path.join(os.path.expanduser(local_cache),
+                        "pathways_%s.compiled" % org)
+    try:
+        graph = PathwayGraph.load(path)
+    except LOAD_ERRORS:
+        graph = None
+
+    if graph is None or graph.key != key:
+        kgmls = []
+        for i, p in enumerate(pathways):
+            kgml = p.kgml()
+            if kgml is not None:
+                kgmls.append(kgml)
+            if progress_callback:
+                progress_callback(50.0 + 50.0 * (i + 1) / len(pathways))
+        graph = PathwayGraph.from_kgml(kgmls)
+        graph.save(path, key)
+    return graph
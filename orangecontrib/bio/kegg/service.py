@@ -8,10 +8,13 @@ REST_API = "http://rest.kegg.jp/"
 
 def slumber_service():
     """
-    Return a rest based service using `slumber` package
+    Return a rest based service using `slumber` package (one instance
+    per `REST_API` url).
     """
     import slumber
     if not hasattr(slumber_service, "_cached"):
+        slumber_service._cached = {}
+    if REST_API not in slumber_service._cached:
 
         class DecodeSerializer(slumber.serialize.BaseSerializer):
             key = "decode"
@@ -23,8 +26,9 @@ def slumber_service():
         # for python 2/3 compatibility
         serializer = slumber.serialize.Serializer(
             default="decode", serializers=[DecodeSerializer()])
-        slumber_service._cached = slumber.API(REST_API, serializer=serializer)
-    return slumber_service._cached
+        slumber_service._cached[REST_API] = slumber.API(
+            REST_API, serializer=serializer)
+    return slumber_service._cached[REST_API]
 
 
 from . import conf
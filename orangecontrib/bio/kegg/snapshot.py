@@ -0,0 +1,296 @@
+"""
+Compiled organism snapshots
+===========================
+
+An :class:`OrganismSnapshot` holds the gene to pathway incidence of a KEGG
+organism as sparse (CSR) numpy arrays together with the pathway names and
+gene aliases. It is built with a few bulk `list`/`link`/`conv` api calls
+and saved locally, so pathway queries and enrichment for gene lists are
+computed in memory without per gene lookups.
+
+"""
+from __future__ import absolute_import
+
+import os
+from collections import defaultdict
+from itertools import chain
+
+import numpy
+
+from . import conf
+from ..utils.compiled import save_arrays, load_arrays, csr_from_pairs, \
+    csr_gather
+
+
+def organism_gene_aliases(api, org):
+    """
+    Return a dictionary mapping KEGG gene ids of organism `org` to sets of
+    their aliases (the id without the organism prefix, the names from the
+    KEGG `list` and the linked 'ncbi-geneid' and 'ncbi-gi' ids).
+    """
+    definitions = api.list(org)
+    ncbi_geneid = api.conv(org, "ncbi-geneid")
+    ncbi_gi = api.conv(org, "ncbi-gi")
+
+    aliases = defaultdict(set)
+
+    for entry_id, definition in definitions:
+        # genes entry id without the organism code
+        aliases[entry_id].add(entry_id.split(":", 1)[1])
+        # all names in the NAME field (KEGG API list returns
+        # 'NAME; DEFINITION') fields for genes
+        names = definition.split(";")[0].split(",")
+        aliases[entry_id].update([name.strip() for name in names])
+
+    for source_id, target_id in chain(ncbi_geneid, ncbi_gi):
+        aliases[target_id].add(source_id.split(":", 1)[1])
+
+    return aliases
+
+
+class OrganismSnapshot(object):
+    """
+    Gene to pathway incidence, pathway names and gene aliases of a KEGG
+    organism.
+
+    Genes and pathways are interned to integers (indices into the sorted
+    `genes` and `pathways` string tables). The incidence is stored in CSR
+    arrays by gene (`gene_indptr`, `gene_pathways`) and by pathway
+    (`pathway_indptr`, `pathway_genes`); aliases in a sorted `aliases`
+    table with the genes they name in `alias_indptr`, `alias_genes`.
+
+    A snapshot is saved as a directory of `.npy` files which are memory
+    mapped on load.
+
+    """
+    #: Snapshot format version.
+    version = 1
+
+    _ARRAYS = ["genes", "pathways", "pathway_names",
+               "gene_indptr", "gene_pathways",
+               "pathway_indptr", "pathway_genes",
+               "aliases", "alias_indptr", "alias_genes"]
+
+    def __init__(self, arrays, meta):
+        for name in self._ARRAYS:
+            setattr(self, name, arrays[name])
+        self.org_code = meta["org_code"]
+        self.release = meta.get("release")
+        self.key = meta.get("key")
+        self.gene_ids = map(intern, self.genes.tolist())
+        self.pathway_ids = map(intern, self.pathways.tolist())
+        self.gene_index = dict((g, i) for i, g in enumerate(self.gene_ids))
+        self.pathway_index = dict((p, i)
+                                  for i, p in enumerate(self.pathway_ids))
+
+    @classmethod
+    def from_data(cls, org_code, genes, pathways, links, aliases=(),
+                  release=None):
+        """
+        Compile a snapshot from a list of KEGG gene ids `genes`, a list of
+        `(pathway_id, name)` tuples `pathways`, a sequence of
+        `(gene_id, pathway_id)` `links` and `(alias, gene_id)` `aliases`.
+        Links and aliases of unknown genes or pathways are ignored.
+        """
+        genes = sorted(set(genes))
+        pathways = sorted(set(pathways))
+        gene_index = dict((g, i) for i, g in enumerate(genes))
+        pathway_index = dict((p, i) for i, (p, _) in enumerate(pathways))
+
+        links = sorted(set((gene_index[g], pathway_index[p])
+                           for g, p in links
+                           if g in gene_index and p in pathway_index))
+        aliases = sorted(set((a, gene_index[g]) for a, g in aliases
+                             if g in gene_index))
+        alias_names = sorted(set(a for a, _ in aliases))
+        alias_index = dict((a, i) for i, a in enumerate(alias_names))
+
+        link_genes = [g for g, _ in links]
+        link_pathways = [p for _, p in links]
+
+        arrays = {
+            "genes": numpy.array(genes, dtype=str),
+            "pathways": numpy.array([p for p, _ in pathways], dtype=str),
+            "pathway_names": numpy.array([name for _, name in pathways],
+                                         dtype=str),
+            "aliases": numpy.array(alias_names, dtype=str),
+        }
+        arrays["gene_indptr"], arrays["gene_pathways"] = \
+            csr_from_pairs(link_genes, link_pathways, len(genes))
+        arrays["pathway_indptr"], arrays["pathway_genes"] = \
+            csr_from_pairs(link_pathways, link_genes, len(pathways))
+        arrays["alias_indptr"], arrays["alias_genes"] = \
+            csr_from_pairs([alias_index[a] for a, _ in aliases],
+                 [g for _, g in aliases], len(alias_names))
+        meta = {"org_code": org_code, "release": release}
+        return cls(arrays, meta)
+
+    @classmethod
+    def from_api(cls, api, org, release=None):
+        """
+        Build a snapshot for organism `org` with bulk calls to a
+        :class:`~.api.KeggApi` instance `api`.
+        """
+        genes = [d.entry_id for d in api.list(org)]
+        pathways = [(d.entry_id, d.definition)
+                    for d in api.list_pathways(org)]
+        links = api.get_genes_pathway_organism(org)
+        aliases = [(alias, gene) for gene, names in
+                   organism_gene_aliases(api, org).iteritems()
+                   for alias in names]
+        return cls.from_data(org, genes, pathways, links, aliases, release)
+
+    def gene_indices(self, genes):
+        """
+        Return an array of indices into `genes` for a list of KEGG gene
+        ids or their unique aliases (-1 for unknown or ambiguous names).
+        """
+        indices = numpy.empty(len(genes), dtype=numpy.int64)
+        for i, gene in enumerate(genes):
+            index = self.gene_index.get(gene)
+            if index is None:
+                index = self._alias_gene(gene)
+            indices[i] = index
+        return indices
+
+    def _alias_gene(self, alias):
+        i = numpy.searchsorted(self.aliases, alias)
+        if i == len(self.aliases) or self.aliases[i] != alias:
+            return -1
+        start, end = self.alias_indptr[i], self.alias_indptr[i + 1]
+        return self.alias_genes[start] if end - start == 1 else -1
+
+    def gene_aliases(self):
+        """
+        Return a list of sets of aliases of each gene (including its id).
+        """
+        aliases = [set([g]) for g in self.gene_ids]
+        counts = numpy.diff(self.alias_indptr)
+        for alias, gene in zip(numpy.repeat(self.aliases, counts).tolist(),
+                               self.alias_genes.tolist()):
+            aliases[gene].add(alias)
+        return aliases
+
+    def pathway_name(self, pathway_id):
+        """
+        Return the name of `pathway_id`.
+        """
+        return self.pathway_names[self.pathway_index[pathway_id]]
+
+    def pathways_for_gene(self, gene_id):
+        """
+        Return a list of pathway ids which include `gene_id`.
+        """
+        i = self.gene_index.get(gene_id)
+        if i is None:
+            return []
+        indices = self.gene_pathways[self.gene_indptr[i]:
+                                     self.gene_indptr[i + 1]]
+        return [self.pathway_ids[j] for j in indices]
+
+    def genes_for_pathway(self, pathway_id):
+        """
+        Return a list of KEGG gene ids in `pathway_id`.
+        """
+        i = self.pathway_index.get(pathway_id)
+        if i is None:
+            return []
+        indices = self.pathway_genes[self.pathway_indptr[i]:
+                                     self.pathway_indptr[i + 1]]
+        return [self.gene_ids[j] for j in indices]
+
+    def gene_mask(self, genes):
+        """
+        Return a boolean mask of the known `genes` (ids or aliases).
+        """
+        indices = self.gene_indices(genes)
+        mask = numpy.zeros(len(self.gene_ids), dtype=bool)
+        mask[indices[indices >= 0]] = True
+        return mask
+
+    def pathway_counts(self, mask):
+        """
+        Return the number of genes in gene `mask` in each pathway.
+        """
+        csum = numpy.zeros(len(self.pathway_genes) + 1, dtype=numpy.int64)
+        numpy.cumsum(mask[self.pathway_genes], out=csum[1:])
+        return csum[self.pathway_indptr[1:]] - csum[self.pathway_indptr[:-1]]
+
+    def pathways_by_genes(self, genes):
+        """
+        Return a sorted list of pathway ids which include all `genes`.
+        """
+        indices = self.gene_indices(genes)
+        if not len(indices) or (indices < 0).any():
+            return []
+        indices = numpy.unique(indices)
+        _, pathways = csr_gather(self.gene_indptr, self.gene_pathways,
+                                  indices)
+        counts = numpy.bincount(pathways, minlength=len(self.pathway_ids))
+        return sorted(self.pathway_ids[i]
+                      for i in numpy.flatnonzero(counts == len(indices)))
+
+    def enriched_pathways(self, genes, reference=None, prob=None):
+        """
+        Return a dictionary with pathway ids (of pathways with at least one
+        of the `genes`) as keys and `(list_of_genes, p_value,
+        num_of_reference_genes)` tuples as items. `genes` and `reference`
+        can be KEGG gene ids or their aliases; the lists of genes contain
+        the names as given in `genes`.
+        """
+        if prob is None:
+            from ..utils import stats
+            prob = stats.Binomial()
+
+        indices = self.gene_indices(genes)
+        if reference is None:
+            ref_mask = numpy.ones(len(self.gene_ids), dtype=bool)
+            ref_size = len(self.gene_ids)
+        else:
+            reference = set(reference)
+            ref_mask = self.gene_mask(list(reference))
+            ref_size = len(reference)
+
+        known = numpy.flatnonzero(indices >= 0)
+        positions, pathways = csr_gather(self.gene_indptr,
+                                          self.gene_pathways, indices[known])
+        if not len(pathways):
+            return {}
+
+        order = numpy.argsort(pathways, kind="mergesort")
+        pathways, positions = pathways[order], known[positions[order]]
+        present, starts = numpy.unique(pathways, return_index=True)
+        ends = numpy.r_[starts[1:], len(pathways)]
+
+        ref_counts = self.pathway_counts(ref_mask)[present]
+        p_values = prob.p_values(ends - starts, ref_size, ref_counts,
+                                 len(genes))
+        return dict((self.pathway_ids[p],
+                     ([genes[i] for i in positions[start: end]],
+                      float(p_value), int(ref_count)))
+                    for p, start, end, p_value, ref_count in
+                    zip(present, starts, ends, p_values, ref_counts))
+
+    def save(self, path, key=None):
+        """
+        Save the snapshot into a directory `path`.
+        """
+        meta = {"key": key, "org_code": self.org_code,
+                "release": self.release}
+        save_arrays(path, self, meta)
+        self.key = key
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load a snapshot saved with :func:`save` memory mapping its arrays.
+        """
+        return cls(*load_arrays(path, cls, mmap_mode))
+
+
+def snapshot_path(org):
+    """
+    Return the local path of the snapshot for organism `org`.
+    """
+    return os.path.join(os.path.expanduser(conf.params["cache.path"]),
+                        "organism_%s.compiled" % org)
@@ -0,0 +1,111 @@
+import unittest
+import tempfile
+import shutil
+import os
+from datetime import datetime, timedelta
+
+from .. import caching
+
+
+class TestSqlite3Store(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "cache.sqlite3")
+
+    def tearDown(self):
+        caching.close_connections()
+        shutil.rmtree(self.tmpdir)
+
+    def test_store(self):
+        store = caching.Sqlite3Store(self.filename)
+        self.assertEqual(len(store), 0)
+        store["a"] = caching.cache_entry("A\x00\xff")
+        store.put_many([("key%i" % i, i) for i in range(1200)])
+        self.assertEqual(len(store), 1201)
+        self.assertTrue("key5" in store)
+        self.assertFalse("b" in store)
+
+        store = caching.Sqlite3Store(self.filename)
+        self.assertEqual(store["a"].value, "A\x00\xff")
+        self.assertEqual(sorted(store)[:3], ["a", "key0", "key1"])
+        items = store.get_many(["key%i" % i for i in range(0, 1500, 2)])
+        self.assertEqual(items, dict(("key%i" % i, i)
+                                     for i in range(0, 1200, 2)))
+
+        del store["a"]
+        self.assertRaises(KeyError, store.__getitem__, "a")
+        try:
+            with store.transaction():
+                store["b"] = 1
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse("b" in store)
+        self.assertIs(caching.connection(self.filename), store.con)
+
+    def test_shared_transaction(self):
+        store = caching.Sqlite3Store(self.filename)
+        other = caching.Sqlite3Store(self.filename)
+        try:
+            with store.transaction():
+                store["a"] = 1
+                other["b"] = 2
+                other.close()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse("a" in store)
+        self.assertFalse("b" in other)
+
+
+class TestCachedMethod(unittest.TestCase):
+    def test_dict_store(self):
+        class A(object):
+            calls = 0
+
+            @caching.cached_method
+            def f(self, x):
+                self.calls += 1
+                return x * 2
+
+        a = A()
+        self.assertEqual([a.f(1), a.f(1), a.f(2)], [2, 2, 4])
+        self.assertEqual(a.calls, 2)
+        a.f.invalidate_all()
+        self.assertEqual(len(a._cached_method_cache), 0)
+
+    def test_release(self):
+        class A(object):
+            calls = 0
+            release = "r1"
+            offline = False
+
+            def last_modified(self, args):
+                return self.release
+
+            @caching.cached_method
+            def f(self, x):
+                if self.offline:
+                    raise IOError
+                self.calls += 1
+                return x * self.calls
+
+        a = A()
+        self.assertEqual([a.f(1), a.f(1)], [1, 1])
+        a.release = "r2"
+        self.assertEqual([a.f(1), a.f(1)], [2, 2])
+        a.release, a.offline = "r3", True
+        self.assertEqual(a.f(1), 2)
+        self.assertRaises(IOError, a.f, 2)
+        stats = caching.cache_stats(a)
+        self.assertEqual((stats.hits, stats.misses, stats.stale), (2, 2, 1))
+
+    def test_is_fresh(self):
+        now = datetime.now()
+        self.assertTrue(caching.is_fresh(now, "weekly"))
+        self.assertFalse(caching.is_fresh(now - timedelta(8), "weekly"))
+        self.assertTrue(caching.is_fresh(now, "daily"))
+        self.assertFalse(caching.is_fresh(now - timedelta(1), "daily"))
+        self.assertFalse(caching.is_fresh(now, "always"))
+        self.assertTrue(caching.is_fresh(now - timedelta(100), "never"))
+        self.assertFalse(caching.is_fresh(None, "never"))
@@ -1,8 +1,14 @@
 import unittest
+import tempfile
+import shutil
+import threading
 import six
 
+from six.moves import BaseHTTPServer
+
 from .. import databases
 from .. import pathway
+from .. import service, conf, caching
 
 
 class TestGenome(unittest.TestCase):
@@ -87,3 +93,112 @@ class TestUtils(unittest.TestCase):
         for exp, batch in zip(expected,
                               databases.batch_iter(iter, 10)):
             self.assertEqual(exp, batch)
+
+    def test_key_index(self):
+        class Compound(databases.DBDataBase):
+            DB = "cpd"
+
+            def __init__(self):
+                databases.DBDataBase.__init__(self)
+                self._keys = ["cpd:C00002", "cpd:C00001", "cpd:C01000"]
+
+        db = Compound()
+        self.assertTrue("cpd:C00001" in db)
+        self.assertFalse("C00001" in db)
+        self.assertEqual(len(db), 3)
+        self.assertEqual(list(db), db.keys())
+        self.assertEqual(db.keys_with_prefix("cpd:C000"),
+                         ["cpd:C00001", "cpd:C00002"])
+        self.assertEqual(db.keys_with_prefix("cpd:D"), [])
+        self.assertEqual(db._key_index.index("cpd:C01000"), 2)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        ids = self.path.strip("/").split("/")[1].split("+")
+        self.server.requests.append(ids)
+        body = "".join("ENTRY       %s    Compound\n///\n" % id.split(":")[1]
+                       for id in ids if not id.endswith("missing"))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPreCache(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                StandInHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever).start()
+        self.rest_api = service.REST_API
+        service.REST_API = "http://127.0.0.1:%i/" % self.server.server_port
+        self.cache_path = conf.params["cache.path"]
+        self.tmpdir = tempfile.mkdtemp()
+        conf.params["cache.path"] = self.tmpdir
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        service.REST_API = self.rest_api
+        conf.params["cache.path"] = self.cache_path
+        caching.close_connections()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pre_cache(self):
+        class Compound(databases.DBDataBase):
+            DB = "cpd"
+
+        db = Compound()
+        keys = ["C%05i" % i for i in range(95)]
+        progress, stats = [], []
+        res = db.pre_cache(keys[:40], max_workers=4,
+                           progress_callback=progress.append,
+                           stats_callback=stats.append)
+        self.assertEqual(res.requested, 40)
+        self.assertEqual(res.fetched, 40)
+        self.assertEqual(progress[-1], 100.0)
+        self.assertEqual(len(stats), 4)
+        self.assertEqual(len(self.server.requests), 4)
+
+        # resumes with the uncached keys only
+        res = db.pre_cache(keys + ["missing"], max_workers=4)
+        self.assertEqual(res.requested, 56)
+        self.assertEqual(res.fetched, 55)
+        self.assertEqual(sorted(sum(self.server.requests, [])),
+                         sorted("cpd:" + key for key in keys + ["missing"]))
+
+        del self.server.requests[:]
+        self.assertEqual(db.get_text("C00042"),
+                         "ENTRY       C00042    Compound\n///\n")
+        self.assertEqual(db.pre_cache(keys).requested, 0)
+        self.assertEqual(self.server.requests, [])
+
+    def test_refresh(self):
+        class Compound(databases.DBDataBase):
+            DB = "cpd"
+
+            def __init__(self):
+                databases.DBDataBase.__init__(self)
+                self._keys = ["cpd:C%05i" % i for i in range(12)]
+
+        db = Compound()
+        db.set_release("r1")
+        db.pre_cache(db.keys()[:5])
+        del self.server.requests[:]
+
+        # entries from an unknown release are fetched again
+        self.assertEqual(db.refresh("r1").fetched, 7)
+        self.assertEqual(db.refresh("r1").fetched, 0)
+        self.assertEqual(db.refresh("r2", max_workers=2).fetched, 12)
+        self.assertEqual(len(sum(self.server.requests, [])), 19)
+
+        db.get_text("C00001")
+        stats = db.api.cache_stats()
+        self.assertGreaterEqual(stats["entries"], 12)
+        self.assertEqual(stats["hits"], 1)
+        self.assertGreater(stats["size"], 0)
@@ -0,0 +1,118 @@
+import unittest
+import tempfile
+import shutil
+import os
+from xml.dom import minidom
+
+from .. import pathway
+from ..types import Definition
+
+KGML_1 = """<?xml version="1.0"?>
+<!DOCTYPE pathway SYSTEM "http://www.kegg.jp/kegg/xml/KGML_v0.7.1_.dtd">
+<pathway name="path:hsa00001" org="hsa" number="00001" title="First">
+    <entry id="1" name="hsa:1 hsa:2" type="gene" reaction="rn:R1">
+        <graphics name="A1, B2" x="10" y="20" type="rectangle"/>
+    </entry>
+    <entry id="2" name="cpd:C00001" type="compound">
+        <graphics name="C00001" x="30" y="40" type="circle"/>
+    </entry>
+    <entry id="3" name="hsa:3" type="gene">
+        <graphics name="C3" x="50" y="60" type="rectangle"/>
+    </entry>
+    <relation entry1="1" entry2="3" type="PPrel">
+        <subtype name="activation" value="--&gt;"/>
+    </relation>
+    <reaction id="1" name="rn:R1" type="irreversible">
+        <substrate id="2" name="cpd:C00001"/>
+        <product id="4" name="cpd:C00002"/>
+    </reaction>
+</pathway>
+"""
+
+KGML_2 = """<?xml version="1.0"?>
+<pathway name="path:hsa00002" org="hsa" number="00002" title="Second">
+    <entry id="7" name="hsa:3" type="gene">
+        <graphics name="C3" x="1" y="2" type="rectangle"/>
+    </entry>
+    <entry id="8" name="hsa:4" type="gene">
+        <graphics name="D4" x="3" y="4" type="rectangle"/>
+    </entry>
+    <entry id="9" name="undefined" type="group">
+        <component id="7"/>
+        <component id="8"/>
+    </entry>
+    <relation entry1="7" entry2="8" type="GErel">
+        <subtype name="expression" value="--&gt;"/>
+    </relation>
+</pathway>
+"""
+
+
+class TestPathway(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, kgml in [("hsa00001", KGML_1), ("hsa00002", KGML_2)]:
+            with open(os.path.join(self.tmpdir, name + ".xml"), "w") as f:
+                f.write(kgml)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse(self):
+        p = pathway.Pathway("path:hsa00001", local_cache=self.tmpdir)
+        dom = minidom.parseString(KGML_1)
+        self.assertEqual(p.title, "First")
+        self.assertEqual(
+            [e.__dict__ for e in p.entries()],
+            [pathway.Pathway.entry(e).__dict__
+             for e in dom.getElementsByTagName("entry")])
+        self.assertEqual(
+            [r.__dict__ for r in p.reactions()],
+            [pathway.Pathway.reaction(e).__dict__
+             for e in dom.getElementsByTagName("reaction")])
+        self.assertEqual(
+            [r.__dict__ for r in p.relations()],
+            [pathway.Pathway.relation(e).__dict__
+             for e in dom.getElementsByTagName("relation")])
+        self.assertEqual(p.genes(), ["hsa:1", "hsa:2", "hsa:3"])
+
+    def test_invalid_kgml(self):
+        filename = os.path.join(self.tmpdir, "hsa00003.xml")
+        with open(filename, "w") as f:
+            f.write(KGML_2[:100])
+        p = pathway.Pathway("path:hsa00003", local_cache=self.tmpdir)
+        self.assertIs(p.kgml(), None)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_graph(self):
+        list_ = pathway.Pathway.list
+        pathway.Pathway.list = classmethod(
+            lambda cls, org: [Definition("path:hsa00001", "First"),
+                              Definition("path:hsa00002", "Second")])
+        try:
+            graph = pathway.organism_graph("hsa", local_cache=self.tmpdir)
+        finally:
+            pathway.Pathway.list = list_
+
+        self.assertEqual(graph.pathway_ids, ["path:hsa00001", "path:hsa00002"])
+        self.assertEqual(graph.names_of_type("gene"),
+                         ["hsa:1", "hsa:2", "hsa:3", "hsa:4"])
+        self.assertEqual(graph.names_of_type("gene", "path:hsa00002"),
+                         ["hsa:3", "hsa:4"])
+        self.assertEqual(len(graph.nodes_by_name("hsa:3")), 2)
+        self.assertEqual(graph.neighbours("hsa:3"), ["hsa:1", "hsa:2", "hsa:4"])
+        self.assertEqual(graph.merged_edges(["PPrel"]),
+                         [("hsa:1", "hsa:3", "PPrel"),
+                          ("hsa:2", "hsa:3", "PPrel")])
+        self.assertEqual(graph.subtypes, ["activation", "expression"])
+        self.assertEqual(graph.node_label[0], "A1, B2")
+
+        loaded = pathway.PathwayGraph.load(
+            os.path.join(self.tmpdir, "pathways_hsa.compiled"))
+        self.assertEqual(loaded.key, graph.key)
+        self.assertEqual(loaded.merged_edges(), graph.merged_edges())
+        substrates = loaded.reaction_substrates[
+            loaded.reaction_substrate_indptr[0]:
+            loaded.reaction_substrate_indptr[1]]
+        self.assertEqual([loaded.name_list[i] for i in substrates],
+                         ["cpd:C00001"])
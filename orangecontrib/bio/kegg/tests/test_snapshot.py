@@ -0,0 +1,79 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from .. import snapshot
+from ..types import Definition, Link
+from ...utils import stats
+
+
+class FakeApi(object):
+    def list(self, org):
+        return [Definition("hsa:1", "A1, AA; gene a"),
+                Definition("hsa:2", "B2; gene b"),
+                Definition("hsa:3", "C3, AA; gene c"),
+                Definition("hsa:4", "D4; gene d")]
+
+    def list_pathways(self, org):
+        return [Definition("path:hsa00010", "Glycolysis"),
+                Definition("path:hsa00020", "TCA cycle")]
+
+    def get_genes_pathway_organism(self, org):
+        return [("hsa:1", "path:hsa00010"), ("hsa:2", "path:hsa00010"),
+                ("hsa:2", "path:hsa00020"), ("hsa:3", "path:hsa00020"),
+                ("hsa:9", "path:hsa00020")]
+
+    def conv(self, org, db):
+        if db == "ncbi-geneid":
+            return [Link("ncbi-geneid:100", "hsa:1")]
+        return []
+
+
+class TestOrganismSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = snapshot.OrganismSnapshot.from_api(
+            FakeApi(), "hsa", "release 1")
+
+    def test_queries(self):
+        snap = self.snapshot
+        self.assertEqual(list(snap.gene_indices(["hsa:2", "100", "AA", "x"])),
+                         [1, 0, -1, -1])
+        self.assertEqual(snap.pathways_for_gene("hsa:2"),
+                         ["path:hsa00010", "path:hsa00020"])
+        self.assertEqual(snap.genes_for_pathway("path:hsa00020"),
+                         ["hsa:2", "hsa:3"])
+        self.assertEqual(snap.pathways_by_genes(["hsa:2", "C3"]),
+                         ["path:hsa00020"])
+        self.assertEqual(snap.pathways_by_genes(["hsa:2", "unknown"]), [])
+        self.assertEqual(snap.pathway_name("path:hsa00010"), "Glycolysis")
+        self.assertEqual(snap.gene_aliases()[0],
+                         set(["hsa:1", "1", "A1", "AA", "100"]))
+
+    def test_enrichment(self):
+        prob = stats.Binomial()
+        genes = ["A1", "hsa:2", "x"]
+        res = self.snapshot.enriched_pathways(genes, prob=prob)
+        self.assertEqual(sorted(res), ["path:hsa00010", "path:hsa00020"])
+        self.assertEqual(res["path:hsa00010"][0], ["A1", "hsa:2"])
+        self.assertEqual(res["path:hsa00010"][2], 2)
+        self.assertAlmostEqual(res["path:hsa00010"][1],
+                               prob.p_value(2, 4, 2, 3))
+
+        res = self.snapshot.enriched_pathways(
+            genes, reference=["hsa:1", "hsa:2"], prob=prob)
+        self.assertEqual(res["path:hsa00020"], (["hsa:2"],
+                                                prob.p_value(1, 2, 1, 3), 1))
+
+    def test_save(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "organism_hsa.compiled")
+            self.snapshot.save(path, "release 1")
+            loaded = snapshot.OrganismSnapshot.load(path)
+            self.assertEqual(loaded.key, "release 1")
+            self.assertEqual(loaded.org_code, "hsa")
+            self.assertEqual(loaded.enriched_pathways(["hsa:3"]),
+                             self.snapshot.enriched_pathways(["hsa:3"]))
+        finally:
+            shutil.rmtree(tmpdir)
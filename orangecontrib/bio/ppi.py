@@ -14,8 +14,12 @@ import textwrap
 
 from StringIO import StringIO
 from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from itertools import count
 from operator import itemgetter
 
+import numpy
+
 from Orange.utils import serverfiles
 from Orange.utils import ConsoleProgressBar, wget
 
@@ -34,6 +38,43 @@ def mkdir_p(path, mode=0o777):
             raise
 
 
+#: Edges as parallel arrays of interacting ids and scores.
+Edges = namedtuple("Edges", ["id1", "id2", "score"])
+
+
+def _edges(rows):
+    """
+    Return :class:`Edges` from a sequence of `(id1, id2, score)` rows.
+    """
+    rows = list(rows)
+    id1 = numpy.empty(len(rows), dtype=object)
+    id2 = numpy.empty(len(rows), dtype=object)
+    id1[:] = [r[0] for r in rows]
+    id2[:] = [r[1] for r in rows]
+    score = numpy.array([r[2] for r in rows], dtype=float)
+    return Edges(id1, id2, score)
+
+
+_temp_table_names = count()
+
+
+@contextmanager
+def _temp_id_table(db, ids):
+    """
+    Create a temporary table with an indexed `id` column filled with
+    `ids` on a sqlite3 connection `db` and yield its name. The table is
+    dropped on exit.
+    """
+    name = "_ids_%i" % next(_temp_table_names)
+    db.execute("CREATE TEMP TABLE %s (id TEXT PRIMARY KEY)" % name)
+    try:
+        db.executemany("INSERT OR IGNORE INTO %s VALUES (?)" % name,
+                       ((id,) for id in ids))
+        yield name
+    finally:
+        db.execute("DROP TABLE temp.%s" % name)
+
+
 class PPIDatabase(object):
     """
     A general interface for protein-protein interaction database access.
@@ -92,6 +133,43 @@ class PPIDatabase(object):
         """
         raise NotImplementedError
 
+    def synonyms_many(self, ids):
+        """
+        Return a list of synonym lists for each of `ids`.
+        """
+        return [self.synonyms(id) for id in ids]
+
+    def edges_many(self, ids, min_score=None, internal=False):
+        """
+        Return :class:`Edges` of all edges of proteins in `ids`. Edges with
+        a score below `min_score` are skipped. If `internal` is True only
+        return the edges between the proteins in `ids`.
+        """
+        ids = set(ids)
+        edges = set(edge for id in ids for edge in self.edges(id))
+        return _edges(sorted(
+            (id1, id2, score) for id1, id2, score in edges
+            if (min_score is None or score >= min_score) and
+            (not internal or (id1 in ids and id2 in ids))))
+
+    def k_hop_neighbourhood(self, ids, k=1, min_score=None):
+        """
+        Return a sorted array of protein ids at most `k` interactions
+        (with a score of at least `min_score`) away from `ids`.
+        """
+        visited = set(ids)
+        frontier = visited
+        for _ in range(k):
+            if not frontier:
+                break
+            edges = self.edges_many(frontier, min_score=min_score)
+            reached = set(edges.id1) | set(edges.id2)
+            frontier = reached - visited
+            visited |= frontier
+        res = numpy.empty(len(visited), dtype=object)
+        res[:] = sorted(visited)
+        return res
+
     def all_edges_annotated(self, taxid=None):
         """
         Return a list of all edges annotated. If taxid is not None
@@ -122,15 +200,15 @@ class PPIDatabase(object):
         """
         from Orange import network
 
+        ids = list(ids)
         graph = network.Graph()
-        for id in ids:
-            graph.add_node(id, synonyms=",".join(self.synonyms(id)))
-
-        for id in ids:
-            edges = self.edges(id)
+        for id, synonyms in zip(ids, self.synonyms_many(ids)):
+            graph.add_node(id, synonyms=",".join(synonyms))
 
-            for id1, id2, score in edges:
-                graph.add_edge(id1, id2, weight=score)
+        edges = self.edges_many(ids)
+        for id1, id2, score in zip(edges.id1.tolist(), edges.id2.tolist(),
+                                   edges.score.tolist()):
+            graph.add_edge(id1, id2, weight=score)
 
         return graph
 
@@ -280,12 +358,35 @@ class BioGRID(PPIDatabase):
             (id,))
         rec = cur.fetchone()
         if rec:
-            synonyms = list(rec[:-1]) + \
-                       (rec[-1].split("|") if rec[-1] is not None else [])
-            return [s for s in synonyms if s is not None]
+            return self._synonyms(rec)
         else:
             return []
 
+    @staticmethod
+    def _synonyms(rec):
+        synonyms = list(rec[:-1]) + \
+                   (rec[-1].split("|") if rec[-1] is not None else [])
+        return [s for s in synonyms if s is not None]
+
+    def synonyms_many(self, ids):
+        """
+        Return a list of synonym lists for each of `ids` (with one query).
+        """
+        ids = list(ids)
+        with _temp_id_table(self.db, ids) as table:
+            cur = self.db.execute("""\
+                select biogrid_id_interactor,
+                       entrez_gene_interactor,
+                       systematic_name_interactor,
+                       official_symbol_interactor,
+                       synonyms_interactor
+                from {0} join proteins on
+                    {0}.id=biogrid_id_interactor
+                """.format(table))
+            synonyms = dict((rec[0], self._synonyms(rec[1:]))
+                            for rec in cur.fetchall())
+        return [synonyms.get(id, []) for id in ids]
+
     def all_edges(self, taxid=None):
         """
         Return a list of all edges. If taxid is not None return the
@@ -322,6 +423,44 @@ class BioGRID(PPIDatabase):
         """, (id, id))
         return cur.fetchall()
 
+    def edges_many(self, ids, min_score=None, internal=False):
+        """
+        Return :class:`Edges` of all interactions where any of `ids` is a
+        participant (or, if `internal` is True, both participants are in
+        `ids`). Interactions with a score below `min_score` are skipped.
+        Repeated interaction records are returned once (as in
+        :func:`PPIDatabase.edges_many`).
+        """
+        where = "where score>=?" if min_score is not None else ""
+        params = (min_score,) * 2 if min_score is not None else ()
+        with _temp_id_table(self.db, ids) as table:
+            if internal:
+                cur = self.db.execute("""\
+                    select distinct biogrid_id_interactor_a,
+                           biogrid_id_interactor_b, score
+                    from {0} as a join links on
+                        a.id=biogrid_id_interactor_a
+                    join {0} as b on b.id=biogrid_id_interactor_b
+                    {1}
+                    order by 1, 2, 3
+                    """.format(table, where), params[:1])
+            else:
+                cur = self.db.execute("""\
+                    select biogrid_id_interactor_a, biogrid_id_interactor_b,
+                           score
+                    from {0} join links on {0}.id=biogrid_id_interactor_a
+                    {1}
+                    union
+                    select biogrid_id_interactor_a, biogrid_id_interactor_b,
+                           score
+                    from {0} join links on {0}.id=biogrid_id_interactor_b
+                    where biogrid_id_interactor_a not in (select id from {0})
+                    {2}
+                    order by 1, 2, 3
+                    """.format(table, where, where.replace("where", "and")),
+                    params)
+            return _edges(cur.fetchall())
+
     def all_edges_annotated(self, taxid=None):
         """
         Return a list of all edges annotated. If taxid is not None
@@ -500,6 +639,77 @@ class BioGRID(PPIDatabase):
         """)
 
 
+class CSRAdjacency(namedtuple("CSRAdjacency",
+                              ["ids", "indptr", "indices", "scores",
+                               "channels"])):
+    """
+    Links of a PPI network as a CSR adjacency. Protein ids are interned
+    to indices into the sorted `ids` array; the neighbours of the i-th
+    protein are `indices[indptr[i]:indptr[i + 1]]` with link `scores`
+    (and, if not None, `channels` subscores (a 2D array) of the same
+    rows).
+    """
+    __slots__ = ()
+
+    def matrix(self, channel=None):
+        """
+        Return a `scipy.sparse.csr_matrix` of link scores (or of subscores
+        in the `channel`-th column of `channels`).
+        """
+        from scipy import sparse
+        if channel is not None and self.channels is None:
+            raise ValueError("The adjacency has no channel subscores "
+                             "(use STRINGDetailed)")
+        data = self.scores if channel is None else self.channels[:, channel]
+        n = len(self.ids)
+        return sparse.csr_matrix((data, self.indices, self.indptr),
+                                 shape=(n, n))
+
+    def save(self, filename):
+        """
+        Save the arrays into a compressed `.npz` file `filename`.
+        """
+        arrays = dict((name, value) for name, value in self._asdict().items()
+                      if value is not None)
+        with open(filename + ".tmp", "wb") as f:
+            numpy.savez_compressed(f, **arrays)
+        if os.name == "nt" and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename + ".tmp", filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the arrays saved with :func:`save`.
+        """
+        with numpy.load(filename) as npz:
+            return cls(*[npz[name] if name in npz.files else None
+                         for name in cls._fields])
+
+
+def links_csr(links, ids=()):
+    """
+    Return a :class:`CSRAdjacency` of a sequence of `(id1, id2, score)`
+    links (both directions must be included for a symmetric matrix).
+    Proteins in `ids` are included even if they have no links.
+    """
+    links = list(links)
+    names = numpy.array([l[0] for l in links] + [l[1] for l in links] +
+                        list(ids), dtype=str)
+    all_ids, inverse = numpy.unique(names, return_inverse=True)
+    n = len(links)
+    rows, cols = inverse[:n], inverse[n: 2 * n]
+    scores = numpy.array([l[2] for l in links], dtype=numpy.int16)
+    order = numpy.lexsort((cols, rows))
+    indptr = numpy.searchsorted(rows[order], numpy.arange(len(all_ids) + 1))
+    return CSRAdjacency(all_ids, indptr.astype(numpy.int64),
+                        cols[order].astype(numpy.int32), scores[order], None)
+
+
+def _csr_filename(dbfilename):
+    return os.path.splitext(dbfilename)[0] + ".npz"
+
+
 STRINGInteraction = namedtuple(
     "STRINGInteraciton",
     ["protein_id1",
@@ -540,6 +750,9 @@ class STRING(PPIDatabase):
         - `alias`: protein alias (text)
         - `source`: protein alias source (text)
 
+    The links are also stored as a CSR adjacency (see
+    :class:`CSRAdjacency`) in a `.npz` file next to the database.
+
     """
     DOMAIN = "PPI"
     FILENAME = "string.protein.{taxid}.sqlite"
@@ -633,6 +846,21 @@ class STRING(PPIDatabase):
         res = cur.fetchall()
         return [r[0] for r in res]
 
+    def synonyms_many(self, ids):
+        """
+        Return a list of synonym lists for each of `ids` (with one query).
+        """
+        ids = list(ids)
+        synonyms = defaultdict(list)
+        with _temp_id_table(self.db, ids) as table:
+            cur = self.db.execute("""\
+                select aliases.protein_id, alias
+                from {0} join aliases on {0}.id=aliases.protein_id
+                """.format(table))
+            for id, alias in cur.fetchall():
+                synonyms[id].append(alias)
+        return [synonyms.get(id, []) for id in ids]
+
     def synonyms_with_source(self, id):
         """
         Return a list of synonyms for primary `id` along with its
@@ -681,11 +909,44 @@ class STRING(PPIDatabase):
             """, (id,))
         return cur.fetchall()
 
+    def edges_many(self, ids, min_score=None, internal=False):
+        """
+        Return :class:`Edges` of all edges from proteins in `ids` (or, if
+        `internal` is True, the edges between them). Edges with a score
+        below `min_score` are skipped.
+        """
+        with _temp_id_table(self.db, ids) as table:
+            cur = self.db.execute("""\
+                select links.protein_id1, links.protein_id2, links.score
+                from {0} as a join links on a.id=links.protein_id1
+                {1}
+                {2}
+                """.format(
+                    table,
+                    "join {0} as b on b.id=links.protein_id2".format(table)
+                    if internal else "",
+                    "where links.score>=?" if min_score is not None else ""),
+                (min_score,) if min_score is not None else ())
+            return _edges(cur.fetchall())
+
     def all_edges_annotated(self, taxid=None):
-        res = []
-        for id in self.ids(taxid):
-            res.extend(self.edges_annotated(id))
-        return res
+        return self.edges_annotated_many(self.ids(taxid))
+
+    def edges_annotated_many(self, ids):
+        """
+        Return a list of annotated edges (:class:`STRINGInteraction`) of
+        all proteins in `ids`.
+        """
+        with _temp_id_table(self.db, ids) as table:
+            cur = self.db.execute("""\
+                select links.protein_id1, links.protein_id2, links.score,
+                       actions.action, actions.mode, actions.score
+                from {0} join links on {0}.id=links.protein_id1
+                left join actions on
+                       links.protein_id1=actions.protein_id1 and
+                       links.protein_id2=actions.protein_id2
+                """.format(table))
+            return map(STRINGInteraction._make, cur.fetchall())
 
     def edges_annotated(self, id):
         cur = self.db.execute("""\
@@ -713,6 +974,55 @@ class STRING(PPIDatabase):
             """, (name, taxid))
         return map(itemgetter(0), cur)
 
+    def csr_filename(self):
+        """
+        Return the filename of the `.npz` CSR adjacency stored next to
+        the database (None for in memory databases).
+        """
+        return _csr_filename(self.filename) if self.filename else None
+
+    def _csr_sources(self):
+        # Database files the CSR adjacency is built from.
+        return [self.filename]
+
+    def links_csr(self):
+        """
+        Return a :class:`CSRAdjacency` of all links (read with one query).
+        """
+        return self.db_csr(self.db)
+
+    @classmethod
+    def db_csr(cls, dbcon):
+        cur = dbcon.execute("SELECT protein_id1, protein_id2, score "
+                            "FROM links")
+        links = cur.fetchall()
+        ids = [r[0] for r in dbcon.execute("SELECT protein_id FROM proteins")]
+        return links_csr(links, ids)
+
+    def adjacency(self, channel=None):
+        """
+        Return a tuple of the sorted protein ids and a
+        `scipy.sparse.csr_matrix` of all link scores between them (or of
+        `channel` subscores for :class:`STRINGDetailed`).
+
+        The adjacency is read from a `.npz` file next to the database,
+        which is (re)built from the database if missing or outdated.
+        """
+        filename = self.csr_filename()
+        sources = self._csr_sources()
+        if filename is None or None in sources:
+            csr = self.links_csr()
+        elif os.path.exists(filename) and \
+                os.path.getmtime(filename) >= \
+                max(os.path.getmtime(source) for source in sources):
+            csr = CSRAdjacency.load(filename)
+        else:
+            csr = self.links_csr()
+            csr.save(filename)
+        if isinstance(channel, basestring):
+            channel = STRINGDetailedInteraction._fields[6:].index(channel)
+        return csr.ids, csr.matrix(channel)
+
     @classmethod
     def download_data(cls, version, taxids=None):
         """
@@ -868,6 +1178,10 @@ class STRING(PPIDatabase):
                 INSERT INTO version
                 VALUES (?, ?)""", (version, cls.VERSION))
 
+        print "Building the CSR adjacency"
+        cls.db_csr(con).save(_csr_filename(dbfilename))
+        con.close()
+
     @classmethod
     def clear_db(cls, dbcon):
         dbcon.executescript(textwrap.dedent("""
@@ -898,6 +1212,9 @@ class STRING(PPIDatabase):
             CREATE INDEX IF NOT EXISTS index_link_protein_id1
                 ON links (protein_id1);
 
+            CREATE INDEX IF NOT EXISTS index_link_protein_id2
+                ON links (protein_id2);
+
             CREATE INDEX IF NOT EXISTS index_action_protein_id1
                 ON actions (protein_id1);
 
@@ -984,6 +1301,7 @@ class STRINGDetailed(STRING):
             detailed_database = serverfiles.localpath_download(
                 "PPI", "string-protein-detailed.sqlite")
 
+        self.detailed_filename = detailed_database
         self.db_detailed = sqlite3.connect(detailed_database)
         self.db_detailed.execute("ATTACH DATABASE ? as string", (db_file,))
 
@@ -1008,6 +1326,60 @@ class STRINGDetailed(STRING):
             )
         return edges_nc
 
+    def csr_filename(self):
+        return _csr_filename(self.detailed_filename)
+
+    def _csr_sources(self):
+        return [self.filename, self.detailed_filename]
+
+    def links_csr(self):
+        """
+        Return a :class:`CSRAdjacency` of all links with channel subscores
+        (in the order of `STRINGDetailedInteraction` fields).
+        """
+        csr = STRING.links_csr(self)
+        n = len(csr.ids)
+        rows = numpy.repeat(numpy.arange(n), numpy.diff(csr.indptr))
+        keys = rows * n + csr.indices
+        channels = numpy.zeros((len(keys), 7), dtype=numpy.int16)
+
+        cur = self.db_detailed.execute("""
+            SELECT protein_id1, protein_id2,
+                   neighborhood, fusion, cooccurence, coexpression,
+                   experimental, database, textmining
+            FROM evidence
+            """)
+        evidence = cur.fetchall()
+        if evidence and len(keys):
+            id1 = numpy.array([r[0] for r in evidence], dtype=str)
+            id2 = numpy.array([r[1] for r in evidence], dtype=str)
+            i = numpy.searchsorted(csr.ids, id1).clip(0, n - 1)
+            j = numpy.searchsorted(csr.ids, id2).clip(0, n - 1)
+            known = (csr.ids[i] == id1) & (csr.ids[j] == id2)
+            pos = numpy.searchsorted(keys, i * n + j).clip(0, len(keys) - 1)
+            known &= keys[pos] == i * n + j
+            values = numpy.array([r[2:] for r in evidence],
+                                 dtype=numpy.int16)
+            channels[pos[known]] = values[known]
+        return csr._replace(channels=channels)
+
+    def edges_annotated_many(self, ids):
+        ids = list(ids)
+        edges = STRING.edges_annotated_many(self, ids)
+        with _temp_id_table(self.db_detailed, ids) as table:
+            cur = self.db_detailed.execute("""
+                SELECT protein_id1, protein_id2,
+                       neighborhood, fusion, cooccurence, coexpression,
+                       experimental, database, textmining
+                FROM {0} JOIN evidence ON {0}.id=evidence.protein_id1
+                """.format(table))
+            evidence = dict(((rec[0], rec[1]), rec[2:])
+                            for rec in cur.fetchall())
+        return [STRINGDetailedInteraction(*(tuple(edge) + tuple(
+                    evidence.get((edge.protein_id1, edge.protein_id2),
+                                 [0] * 7))))
+                for edge in edges]
+
     @classmethod
     def init_db(cls, version, taxid, cache_dir=None, dbfilename=None):
         if cache_dir is None:
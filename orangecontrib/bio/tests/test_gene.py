@@ -0,0 +1,164 @@
+import unittest
+import tempfile
+import shutil
+import os
+import cPickle
+
+from .. import gene
+
+ALIASES = [
+    set(["A1", "alpha", "ALPHA1"]),
+    set(["B2", "beta"]),
+    set(["C3", "Alpha"]),
+]
+
+
+class TestAliasIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index(self):
+        index = gene.AliasIndex.from_aliases(ALIASES, ignore_case=True)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.groups("ALPHA"), set([0, 2]))
+        self.assertEqual(index.groups("b2"), set([1]))
+        self.assertEqual(index.groups("gamma"), set())
+        self.assertEqual(list(index.aliases()), ALIASES)
+
+        path = os.path.join(self.tmpdir, "index.compiled")
+        index.save(path, "key")
+        loaded = gene.AliasIndex.load(path)
+        self.assertEqual(loaded.key, "key")
+        self.assertEqual(loaded.groups("alpha"), set([0, 2]))
+        self.assertEqual(gene.AliasIndex.load_cached(path, "other"), None)
+
+        index = gene.AliasIndex.from_aliases(ALIASES, ignore_case=False)
+        self.assertEqual(index.groups("Alpha"), set([2]))
+        self.assertEqual(index.groups("ALPHA"), set())
+
+    def test_matcher(self):
+        filename = os.path.join(self.tmpdir, "aliases")
+        with open(filename, "wb") as f:
+            cPickle.dump(None, f, -1)
+            cPickle.dump(ALIASES, f, -1)
+
+        for i in range(2):
+            matcher = gene.MatcherAliasesFile(filename)
+            matcher.set_targets(["a1", "beta", "C3"])
+            self.assertEqual(sorted(matcher.match("Alpha")), ["C3", "a1"])
+            self.assertEqual(matcher.umatch("B2"), "beta")
+            self.assertEqual(matcher.match("gamma"), [])
+        self.assertTrue(os.path.isdir(filename + ".ic.compiled"))
+
+
+class TestMatchMany(unittest.TestCase):
+    def test_match_many(self):
+        matcher = gene.matcher([gene.MatcherAliases(ALIASES)])
+        matcher.set_targets(["a1", "beta", "C3", "b2"])
+        genes = ["A1", "Alpha", "B2", "beta", "gamma"]
+
+        indptr, indices = matcher.match_many(genes)
+        targets = matcher.targets
+        matches = [sorted(targets[i] for i in indices[indptr[j]:indptr[j + 1]])
+                   for j in range(len(genes))]
+        self.assertEqual(matches, [sorted(matcher.match(g)) for g in genes])
+        self.assertEqual(matches[1], ["C3", "a1"])
+
+        self.assertEqual(list(matcher.umatch_many(genes)), [0, -1, 3, 1, -1])
+        self.assertEqual([targets[i] if i >= 0 else None
+                          for i in matcher.umatch_many(genes)],
+                         [matcher.umatch(g) for g in genes])
+        self.assertEqual(gene.umatch_names(matcher, genes),
+                         [matcher.umatch(g) for g in genes])
+
+    def test_umatch_names_fallback(self):
+        class FirstMatcher(object):
+            """ A matcher with only umatch. """
+            def umatch(self, name):
+                return name[0] if name != "gamma" else None
+
+        self.assertEqual(gene.umatch_names(FirstMatcher(), ["A1", "gamma"]),
+                         ["A", None])
+
+        class FirstMatch(gene.Match):
+            """ A Match without targets. """
+            def match(self, name):
+                return [name[0]] if name != "gamma" else []
+
+        match = FirstMatch()
+        self.assertEqual(gene.umatch_names(match, ["A1", "gamma"]),
+                         ["A", None])
+        # targets without some matches
+        match.targets = ["B"]
+        self.assertRaises(ValueError, match.match_many, ["A1"])
+        self.assertEqual(gene.umatch_names(match, ["A1", "B2", "gamma"]),
+                         ["A", "B", None])
+
+
+class NamedAliases(gene.MatcherAliases):
+    def __init__(self, name, aliases):
+        gene.MatcherAliases.__init__(self, aliases)
+        self.name = name
+
+    def filename(self):
+        return self.name
+
+    def create_aliases_version(self):
+        return "1"
+
+
+class TestJoinAliases(unittest.TestCase):
+    def assertSameGroups(self, groups1, groups2):
+        self.assertEqual(sorted(map(sorted, groups1)),
+                         sorted(map(sorted, groups2)))
+
+    def test_join(self):
+        ncbi = [set(["1", "abc"]), set(["2", "DEF"]), set(["3"])]
+        dicty = [set(["DDB1", "ABC", "def"]), set(["DDB2", "xyz"])]
+        joined = gene.join_aliases([ncbi, dicty], lower=True)
+        self.assertEqual(joined, [set(["1", "abc", "DDB1", "ABC", "def"]),
+                                  set(["2", "DEF", "DDB1", "ABC", "def"]),
+                                  set(["3"]), set(["DDB2", "xyz"])])
+        self.assertEqual(gene.join_aliases([dicty, ncbi], lower=True), joined)
+        self.assertSameGroups(joined, gene.join_sets_l([ncbi, dicty], lower=True))
+
+        joined = gene.join_aliases([ncbi, dicty], lower=False)
+        self.assertEqual(len(joined), 5)
+        self.assertSameGroups(joined, gene.join_sets_l([ncbi, dicty]))
+
+    def test_shared_synonyms(self):
+        ncbi = [set(["CDKN2A", "P16"]), set(["OTHER", "P16"]), set(["TP53"])]
+        dicty = [set(["P16", "DDB2"]), set(["TP53", "DDB3"])]
+        hgnc = [set(["cdkn2a", "ARF"]), set(["DDB3", "p53"])]
+        for lower in [False, True]:
+            sources = [ncbi, dicty, hgnc]
+            joined = gene.join_aliases(sources, lower=lower)
+            self.assertSameGroups(joined, gene.join_sets_l(sources, lower=lower))
+            self.assertSameGroups(gene.join_aliases(sources[1::-1], lower=lower),
+                                  gene.join_sets_l(sources[:2], lower=lower))
+
+        joined = gene.join_aliases([ncbi, dicty])
+        self.assertIn(set(["CDKN2A", "P16", "DDB2"]), joined)
+        self.assertIn(set(["OTHER", "P16", "DDB2"]), joined)
+        matcher = gene.matcher([gene.MatcherAliases(joined)])
+        matcher.set_targets(["CDKN2A", "OTHER", "TP53"])
+        self.assertEqual(matcher.umatch("CDKN2A"), "CDKN2A")
+        self.assertEqual(matcher.umatch("OTHER"), "OTHER")
+        self.assertEqual(matcher.umatch("P16"), None)
+
+    def test_joined_matcher_order(self):
+        a = NamedAliases("a", [set(["x", "p"])])
+        b = NamedAliases("b", [set(["x", "q"]), set(["p", "r"])])
+        c = NamedAliases("c", [set(["q", "r"])])
+        abc = gene.MatcherAliasesPickledJoined([a, b, c])
+        acb = gene.MatcherAliasesPickledJoined([a, c, b])
+        self.assertEqual(abc.filename(), acb.filename())
+        self.assertEqual(abc.create_aliases_version(),
+                         acb.create_aliases_version())
+        self.assertSameGroups(abc.create_aliases(), acb.create_aliases())
+        self.assertSameGroups(abc.create_aliases(),
+                              gene.join_sets_l([a.aliases, b.aliases,
+                                                c.aliases]))
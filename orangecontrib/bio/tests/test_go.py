@@ -0,0 +1,271 @@
+import unittest
+import tempfile
+import shutil
+import os
+from StringIO import StringIO
+
+import numpy
+
+from .. import go, gene
+
+OBO = """format-version: 1.2
+
+[Term]
+id: GO:0000001
+name: root
+namespace: biological_process
+
+[Term]
+id: GO:0000002
+name: a
+namespace: biological_process
+is_a: GO:0000001 ! root
+
+[Term]
+id: GO:0000003
+name: b
+namespace: biological_process
+alt_id: GO:0000033
+is_a: GO:0000001 ! root
+
+[Term]
+id: GO:0000004
+name: c
+namespace: biological_process
+is_a: GO:0000002 ! a
+is_a: GO:0000003 ! b
+
+"""
+
+ANNOTATIONS = [
+    ("G1", "GO:0000004", "IDA", "P"),
+    ("G2", "GO:0000002", "IEA", "P"),
+    ("G3", "GO:0000033", "IDA", "P"),
+    ("G4", "GO:0000001", "IDA", "F"),
+]
+
+
+class TestOntology(unittest.TestCase):
+    def setUp(self):
+        self.ontology = go.Ontology(StringIO(OBO))
+
+    def test_graph(self):
+        ontology = self.ontology
+        self.assertEqual(ontology.extract_super_graph(["GO:0000004"]),
+                         set(["GO:0000001", "GO:0000002", "GO:0000003",
+                              "GO:0000004"]))
+        self.assertEqual(ontology.extract_super_graph("GO:0000033"),
+                         set(["GO:0000001", "GO:0000033"]))
+        self.assertEqual(ontology.extract_sub_graph(["GO:0000002"]),
+                         set(["GO:0000002", "GO:0000004"]))
+        self.assertEqual(ontology.term_depth("GO:0000001"), 1)
+        self.assertEqual(ontology.term_depth("GO:0000004"), 3)
+
+        ontology.set_slims_subset(["GO:0000003"])
+        self.assertEqual(ontology.slims_for_term("GO:0000004"),
+                         set(["GO:0000003"]))
+        self.assertEqual(ontology.slims_for_term("GO:0000002"), set())
+
+    def test_closure_index(self):
+        closure = self.ontology.closure_index()
+        self.assertIs(closure, self.ontology.closure_index())
+        index = closure.term_index
+        positions, ancestors = closure.ancestor_pairs(
+            [index["GO:0000004"], index["GO:0000002"]])
+        self.assertEqual(
+            sorted((p, closure.term_ids[a])
+                   for p, a in zip(positions, ancestors)),
+            [(0, "GO:0000001"), (0, "GO:0000002"), (0, "GO:0000003"),
+             (1, "GO:0000001")])
+        self.assertEqual(
+            [closure.term_ids[i] for i in
+             closure.descendants([index["GO:0000001"]])],
+            ["GO:0000002", "GO:0000003", "GO:0000004"])
+
+
+    def test_cyclic_relations(self):
+        obo = OBO.replace(
+            "is_a: GO:0000001 ! root\n\n[Term]\nid: GO:0000003",
+            "is_a: GO:0000001 ! root\nrelationship: has_part GO:0000003\n"
+            "\n[Term]\nid: GO:0000003").replace(
+            "alt_id: GO:0000033\nis_a: GO:0000001 ! root",
+            "alt_id: GO:0000033\nrelationship: part_of GO:0000002")
+        obo = obo.replace("is_a: GO:0000002 ! a\n", "")
+        ontology = go.Ontology(StringIO(obo))
+        self.assertIn(("part_of", "GO:0000002"),
+                      ontology["GO:0000003"].related)
+        all_terms = set(["GO:0000001", "GO:0000002", "GO:0000003",
+                         "GO:0000004"])
+        self.assertEqual(ontology.extract_super_graph(["GO:0000004"]),
+                         all_terms)
+        self.assertEqual(ontology.extract_super_graph(["GO:0000003"]),
+                         all_terms - set(["GO:0000004"]))
+        self.assertEqual(ontology.extract_sub_graph(["GO:0000001"]),
+                         all_terms)
+        self.assertEqual(ontology.term_depth("GO:0000004"), 4)
+
+
+class TestOntologySnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_snapshot(self):
+        ontology = go.Ontology(StringIO(OBO))
+        path = os.path.join(self.tmpdir, "ontology.compiled")
+        go.OntologySnapshot.from_ontology(ontology).save(path, "key")
+        snapshot = go.OntologySnapshot.load(path)
+        self.assertEqual(snapshot.key, "key")
+
+        compiled = go.Ontology.from_snapshot(snapshot)
+        self.assertEqual(sorted(compiled), sorted(ontology))
+        for termid in ontology:
+            term, cterm = ontology[termid], compiled[termid]
+            self.assertEqual(repr(term), repr(cterm))
+            self.assertEqual(term.related, cterm.related)
+            self.assertEqual(term.related_to, cterm.related_to)
+        self.assertEqual(compiled["GO:0000033"].id, "GO:0000003")
+        self.assertEqual(compiled.extract_super_graph(["GO:0000004"]),
+                         ontology.extract_super_graph(["GO:0000004"]))
+
+
+def annotation(gene, term, evidence, aspect):
+    return go.AnnotationRecord(
+        "DB", gene, gene, "", term, "ref", evidence, "", aspect, gene, "",
+        "gene", "taxon:1", "20130101", "DB", "", "")
+
+
+class TestAnnotations(unittest.TestCase):
+    def setUp(self):
+        self.ontology = go.Ontology(StringIO(OBO))
+        self.annotations = go.Annotations()
+        self.annotations.ontology = self.ontology
+        self.annotations.extend([annotation(*a) for a in ANNOTATIONS])
+
+    def test_term_gene_index(self):
+        index = self.annotations.term_gene_index()
+        self.assertEqual(set(index.terms), set(self.ontology.terms))
+        self.assertEqual(index.term_genes("GO:0000001"),
+                         ["G1", "G2", "G3", "G4"])
+        self.assertEqual(index.term_genes("GO:0000003"), ["G1", "G3"])
+        self.assertEqual(index.term_genes("GO:0000004"), ["G1"])
+
+        counts = index.counts(index.mask(["G1", "G3", "Unknown"]))
+        self.assertEqual(counts[index.term_index["GO:0000002"]], 1)
+        self.assertEqual(counts[index.term_index["GO:0000003"]], 2)
+
+        index = self.annotations.term_gene_index(["IDA"], "P")
+        self.assertEqual(index.term_genes("GO:0000001"), ["G1", "G3"])
+        self.assertIs(index, self.annotations.term_gene_index(["IDA"], "P"))
+
+    def test_enriched_terms(self):
+        res = self.annotations.get_enriched_terms(
+            ["G1", "G3"], use_fdr=False)
+        self.assertEqual(set(res), set(self.ontology.terms))
+        genes, _, ref_count = res["GO:0000003"]
+        self.assertEqual(sorted(genes), ["G1", "G3"])
+        self.assertEqual(ref_count, 2)
+        genes, _, ref_count = res["GO:0000002"]
+        self.assertEqual(genes, ["G1"])
+        self.assertEqual(ref_count, 2)
+
+        res = self.annotations.get_enriched_terms(
+            ["G1", "G2"], reference=["G2", "G3"], evidence_codes=["IEA"],
+            use_fdr=False)
+        self.assertEqual(set(res), set(["GO:0000001", "GO:0000002"]))
+        self.assertEqual(res["GO:0000002"][0], ["G2"])
+        self.assertEqual(res["GO:0000002"][2], 1)
+
+    def test_gene_names_translator(self):
+        self.assertEqual(
+            self.annotations.get_gene_names_translator(["G1", "g2", "X"]),
+            {"G1": "G1"})
+        self.annotations.genematcher = gene.matcher([])
+        self.annotations.genematcher.set_targets(self.annotations.gene_names)
+        self.assertEqual(
+            self.annotations.get_gene_names_translator(["G1", "g2", "X"]),
+            {"G1": "G1", "G2": "g2"})
+
+        class UpperMatcher(object):
+            """ A matcher with only umatch. """
+            def umatch(self, gene):
+                return gene.upper() if gene.upper() != "X" else None
+
+        self.annotations.genematcher = UpperMatcher()
+        self.assertEqual(
+            self.annotations.get_gene_names_translator(["G1", "g2", "X"]),
+            {"G1": "G1", "G2": "g2"})
+
+    def test_enriched_terms_batch(self):
+        gene_lists = [["G1", "G3"], ["G2"], []]
+        batch = self.annotations.get_enriched_terms_batch(gene_lists)
+        self.assertEqual(batch.counts.shape, (3, len(batch.terms)))
+        for i, genes in enumerate(gene_lists):
+            res = self.annotations.get_enriched_terms(genes)
+            for j, term in enumerate(batch.terms):
+                if term in res:
+                    self.assertAlmostEqual(batch.fdr[i, j], res[term][1])
+                    self.assertEqual(batch.counts[i, j], len(res[term][0]))
+                    self.assertEqual(batch.ref_counts[j], res[term][2])
+                else:
+                    self.assertTrue(numpy.isnan(batch.p_values[i, j]))
+
+    def test_enriched_terms_batch_processes(self):
+        gene_lists = [["G1", "G3"], ["G2"], [], ["G4", "G1"]]
+        serial = self.annotations.get_enriched_terms_batch(gene_lists)
+        progress = []
+        pooled = self.annotations.get_enriched_terms_batch(
+            gene_lists, processes=2, progress_callback=progress.append)
+        self.assertEqual(pooled.terms, serial.terms)
+        numpy.testing.assert_array_equal(pooled.counts, serial.counts)
+        numpy.testing.assert_array_equal(pooled.ref_counts, serial.ref_counts)
+        numpy.testing.assert_array_equal(pooled.p_values, serial.p_values)
+        numpy.testing.assert_array_equal(pooled.fdr, serial.fdr)
+        self.assertTrue(progress)
+
+    def test_parse_filters(self):
+        lines = ["!gaf-version: 2.0"]
+        for i, (gene, term, evidence, aspect) in enumerate(ANNOTATIONS):
+            record = list(annotation(gene, term, evidence, aspect))
+            record[12] = "taxon:%i" % (9606 if i % 2 else 10090)
+            lines.append("\t".join(record))
+        record[3] = "NOT|contributes_to"
+        lines.append("\t".join(record))
+        gaf = "\n".join(lines) + "\n"
+
+        annotations = go.Annotations()
+        annotations.parse_file(StringIO(gaf))
+        self.assertEqual(annotations.header, "!gaf-version: 2.0\n")
+        self.assertEqual(annotations.gene_names, set(["G1", "G2", "G3", "G4"]))
+
+        annotations = go.Annotations()
+        annotations.parse_file(StringIO(gaf), exclude_evidence=["IEA"],
+                               aspect="P")
+        self.assertEqual(annotations.gene_names, set(["G1", "G3"]))
+
+        records = list(go.iter_annotations(
+            StringIO(gaf), evidence_codes=["IDA"], taxids=["9606"]))
+        self.assertEqual([r.gene_name for r in records], ["G4"])
+
+    def test_annotation_store(self):
+        store = go.AnnotationStore.from_records(self.annotations.annotations)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "annotations.compiled")
+            store.save(path)
+            compiled = go.Annotations(ontology=self.ontology)
+            compiled.set_store(go.AnnotationStore.load(path))
+
+            self.assertEqual(list(compiled), list(self.annotations))
+            self.assertEqual(compiled.gene_names,
+                             self.annotations.gene_names)
+            self.assertEqual(compiled.gene_annotations["G1"],
+                             self.annotations.gene_annotations["G1"])
+            self.assertEqual(compiled.term_anotations["GO:0000033"],
+                             self.annotations.term_anotations["GO:0000033"])
+            self.assertEqual(compiled.get_enriched_terms(["G1", "G3"]),
+                             self.annotations.get_enriched_terms(["G1", "G3"]))
+        finally:
+            shutil.rmtree(tmpdir)
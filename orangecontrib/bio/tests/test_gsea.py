@@ -0,0 +1,193 @@
+import unittest
+import random
+import operator
+import pickle
+import warnings
+
+import numpy
+
+try:
+    from .. import gsea
+except ImportError:
+    # gsea needs Orange 2
+    gsea = None
+
+
+def scalar_gsea(rankings, subsets, n):
+    """ The per gene set, per permutation computation of gseaR (with the
+    straightforward FDR) the vectorized version replaced.
+    """
+    def scores(r):
+        ordered = gsea.orderedPointersCorr(r)
+        rev = numpy.argsort(ordered)
+        return [gsea.enrichmentScoreRanked(s, r, ordered, rev2=rev)[0]
+                for s in subsets]
+
+    es = scores(rankings)
+    nulls = zip(*[scores(gsea.shuffleList(rankings, random.Random(2000 + i)))
+                  for i in range(n)])
+
+    results = []
+    for s, null in zip(es, nulls):
+        def normalize(v):
+            part = [a for a in null if (a >= 0) == (v >= 0)]
+            if v == 0 or not part or gsea.mean(part) == 0:
+                return 0.0
+            return v / gsea.mean(part) if v >= 0 else -v / gsea.mean(part)
+        results.append((s, normalize(s), gsea.gseapval(s, null),
+                        [normalize(v) for v in null]))
+
+    all_nes = [nes for _, nes, _, _ in results]
+    vals = [v for _, _, _, nulls in results for v in nulls]
+    significance = []
+    for s, nes, p, _ in results:
+        if nes >= 0:
+            op0, opn = operator.ge, operator.ge
+        else:
+            op0, opn = operator.lt, operator.le
+        all_pos = [a for a in vals if op0(a, 0)]
+        all_higher = [a for a in all_pos if opn(a, nes)]
+        nes_pos = [a for a in all_nes if op0(a, 0)]
+        nes_higher = [a for a in nes_pos if opn(a, nes)]
+        try:
+            fdr = (len(all_higher) / float(len(all_pos))) / \
+                (len(nes_higher) / float(len(nes_pos)))
+        except ZeroDivisionError:
+            fdr = 1000000000.0
+        significance.append((s, nes, p, fdr))
+    return significance
+
+
+def random_subsets(rand, ngenes):
+    return [rand.sample(range(ngenes), size)
+            for size in [0, 1, 2, 3, 5, 5, 8, 13, 20] if size < ngenes]
+
+
+def example_table(rand, nexamples, ngenes):
+    import Orange
+    domain = Orange.data.Domain(
+        [Orange.feature.Continuous("g%i" % i) for i in range(ngenes)],
+        Orange.feature.Discrete("class", values=["a", "b"]))
+    X = rand.normal(size=(nexamples, ngenes))
+    X[:nexamples // 2, :ngenes // 2] += 1.0
+    rows = [list(x) + ["a" if i < nexamples // 2 else "b"]
+            for i, x in enumerate(X)]
+    return Orange.data.Table(domain, rows)
+
+
+@unittest.skipIf(gsea is None, "Orange 2 is not available")
+class TestSubsetScorer(unittest.TestCase):
+    def test_enrichment_scores(self):
+        rand = random.Random(0)
+        rankings = numpy.random.RandomState(0).normal(size=(6, 40))
+        # ties are ordered as in orderedPointersCorr
+        rankings[3] = numpy.round(rankings[3])
+        rankings[4, :5] = 0.0
+        subsets = random_subsets(rand, 40)
+        scores = gsea.SubsetScorer(subsets, block_cells=30)(rankings)
+        self.assertEqual(scores.shape, (6, len(subsets)))
+        for r, ranking in zip(scores, rankings):
+            ordered = gsea.orderedPointersCorr(ranking)
+            for score, subset in zip(r, subsets):
+                self.assertAlmostEqual(
+                    score,
+                    gsea.enrichmentScoreRanked(subset, ranking, ordered)[0],
+                    places=12)
+
+    def test_gene_permutations(self):
+        rankings = numpy.arange(10.0)
+        permuted = gsea.GenePermutations(rankings)([2000, 2001])
+        for seed, row in zip([2000, 2001], permuted):
+            self.assertEqual(
+                list(row),
+                gsea.shuffleList(list(rankings), random.Random(seed)))
+
+
+@unittest.skipIf(gsea is None, "Orange 2 is not available")
+class TestGSEA(unittest.TestCase):
+    def setUp(self):
+        self.rankings = list(numpy.random.RandomState(1).normal(size=60))
+        self.subsets = random_subsets(random.Random(1), 60)
+
+    def assertSameResults(self, results, expected):
+        self.assertEqual(len(results), len(expected))
+        for res, exp in zip(results, expected):
+            for a, b in zip(res, exp):
+                self.assertAlmostEqual(a, b, places=10)
+
+    def test_gsea_ranked(self):
+        results = gsea.gseaR(self.rankings, self.subsets, 30)
+        self.assertSameResults(
+            results, scalar_gsea(self.rankings, self.subsets, 30))
+
+    def test_gsea_gene_permutations(self):
+        data = example_table(numpy.random.RandomState(2), 20, 12)
+        rankingf = gsea.rankingFromOrangeMeas(gsea.MA_signalToNoise())
+        subsets = random_subsets(random.Random(2), 12)
+        results = gsea.gseaE(data, subsets, n=20, permutation="genes")
+        self.assertSameResults(
+            results, scalar_gsea(rankingf(data), subsets, 20))
+
+    def test_signal_to_noise_permutations(self):
+        data = example_table(numpy.random.RandomState(3), 16, 10)
+        rankingf = gsea.rankingFromOrangeMeas(gsea.MA_signalToNoise())
+        s2n = gsea.SignalToNoisePermutations(data)
+        numpy.testing.assert_array_almost_equal(
+            s2n.rankings(s2n.codes)[0], rankingf(data))
+        seeds = gsea.permutationSeeds(5)
+        numpy.testing.assert_array_almost_equal(
+            s2n(seeds), gsea.ClassPermutations(data, rankingf)(seeds))
+
+        # the default (vectorized) ranking and an explicit rankingf give
+        # the same class permutation results
+        subsets = random_subsets(random.Random(3), 10)
+        self.assertSameResults(
+            gsea.gseaE(data, subsets, n=15),
+            gsea.gseaE(data, subsets, rankingf=rankingf, n=15))
+
+
+@unittest.skipIf(gsea is None, "Orange 2 is not available")
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.rankings = list(numpy.random.RandomState(4).normal(size=50))
+        self.subsets = random_subsets(random.Random(4), 50)
+
+    def run_gsea(self, n, **kwargs):
+        calls = []
+        results = gsea.gseaR(self.rankings, self.subsets, n,
+                             callback=lambda: calls.append(1), **kwargs)
+        return results, len(calls)
+
+    def test_processes(self):
+        n = 70  # more than one shard
+        serial, serial_calls = self.run_gsea(n)
+        pooled, pooled_calls = self.run_gsea(n, processes=2)
+        mapped, mapped_calls = self.run_gsea(n, mapf=map)
+        # bit-identical, not just close
+        self.assertEqual(pooled, serial)
+        self.assertEqual(mapped, serial)
+        self.assertEqual(serial_calls, n + 1)
+        self.assertEqual(pooled_calls, n + 1)
+        self.assertEqual(mapped_calls, n + 1)
+
+    def test_unpicklable_permutations(self):
+        scorer = gsea.SubsetScorer(self.subsets)
+        genes = gsea.GenePermutations(self.rankings)
+        seeds = gsea.permutationSeeds(40)
+        expected = gsea.nullEnrichmentScores(genes, scorer, seeds)
+        numpy.testing.assert_array_equal(
+            gsea.nullEnrichmentScores(genes, scorer, seeds, mapf=map),
+            expected)
+
+        permutations = lambda seeds: genes(seeds)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            nulls = gsea.nullEnrichmentScores(permutations, scorer, seeds,
+                                              mapf=map)
+        self.assertEqual(len(w), 1)
+        numpy.testing.assert_array_equal(nulls, expected)
+
+    def test_picklable_ranking(self):
+        rankingf = gsea.rankingFromOrangeMeas(gsea.MA_signalToNoise())
+        self.assertIsInstance(pickle.loads(pickle.dumps(rankingf)),
+                              gsea.MeasureRanking)
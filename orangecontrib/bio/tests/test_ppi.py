@@ -0,0 +1,200 @@
+import unittest
+import sqlite3
+import tempfile
+import shutil
+import os
+
+import numpy
+
+from .. import ppi
+
+# a - b - c - d,  a - c (low score), e isolated
+LINKS = [("9606.a", "9606.b", 900), ("9606.b", "9606.c", 800),
+         ("9606.c", "9606.d", 700), ("9606.a", "9606.c", 100)]
+
+ALIASES = [("9606.a", "A1"), ("9606.a", "alpha"), ("9606.b", "B1"),
+           ("9606.e", "E1")]
+
+
+def string_db():
+    con = sqlite3.connect(":memory:")
+    ppi.STRING.clear_db(con)
+    links = LINKS + [(p2, p1, score) for p1, p2, score in LINKS]
+    con.executemany("INSERT INTO links VALUES (?, ?, ?)", links)
+    con.executemany("INSERT INTO proteins VALUES (?, '9606')",
+                    [("9606." + p,) for p in "abcde"])
+    con.executemany("INSERT INTO actions VALUES (?, ?, 'binding', '', ?)",
+                    links[:1])
+    con.executemany("INSERT INTO aliases VALUES (?, ?, 'source')", ALIASES)
+    ppi.STRING.create_db_index(con)
+    return con
+
+
+def biogrid_db():
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE links (biogrid_id_interactor_a text, "
+                "biogrid_id_interactor_b text, score real)")
+    con.execute("CREATE TABLE proteins (biogrid_id_interactor text, "
+                "entrez_gene_interactor text, "
+                "systematic_name_interactor text, "
+                "official_symbol_interactor text, "
+                "synonyms_interactor text, organism_interactor text)")
+    # BioGRID has a row for each interaction record, so a repeated
+    # interaction is stored more than once
+    con.executemany("INSERT INTO links VALUES (?, ?, ?)", LINKS + LINKS[:2])
+    con.executemany("INSERT INTO proteins VALUES (?, ?, NULL, ?, ?, '9606')",
+                    [("9606.a", "1", "A1", "alpha|a"),
+                     ("9606.b", "2", "B1", None)])
+    db = ppi.BioGRID.__new__(ppi.BioGRID)
+    db.db = con
+    db.init_db_index()
+    return db
+
+
+def edge_set(edges):
+    return sorted(zip(edges.id1, edges.id2, edges.score))
+
+
+class TestBulkQueries(unittest.TestCase):
+    def setUp(self):
+        self.dbs = [ppi.STRING(database=string_db()), biogrid_db()]
+
+    def test_synonyms_many(self):
+        ids = ["9606.a", "9606.x", "9606.b"]
+        for db in self.dbs:
+            self.assertEqual(map(sorted, db.synonyms_many(ids)),
+                             [sorted(db.synonyms(id)) for id in ids])
+
+    def test_edges_many(self):
+        for db in self.dbs:
+            ids = ["9606.a", "9606.b"]
+            edges = db.edges_many(ids)
+            self.assertEqual(
+                edge_set(edges),
+                sorted(set(e for id in ids for e in db.edges(id))))
+            self.assertEqual(edge_set(edges), sorted(set(edge_set(edges))))
+            self.assertEqual(edges.score.dtype.kind, "f")
+
+            edges = db.edges_many(ids, min_score=500, internal=True)
+            self.assertEqual(set(frozenset([a, b]) for a, b, _ in
+                                 edge_set(edges)),
+                             set([frozenset(["9606.a", "9606.b"])]))
+            self.assertEqual(len(db.edges_many([]).id1), 0)
+
+    def test_k_hop_neighbourhood(self):
+        for db in self.dbs:
+            self.assertEqual(
+                list(db.k_hop_neighbourhood(["9606.a"], 1)),
+                ["9606.a", "9606.b", "9606.c"])
+            self.assertEqual(
+                list(db.k_hop_neighbourhood(["9606.a"], 1, min_score=500)),
+                ["9606.a", "9606.b"])
+            self.assertEqual(
+                list(db.k_hop_neighbourhood(["9606.a"], 3, min_score=500)),
+                ["9606.a", "9606.b", "9606.c", "9606.d"])
+
+    def test_edges_annotated_many(self):
+        db = self.dbs[0]
+        ids = db.ids("9606")
+        self.assertEqual(sorted(db.edges_annotated_many(ids)),
+                         sorted(e for id in ids
+                                for e in db.edges_annotated(id)))
+        self.assertEqual(len(db.all_edges_annotated("9606")), 8)
+
+
+class TestCSR(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_links_csr(self):
+        db = ppi.STRING(database=string_db())
+        csr = db.links_csr()
+        self.assertEqual(list(csr.ids), ["9606." + p for p in "abcde"])
+        links = [(csr.ids[i], csr.ids[j], s)
+                 for i in range(len(csr.ids))
+                 for j, s in zip(csr.indices[csr.indptr[i]:csr.indptr[i + 1]],
+                                 csr.scores[csr.indptr[i]:csr.indptr[i + 1]])]
+        self.assertEqual(sorted(links), sorted(db.all_edges("9606")))
+
+        filename = os.path.join(self.tmpdir, "links.npz")
+        csr.save(filename)
+        loaded = ppi.CSRAdjacency.load(filename)
+        self.assertIs(loaded.channels, None)
+        for a, b in zip(csr[:4], loaded[:4]):
+            numpy.testing.assert_array_equal(a, b)
+
+    def test_detailed_csr(self):
+        detailed = sqlite3.connect(":memory:")
+        detailed.execute("CREATE TABLE evidence (protein_id1, protein_id2, "
+                         "neighborhood, fusion, cooccurence, coexpression, "
+                         "experimental, database, textmining)")
+        detailed.execute("INSERT INTO evidence VALUES "
+                         "('9606.b', '9606.c', 1, 2, 3, 4, 5, 6, 7)")
+        db = ppi.STRINGDetailed.__new__(ppi.STRINGDetailed)
+        db.db, db.db_detailed = string_db(), detailed
+        csr = db.links_csr()
+        b, c = 1, 2
+        pos = csr.indptr[b] + list(
+            csr.indices[csr.indptr[b]:csr.indptr[b + 1]]).index(c)
+        self.assertEqual(list(csr.channels[pos]), range(1, 8))
+        self.assertEqual(csr.channels.sum(), sum(range(1, 8)))
+
+    def test_adjacency(self):
+        try:
+            import scipy.sparse
+        except ImportError:
+            self.skipTest("scipy is not available")
+        filename = os.path.join(self.tmpdir, "string.sqlite")
+        con = string_db()
+        with sqlite3.connect(filename) as dest:
+            dest.executescript("\n".join(con.iterdump()))
+        db = ppi.STRING(database=filename)
+        ids, matrix = db.adjacency()
+        self.assertTrue(os.path.exists(db.csr_filename()))
+        self.assertEqual(matrix.shape, (5, 5))
+        self.assertEqual(matrix[0, 1], 900)
+        self.assertEqual(matrix[1, 0], 900)
+        self.assertEqual(matrix.nnz, 8)
+        ids2, matrix2 = db.adjacency()
+        self.assertEqual((matrix != matrix2).nnz, 0)
+        # plain STRING has no channel subscores
+        self.assertRaises(ValueError, db.adjacency, "fusion")
+
+    def test_detailed_adjacency(self):
+        try:
+            import scipy.sparse
+        except ImportError:
+            self.skipTest("scipy is not available")
+        db = ppi.STRINGDetailed.__new__(ppi.STRINGDetailed)
+        db.db, db.filename = string_db(), None
+        db.detailed_filename = os.path.join(self.tmpdir, "detailed.sqlite")
+        db.db_detailed = sqlite3.connect(db.detailed_filename)
+        db.db_detailed.execute(
+            "CREATE TABLE evidence (protein_id1, protein_id2, neighborhood, "
+            "fusion, cooccurence, coexpression, experimental, database, "
+            "textmining)")
+        db.db_detailed.execute("INSERT INTO evidence VALUES "
+                               "('9606.a', '9606.b', 1, 2, 3, 4, 5, 6, 7)")
+        db.db_detailed.commit()
+        # the links database has no file; nothing is saved
+        ids, matrix = db.adjacency("fusion")
+        self.assertEqual(matrix[0, 1], 2)
+        self.assertFalse(os.path.exists(db.csr_filename()))
+
+        filename = os.path.join(self.tmpdir, "string.sqlite")
+        with sqlite3.connect(filename) as dest:
+            dest.executescript("\n".join(db.db.iterdump()))
+        db.filename = filename
+        db.adjacency()
+        self.assertTrue(os.path.exists(db.csr_filename()))
+
+        # an updated detailed database invalidates the saved adjacency
+        db.db_detailed.execute("UPDATE evidence SET fusion=9")
+        db.db_detailed.commit()
+        mtime = os.path.getmtime(db.csr_filename()) + 10
+        os.utime(db.detailed_filename, (mtime, mtime))
+        ids, matrix = db.adjacency("fusion")
+        self.assertEqual(matrix[0, 1], 9)
@@ -0,0 +1,243 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import os
+import gzip
+import hashlib
+import multiprocessing
+from StringIO import StringIO
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs
+
+from ..utils import serverfiles
+
+CONTENT = "".join("line %i\n" % i for i in range(20000))
+
+
+def gzipped(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode="wb")
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length))
+        command = self.path.rsplit("/", 1)[1]
+        self.server.requests.append((command, self.headers.get("Range")))
+        if command == "listdomains":
+            self._respond(200, "test")
+        elif command == "allinfo":
+            self._respond(200, "[[[[[".join(
+                name + "=====" + self._info(name)
+                for name in sorted(self.server.files)))
+            return
+        data, tags = self.server.files.get(form.get("filename", [""])[0],
+                                           (None, None))
+        if command == "info":
+            self._respond(200, self._info(form["filename"][0]))
+        elif command == "download":
+            start = 0
+            if self.headers.get("Range") and self.server.ranges:
+                start = int(self.headers["Range"][6:].rstrip("-"))
+            self._respond(206 if start else 200, data[start:])
+
+    do_GET = do_POST
+
+    def _info(self, filename):
+        data, tags = self.server.files[filename]
+        return "|||||".join([str(len(data)), self.server.datetime,
+                             "title", ";".join(tags)])
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # pooled keep-alive connections must not block the server loop
+    daemon_threads = True
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(("127.0.0.1", 0), StandInHandler)
+        self.server.requests = []
+        self.server.ranges = True
+        self.server.datetime = "2015-01-01 00:00:00.0"
+        self.server.files = {
+            "plain.txt": (CONTENT, ["#md5:" + hashlib.md5(CONTENT).hexdigest()]),
+            "packed.txt": (gzipped(CONTENT), ["#compression:gz"]),
+            "corrupt.txt": (CONTENT, ["#md5:0"]),
+        }
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.buffer_dir = serverfiles.environ.buffer_dir
+        serverfiles.environ.buffer_dir = self.tmpdir
+        serverfiles._index_cache.clear()
+        self.sf = serverfiles.ServerFiles(
+            server="127.0.0.1:%i/" % self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        serverfiles.environ.buffer_dir = self.buffer_dir
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, filename):
+        with open(serverfiles.localpath("test", filename)) as f:
+            return f.read()
+
+    def test_download(self):
+        progress = []
+        serverfiles.download("test", "plain.txt", serverfiles=self.sf,
+                             callback=lambda: progress.append(1))
+        self.assertEqual(self.read("plain.txt"), CONTENT)
+        self.assertEqual(len(progress), 101)
+        self.assertEqual(serverfiles.listfiles("test"), ["plain.txt"])
+        self.assertFalse(os.path.exists(
+            serverfiles.localpath("test", "plain.txt.part")))
+
+        serverfiles.download("test", "packed.txt", serverfiles=self.sf)
+        self.assertEqual(self.read("packed.txt"), CONTENT)
+
+        self.assertRaises(IOError, serverfiles.download, "test",
+                          "corrupt.txt", serverfiles=self.sf)
+        self.assertFalse(os.path.exists(
+            serverfiles.localpath("test", "corrupt.txt")))
+
+    def test_resume(self):
+        target = serverfiles.localpath("test", "plain.txt")
+        os.makedirs(os.path.dirname(target))
+        for ranges in [True, False]:
+            self.server.ranges = ranges
+            with open(target + ".part", "wb") as f:
+                f.write(CONTENT[:1000])
+            with open(target + ".part.version", "wt") as f:
+                f.write(serverfiles._file_version(
+                    self.sf.info("test", "plain.txt")))
+            del self.server.requests[:]
+            serverfiles.download("test", "plain.txt", serverfiles=self.sf)
+            self.assertEqual(self.read("plain.txt"), CONTENT)
+            self.assertIn(("download", "bytes=1000-"), self.server.requests)
+
+    def test_resume_changed(self):
+        target = serverfiles.localpath("test", "plain.txt")
+        os.makedirs(os.path.dirname(target))
+        with open(target + ".part", "wb") as f:
+            f.write(CONTENT[:1000])
+        # a partial download without a version is not resumed
+        serverfiles.download("test", "plain.txt", serverfiles=self.sf)
+        self.assertEqual(self.read("plain.txt"), CONTENT)
+        self.assertNotIn(("download", "bytes=1000-"), self.server.requests)
+
+        # interrupted download of an old version of the file
+        old = CONTENT.replace("line", "LINE")
+        info = serverfiles.info("test", "plain.txt")
+        with open(target + ".part", "wb") as f:
+            f.write(old[:1000])
+        with open(target + ".part.version", "wt") as f:
+            f.write(serverfiles._file_version(info))
+        self.server.datetime = "2016-01-01 00:00:00.0"
+        del self.server.requests[:]
+        self.sf.download("test", "plain.txt", target)
+        with open(target) as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertNotIn(("download", "bytes=1000-"), self.server.requests)
+        self.assertFalse(os.path.exists(target + ".part.version"))
+
+    def test_download_many(self):
+        done = []
+        serverfiles.download_many(
+            [("test", "plain.txt"), ("test", "packed.txt")],
+            serverfiles=self.sf, max_workers=2, callback=done.append)
+        self.assertEqual(sorted(done), [("test", "packed.txt"),
+                                        ("test", "plain.txt")])
+        self.assertEqual(self.read("packed.txt"), CONTENT)
+        self.assertEqual(self.read("plain.txt"), CONTENT)
+
+        done = []
+        del self.server.requests[:]
+        serverfiles.download_many(
+            [("test", "plain.txt"), ("test", "packed.txt")],
+            serverfiles=self.sf, max_workers=2, callback=done.append,
+            outdated_only=True)
+        self.assertEqual(done, [])
+        self.assertNotIn(("download", None), self.server.requests)
+
+    def test_server_index(self):
+        index = serverfiles.server_index(self.sf)
+        self.assertEqual(sorted(index), [("test", "corrupt.txt"),
+                                         ("test", "packed.txt"),
+                                         ("test", "plain.txt")])
+        self.assertEqual(index[("test", "plain.txt")]["size"],
+                         str(len(CONTENT)))
+        self.assertEqual(self.server.requests,
+                         [("listdomains", None), ("allinfo", None)])
+
+        del self.server.requests[:]
+        serverfiles._index_cache.clear()
+        self.assertEqual(serverfiles.server_index(self.sf), index)
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(self.sf.search(["plain"]), [("test", "plain.txt")])
+
+        serverfiles.download("test", "plain.txt", serverfiles=self.sf)
+        del self.server.requests[:]
+        self.assertFalse(serverfiles.needs_update("test", "plain.txt", self.sf))
+        self.assertTrue(serverfiles.needs_update("test", "packed.txt", self.sf))
+        self.assertEqual(self.server.requests, [])
+
+        self.server.datetime = "2016-01-01 00:00:00.0"
+        serverfiles.server_index(self.sf, refresh=True)
+        self.assertTrue(serverfiles.needs_update("test", "plain.txt", self.sf))
+        serverfiles.update("test", "plain.txt", self.sf)
+        self.assertFalse(serverfiles.needs_update("test", "plain.txt", self.sf))
+
+
+def try_lock(domain, filename):
+    try:
+        with serverfiles._lock_file(domain, filename):
+            pass
+    except Exception:
+        os._exit(1)
+    os._exit(0)
+
+
+@unittest.skipIf(serverfiles.fcntl is None, "fcntl is not available")
+class TestLock(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.buffer_dir = serverfiles.environ.buffer_dir
+        serverfiles.environ.buffer_dir = self.tmpdir
+
+    def tearDown(self):
+        serverfiles.environ.buffer_dir = self.buffer_dir
+        shutil.rmtree(self.tmpdir)
+
+    def try_lock(self):
+        p = multiprocessing.Process(target=try_lock, args=("test", "a.txt"))
+        p.start()
+        p.join()
+        return p.exitcode == 0
+
+    def test_lock(self):
+        with serverfiles._lock_file("test", "a.txt"):
+            self.assertFalse(self.try_lock())
+            flock = serverfiles._FileLock(serverfiles.localpath("test", "a.txt"))
+            self.assertFalse(flock.acquire(blocking=False))
+        self.assertTrue(self.try_lock())
+        self.assertEqual(serverfiles.listfiles("test"), [])
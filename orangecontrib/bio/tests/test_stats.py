@@ -0,0 +1,222 @@
+import unittest
+import itertools
+import tempfile
+import shutil
+import math
+import os
+
+import numpy
+
+from ..utils import stats
+
+
+def scalar_p_value(prob, k, N, m, n):
+    """ The scalar p-value computation the array version replaced. """
+    hi = min(n, m) if isinstance(prob, stats.Hypergeometric) else n
+    if hi - k + 1 <= k:
+        return sum(prob(i, N, m, n) for i in range(k, hi + 1))
+    value = 1.0 - sum(prob(i, N, m, n) for i in range(k))
+    if value < 1e-3:
+        return sum(prob(i, N, m, n) for i in range(k, hi + 1))
+    return value
+
+
+def scalar_fdr(p_values, dependent=False, m=None):
+    """ The list based FDR the array version replaced. """
+    order = sorted(range(len(p_values)), key=lambda i: p_values[i])
+    m = m or len(p_values)
+    if dependent:
+        m = m * sum(1.0 / i for i in range(1, m + 1))
+    fdrs = [p_values[i] * m / (j + 1.0) for j, i in enumerate(order)]
+    for j in reversed(range(len(fdrs) - 1)):
+        fdrs[j] = min(fdrs[j], fdrs[j + 1])
+    result = [None] * len(p_values)
+    for j, i in enumerate(order):
+        result[i] = fdrs[j]
+    return result
+
+
+def scalar_holm(p_values, m=None):
+    order = sorted(range(len(p_values)), key=lambda i: p_values[i])
+    m = m or len(p_values)
+    result, cmax = [None] * len(p_values), 0.0
+    for j, i in enumerate(order):
+        cmax = max(cmax, p_values[i] * (m - j))
+        result[i] = min(cmax, 1.0)
+    return result
+
+
+class TestPValues(unittest.TestCase):
+    def check(self, prob, cases):
+        k, N, m, n = map(numpy.array, zip(*cases))
+        p_values = prob.p_values(k, N, m, n)
+        for p, case in zip(p_values, cases):
+            expected = scalar_p_value(prob, *case)
+            self.assertAlmostEqual(p, expected, places=10, msg=str(case))
+            self.assertAlmostEqual(prob.p_value(*case), expected, places=10)
+
+    def cases(self):
+        cases = [(k, N, m, n) for N, m, n in [(20, 5, 8), (50, 10, 10),
+                                             (50, 49, 30), (1000, 30, 200)]
+                 for k in range(0, min(n, m) + 2)]
+        # edge cases: k = 0, k = n and n = N
+        cases += [(0, 10, 3, 4), (4, 10, 3, 4), (4, 10, 8, 4),
+                  (3, 10, 3, 10), (2, 10, 3, 10), (0, 10, 3, 10),
+                  (10, 10, 10, 10), (0, 10, 0, 5), (5, 10, 10, 5)]
+        return cases
+
+    def test_hypergeometric(self):
+        self.check(stats.Hypergeometric(), self.cases())
+
+    def test_binomial(self):
+        self.check(stats.Binomial(), self.cases())
+
+    def test_edge_values(self):
+        for prob in [stats.Hypergeometric(), stats.Binomial()]:
+            self.assertEqual(prob.p_value(0, 10, 3, 4), 1.0)
+            self.assertEqual(prob.p_value(4, 10, 10, 4), 1.0)
+            self.assertEqual(prob.p_value(1, 10, 0, 4), 0.0)
+        hyper = stats.Hypergeometric()
+        # drawing everything (n = N) gives exactly m positives
+        self.assertAlmostEqual(hyper.p_value(3, 10, 3, 10), 1.0)
+        self.assertEqual(hyper.p_value(4, 10, 3, 10), 0.0)
+
+    def test_broadcast(self):
+        prob = stats.Hypergeometric()
+        k = numpy.arange(5).reshape(5, 1)
+        p_values = prob.p_values(k, 50, numpy.array([5, 10, 20]), 10)
+        self.assertEqual(p_values.shape, (5, 3))
+        for i, j in itertools.product(range(5), range(3)):
+            self.assertAlmostEqual(p_values[i, j],
+                                   prob.p_value(i, 50, [5, 10, 20][j], 10))
+        self.assertEqual(prob.p_values([], [], [], []).shape, (0,))
+
+
+class TestCorrections(unittest.TestCase):
+    P = [0.04, 0.001, 0.3, 0.02, 0.04, 0.9, 0.0001, 0.5]
+
+    def corrections(self):
+        return [(stats.FDR, scalar_fdr),
+                (stats.BenjaminiYekutieli,
+                 lambda p, m=None: scalar_fdr(p, dependent=True, m=m)),
+                (stats.Holm, scalar_holm),
+                (stats.Bonferroni,
+                 lambda p, m=None: [min(v * (m or len(p)), 1.0) for v in p])]
+
+    def test_scalar_baseline(self):
+        for correct, baseline in self.corrections():
+            result = correct(self.P)
+            self.assertIsInstance(result, list)
+            numpy.testing.assert_array_almost_equal(result, baseline(self.P))
+            # sorted input, with and without ordered
+            ordered = sorted(self.P)
+            numpy.testing.assert_array_almost_equal(
+                correct(ordered), baseline(ordered))
+            if correct is not stats.Bonferroni:
+                numpy.testing.assert_array_almost_equal(
+                    correct(ordered, ordered=True), baseline(ordered))
+            self.assertEqual(correct([]), [])
+
+    def test_larger_m(self):
+        for correct, baseline in self.corrections():
+            numpy.testing.assert_array_almost_equal(
+                correct(self.P, m=20), baseline(self.P, m=20))
+
+    def test_inplace(self):
+        for correct, _ in self.corrections():
+            p = numpy.array(self.P)
+            expected = correct(self.P)
+            result = correct(p, inplace=True)
+            self.assertIs(result, p)
+            numpy.testing.assert_array_almost_equal(p, expected)
+
+            p = numpy.array(self.P)
+            result = correct(p)
+            self.assertIsInstance(result, numpy.ndarray)
+            self.assertIsNot(result, p)
+            numpy.testing.assert_array_equal(p, self.P)
+
+            # lists (and integer arrays) can not be changed in place
+            self.assertRaises(TypeError, correct, list(self.P), inplace=True)
+            self.assertRaises(TypeError, correct, numpy.array([0, 1]),
+                              inplace=True)
+
+    def test_bonferroni(self):
+        # p * m capped at 1 (not p / m)
+        numpy.testing.assert_array_almost_equal(
+            stats.Bonferroni([0.01, 0.2, 0.5]), [0.03, 0.6, 1.0])
+        numpy.testing.assert_array_almost_equal(
+            stats.Bonferroni([0.01, 0.2], m=10), [0.1, 1.0])
+
+    def test_by_equals_dependent_fdr(self):
+        numpy.testing.assert_array_equal(
+            stats.BenjaminiYekutieli(self.P), stats.FDR(self.P, dependent=True))
+
+
+class TestLogBin(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        stats.LogBin.set_cache_file(None)
+
+    def tearDown(self):
+        stats.LogBin.set_cache_file(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_lazy_growth(self):
+        self.assertEqual(stats.LogBin._max, 0)
+        prob = stats.Hypergeometric(max=10)
+        self.assertTrue(10 <= stats.LogBin._max < 1000)
+        prob.p_value(3, 2000, 10, 20)
+        size = stats.LogBin._max
+        self.assertTrue(size > 2000)
+        self.assertEqual(len(stats.LogBin._lookup), size)
+        prob.p_value(3, size + 1, 10, 20)
+        # grows at least geometrically
+        self.assertTrue(stats.LogBin._max >= 2 * size)
+
+    def test_lgamma(self):
+        prob = stats.Binomial(max=3000)
+        lookup = stats.LogBin._lookup
+        for i in [0, 1, 2, 10, 171, 1000, 2999]:
+            self.assertAlmostEqual(lookup[i], math.lgamma(i + 1), places=7)
+        self.assertAlmostEqual(prob._logbin(2000, 700),
+                               math.lgamma(2001) - math.lgamma(1301) -
+                               math.lgamma(701), places=7)
+
+    def test_cache_file(self):
+        filename = os.path.join(self.tmpdir, "logfactorial.npy")
+        stats.LogBin.set_cache_file(filename)
+        stats.LogBin(max=500)
+        self.assertTrue(os.path.exists(filename))
+        self.assertIsInstance(stats.LogBin._lookup, numpy.memmap)
+        saved = numpy.array(stats.LogBin._lookup)
+
+        # a new process (simulated by a reset) maps the saved table
+        stats.LogBin.set_cache_file(filename)
+        stats.LogBin(max=100)
+        self.assertIsInstance(stats.LogBin._lookup, numpy.memmap)
+        numpy.testing.assert_array_equal(stats.LogBin._lookup, saved)
+        self.assertEqual(stats.LogBin._max, len(saved))
+
+        # a larger table replaces the file
+        stats.LogBin(max=5000)
+        self.assertTrue(len(numpy.load(filename, mmap_mode="r")) >= 5000)
+        numpy.testing.assert_array_almost_equal(
+            stats.LogBin._lookup[:len(saved)], saved)
+
+
+class TestHarmonic(unittest.TestCase):
+    def test_harmonic(self):
+        table = stats._harmonic_table
+        stats._harmonic_table = None
+        try:
+            self.assertAlmostEqual(stats._harmonic(1), 1.0)
+            self.assertIsNot(stats._harmonic_table, None)
+            self.assertAlmostEqual(stats._harmonic(10),
+                                   sum(1.0 / i for i in range(1, 11)))
+            m = 200000
+            self.assertAlmostEqual(stats._harmonic(m),
+                                   sum(1.0 / i for i in range(1, m + 1)),
+                                   delta=5e-6)
+        finally:
+            stats._harmonic_table = table
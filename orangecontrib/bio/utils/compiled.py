@@ -0,0 +1,132 @@
+"""
+Compiled (memory mapped) data
+=============================
+
+Helpers for data compiled into numpy arrays (for instance ontology
+snapshots, annotation stores, alias indices and KEGG snapshots). A
+compiled object is saved as a directory of `.npy` files (one for each
+name in its `_ARRAYS`) with a pickled `meta.pck` dictionary, which
+includes its class `version`. The arrays are memory mapped on load.
+
+
+Sparse relations (term ancestors, gene pathways, alias groups) are
+stored as CSR `(indptr, indices)` arrays: the entries of row `i` are
+`indices[indptr[i]:indptr[i + 1]]`.
+
+"""
+from __future__ import absolute_import
+
+import os
+import shutil
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy
+
+
+def file_key(filename):
+    """
+    Return a string identifying the version of (the contents of) a file.
+    """
+    stat = os.stat(filename)
+    return "%i.%i" % (stat.st_size, stat.st_mtime)
+
+
+def save_arrays(path, compiled, meta):
+    """
+    Save the `compiled._ARRAYS` arrays of `compiled` and a `meta`
+    dictionary (with `compiled.version`) into a directory `path`. The
+    directory is written under a temporary name and then renamed into
+    place.
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name in compiled._ARRAYS:
+        numpy.save(os.path.join(tmp, name + ".npy"), getattr(compiled, name))
+    meta = dict(meta, version=compiled.version)
+    with open(os.path.join(tmp, "meta.pck"), "wb") as f:
+        pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another process saved it first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_arrays(path, cls, mmap_mode="r"):
+    """
+    Load the arrays and the meta dictionary saved by :func:`save_arrays`
+    (the arrays are memory mapped). Raise :class:`ValueError` if they
+    were saved by a different `cls.version`.
+    """
+    with open(os.path.join(path, "meta.pck"), "rb") as f:
+        meta = pickle.load(f)
+    if meta.get("version") != cls.version:
+        raise ValueError("Incompatible %s version" % cls.__name__)
+    arrays = dict((name, numpy.load(os.path.join(path, name + ".npy"),
+                                    mmap_mode=mmap_mode))
+                  for name in cls._ARRAYS)
+    return arrays, meta
+
+
+def csr_from_pairs(rows, cols, n):
+    """
+    Return `(indptr, indices)` CSR arrays of a sparse `n` row matrix
+    with nonzero `(rows, cols)` (in the order of `cols` within a row).
+    """
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    order = numpy.argsort(rows, kind="mergesort")
+    indptr = numpy.searchsorted(rows[order], numpy.arange(n + 1))
+    indices = numpy.asarray(cols, dtype=numpy.int32)[order]
+    return indptr.astype(numpy.int64), indices
+
+
+def csr_from_lists(lists, dtype=numpy.int32):
+    """
+    Return `(indptr, indices)` CSR arrays with the rows in a list of lists
+    of integers.
+    """
+    indptr = numpy.cumsum([0] + [len(l) for l in lists]).astype(numpy.int64)
+    indices = numpy.fromiter((i for l in lists for i in l), dtype=dtype,
+                             count=indptr[-1])
+    return indptr, indices
+
+
+def csr_unique(n, rows, cols):
+    """
+    Like :func:`csr_from_pairs`, but with sorted unique columns in each
+    row.
+    """
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    cols = numpy.asarray(cols, dtype=numpy.int64)
+    width = cols.max() + 1 if len(cols) else 1
+    pairs = numpy.unique(rows * width + cols)
+    rows, cols = divmod(pairs, width)
+    return numpy.searchsorted(rows, numpy.arange(n + 1)), cols.astype(int)
+
+
+def csr_gather(indptr, indices, rows):
+    """
+    Return `(positions, values)`: the concatenated `indices` of CSR
+    `rows` and the position in `rows` each of them comes from.
+    """
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    positions = numpy.repeat(numpy.arange(len(rows)), counts)
+    offsets = numpy.arange(counts.sum()) - \
+        numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return positions, numpy.asarray(indices)[numpy.repeat(starts, counts) +
+                                             offsets]
+
+
+#: Exceptions raised when loading missing, broken or outdated data.
+LOAD_ERRORS = (IOError, OSError, ValueError, EOFError,
+               pickle.UnpicklingError)
@@ -54,6 +54,8 @@ contain title, tags, size and date and time of the file.
 
 .. autofunction:: needs_update
 
+.. autofunction:: server_index
+
 .. autofunction:: remove
 
 .. autofunction:: remove_domain
@@ -136,12 +138,33 @@ import shutil
 import tarfile
 import gzip
 import bz2
+import zlib
 import glob
 import datetime
+import _strptime  # datetime.strptime is not thread safe on first import
 import tempfile
+import hashlib
+import errno
+import pickle
+
+from multiprocessing.pool import ThreadPool
 
 import six
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+#: Read size of downloads.
+_CHUNK_SIZE = 2 ** 16
+
+#: Max. number of pooled connections per host of a ServerFiles instance.
+_POOL_SIZE = 16
+
+#: Seconds for which the locally cached server index is used.
+INDEX_TTL = 60 * 60
+
 #defserver = "localhost:9999/"
 defserver = "asterix.fri.uni-lj.si/orngServerFiles/"
 
@@ -164,9 +187,10 @@ def _open_file_info(fname): #no outer usage
     return info
 
 def _save_file_info(fname, info): #no outer usage
-    f = open(fname, 'wt')
+    f = open(fname + '.tmp', 'wt')
     f.write('\n'.join([info['size'], info['datetime'], info['title'], ';'.join(info['tags'])]))
     f.close()
+    _replace(fname + '.tmp', fname)
 
 def _parseList(fl):
     return fl.split("|||||")
@@ -233,6 +257,8 @@ class ServerFiles(object):
         self.password = password
         self.access_code = access_code
         self.searchinfo = None
+        self._requests_session = None
+        self._session_lock = threading.Lock()
 
     def upload(self, domain, filename, file, title="", tags=[]):
         """ Uploads a file "file" to the domain where it is saved with filename
@@ -286,52 +312,138 @@ class ServerFiles(object):
         """List all domains on repository."""
         return _parseList(self._open('listdomains', {}))
 
-    def download(self, domain, filename, target, callback=None):
+    def download(self, domain, filename, target, callback=None,
+                 resume=True, decompress=None, md5=None, info=None):
         """
         Downloads file from the repository to a given target name. Callback
         can be a function without arguments. It will be called once for each
         downloaded percent of file: 100 times for the whole file.
+
+        The file is streamed into `target + ".part"`, which is renamed to
+        `target` when complete. If `resume` is True and a partial download
+        exists only the rest of the file is requested (with an HTTP range
+        request). A partial download is only resumed if the server file
+        did not change since (its date and size, taken from `info` or
+        requested from the server, are stored in `target + ".part.version"`).
+        With `decompress` ("gz" or "bz2") the file is decompressed
+        while downloading (a partial file can not be resumed then). The
+        download size is checked against the reported content length and,
+        if given, its (compressed) `md5` hex digest.
         """
         _create_path_for_file(target)
-
-        fdown = self.downloadFH(domain, filename)
-        size = int(fdown.getheader('content-length'))
-
-        f = tempfile.TemporaryFile()
- 
-        chunksize = 1024*8
-        lastchunkreport= 0.0001
-
-        readb = 0
-        # in case size == 0 skip the loop
-        while size > 0:
-            buf = fdown.read(chunksize)
-            readb += len(buf)
-
-            while float(readb) / size > lastchunkreport+0.01:
-                #print float(readb)/size, lastchunkreport + 0.01, float(readb)/size - lastchunkreport 
-                lastchunkreport += 0.01
-                if callback:
-                    callback()
-            if not buf:
-                break
-            f.write(buf)
-
-        fdown.close()
-        f.seek(0)
-
-        shutil.copyfileobj(f, open(target, "wb"))
+        part = target + ".part"
+        part_info = part + ".version"
+
+        offset = 0
+        version = None
+        if resume and decompress is None:
+            if os.path.exists(part):
+                if info is None:
+                    info = self.info(domain, filename)
+                version = _file_version(info)
+                try:
+                    with open(part_info, "rt") as f:
+                        part_version = f.read()
+                except IOError:
+                    part_version = None
+                if part_version == version:
+                    offset = os.path.getsize(part)
+            elif info is not None:
+                version = _file_version(info)
+        headers = {"Range": "bytes=%i-" % offset} if offset else None
+
+        fdown = self._handle('download', {'domain': domain, 'filename': filename},
+                             raw=True, headers=headers)
+        if offset and fdown.status != 206:
+            # the server does not support ranges; start from the beginning
+            offset = 0
+        length = fdown.getheader('content-length')
+        size = offset + int(length) if length is not None else None
+
+        digest = hashlib.md5() if md5 else None
+        if digest is not None and offset:
+            with open(part, "rb") as f:
+                for buf in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                    digest.update(buf)
+
+        out = open(part, "ab" if offset else "wb")
+        if not offset:
+            if version is not None:
+                with open(part_info, "wt") as f:
+                    f.write(version)
+            elif os.path.exists(part_info):
+                os.remove(part_info)
+        if decompress:
+            out = _DecompressingWriter(out, decompress)
+
+        readb = offset
+        reported = 0
+        try:
+            while True:
+                buf = fdown.read(_CHUNK_SIZE)
+                if not buf:
+                    break
+                out.write(buf)
+                if digest is not None:
+                    digest.update(buf)
+                readb += len(buf)
+                if callback and size:
+                    percent = min(100 * readb // size, 100)
+                    while reported < percent:
+                        reported += 1
+                        callback()
+        finally:
+            fdown.close()
+            out.close()
+
+        if size is not None and readb != size:
+            if decompress:
+                _remove_part(part)
+            raise IOError("Incomplete download of %s/%s (%i of %i bytes)" %
+                          (domain, filename, readb, size))
+        if digest is not None and digest.hexdigest() != md5:
+            _remove_part(part)
+            raise IOError("Checksum mismatch for %s/%s" % (domain, filename))
+
+        _replace(part, target)
+        if os.path.exists(part_info):
+            os.remove(part_info)
 
         if callback:
+            while reported < 100:
+                reported += 1
+                callback()
             callback()
 
     def _searchinfo(self):
-        domains = self.listdomains()
+        return server_index(self)
+
+    def allinfo_many(self, domains=None, max_workers=4):
+        """
+        Return a dictionary with `(domain, filename)` keys and file infos
+        of all accessible files in `domains` (all domains by default).
+        Domains are queried concurrently by up to `max_workers` threads.
+        """
+        if domains is None:
+            domains = [d for d in self.listdomains() if d]
+        domains = list(domains)
+
+        def fetch(domain):
+            return domain, self.allinfo(domain)
+
+        if max_workers > 1 and len(domains) > 1:
+            pool = ThreadPool(min(max_workers, len(domains)))
+            try:
+                results = pool.map(fetch, domains)
+            finally:
+                pool.terminate()
+        else:
+            results = map(fetch, domains)
+
         infos = {}
-        for dom in domains:
-            dominfo = self.allinfo(dom)
-            for a,b in dominfo.items():
-                infos[(dom, a)] = b
+        for domain, dominfo in results:
+            for filename, info in dominfo.items():
+                infos[(domain, filename)] = info
         return infos
 
     def search(self, sstrings, **kwargs):
@@ -381,30 +493,46 @@ class ServerFiles(object):
         else:
             return False
 
-    def _server_request(self, root, command, data, files, repeat=2, raw=False):
-        import requests
-        req = requests.Session()
-        a = requests.adapters.HTTPAdapter(max_retries=repeat)
-        req.mount('https://', a)
-        req.mount('http://', a)
+    def _session(self, repeat=2):
+        """
+        Return a `requests.Session` shared by all requests of this instance
+        (so connections are pooled and reused).
+        """
+        with self._session_lock:
+            if self._requests_session is None:
+                import requests
+                req = requests.Session()
+                a = requests.adapters.HTTPAdapter(
+                    max_retries=repeat, pool_maxsize=_POOL_SIZE)
+                req.mount('https://', a)
+                req.mount('http://', a)
+                self._requests_session = req
+            return self._requests_session
+
+    def _server_request(self, root, command, data, files, repeat=2, raw=False,
+                        headers=None):
+        req = self._session(repeat)
 
         auth = None
         if self._authen():
             auth = (self.username, self.password)
 
         if data:
-            ans = req.post(root+command, data=data, files=files, auth=auth, verify=False, timeout=timeout, stream=True)
+            ans = req.post(root+command, data=data, files=files, auth=auth, verify=False, timeout=timeout, stream=True,
+                           headers=headers)
         else:
-            ans = req.get(root+command, auth=auth, verify=False, timeout=timeout, stream=True)
+            ans = req.get(root+command, auth=auth, verify=False, timeout=timeout, stream=True,
+                          headers=headers)
 
         return str(ans.text) if not raw else ans.raw
     
-    def _handle(self, command, data, files=None, raw=False):
+    def _handle(self, command, data, files=None, raw=False, headers=None):
         data2 = self._addAccessCode(data)
         addr = self.publicroot
         if self._authen():
             addr = self.secureroot
-        return self._server_request(addr, command, data, files, raw=raw)
+        return self._server_request(addr, command, data, files, raw=raw,
+                                    headers=headers)
 
     def _open(self, command, data, files=None):
         return self._handle(command, data, files)
@@ -416,6 +544,65 @@ class ServerFiles(object):
         return data
 
 
+class _DecompressingWriter(object):
+    """
+    A file like writer decompressing "gz" or "bz2" data written to it
+    into an underlying file `f`.
+    """
+    def __init__(self, f, compression):
+        if compression not in ("gz", "bz2"):
+            raise ValueError("Unknown compression %r" % compression)
+        self.f = f
+        self.compression = compression
+        self._decompressor = self._new_decompressor()
+
+    def _new_decompressor(self):
+        if self.compression == "gz":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            return bz2.BZ2Decompressor()
+
+    def write(self, data):
+        while data:
+            self.f.write(self._decompressor.decompress(data))
+            # concatenated streams (e.g. multi member gzip files)
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = self._new_decompressor()
+
+    def close(self):
+        if self.compression == "gz":
+            self.f.write(self._decompressor.flush())
+        self.f.close()
+
+
+def _file_version(info):
+    """
+    Return a string identifying the version of a server file from its
+    `info` dictionary.
+    """
+    return "%s|%s" % (info["datetime"], info["size"])
+
+
+def _remove_part(part):
+    """
+    Remove a partial download `part` and its info file.
+    """
+    for path in [part, part + ".version"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _replace(src, dst):
+    """
+    Rename `src` to `dst`, replacing `dst` if it exists (atomically
+    where the platform allows it).
+    """
+    if os.name == "nt" and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
 def _keyed_lock(lock_constructor=threading.Lock):
     lock = threading.Lock()
     locks = {}
@@ -468,16 +655,60 @@ class _Lock(object):
 _get_lock = _keyed_lock(_Lock)
 
 
+class _FileLock(object):
+    """
+    An exclusive inter-process lock for `path` (an `fcntl.flock` on a
+    `path + ".lock"` file). Where `fcntl` is not available (Windows) the
+    lock always succeeds.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        if fcntl is None:
+            return True
+        _create_path_for_file(self.path)
+        f = open(self.path + ".lock", "a")
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f.fileno(), flags)
+        except IOError as ex:
+            f.close()
+            if ex.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            f, self._file = self._file, None
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            f.close()
+
+
 @contextmanager
 def _lock_file(domain, filename, blocking=False):
+    """
+    Lock the local file `filename` in `domain` for this thread and
+    (with a lock file next to it) for other processes sharing the
+    local repository.
+    """
     path = localpath(domain, filename)
     path = os.path.normpath(os.path.realpath(path))
 #     log.debug("locking: %s", path)
     lock = _get_lock(path)
     if lock.acquire(blocking):
-#         log.debug("got lock on: %s", path)
+        flock = _FileLock(path)
         try:
-            yield
+            if not flock.acquire(blocking):
+                raise Exception("Could not acquire lock")
+#             log.debug("got lock on: %s", path)
+            try:
+                yield
+            finally:
+                flock.release()
         finally:
             lock.release()
 #             log.debug("Released lock on: %s",  path)
@@ -501,7 +732,11 @@ def download(domain, filename, serverfiles=None, callback=None,
     To download files as an authenticated user you should also pass an
     instance of ServerFiles class. Callback can be a function without
     arguments. It will be called once for each downloaded percent of
-    file: 100 times for the whole file."""
+    file: 100 times for the whole file.
+
+    Files with "gz" or "bz2" compression are decompressed while they are
+    downloaded, interrupted downloads of other files are resumed, and a
+    "#md5:<hexdigest>" tag, if present, is verified."""
 
     if not serverfiles:
         serverfiles = ServerFiles()
@@ -509,41 +744,97 @@ def download(domain, filename, serverfiles=None, callback=None,
     info = serverfiles.info(domain, filename)
     specialtags = dict([tag.split(":") for tag in info["tags"] if tag.startswith("#") and ":" in tag])
     extract = extract and ("#uncompressed" in specialtags or "#compression" in specialtags)
+    compression = specialtags.get("#compression")
     target = localpath(domain, filename)
     if ConsoleProgressBar:
         callback = DownloadProgress(filename, int(info["size"])) if verbose and not callback else callback    
-    serverfiles.download(domain, filename, target + ".tmp" if extract else target, callback=callback)
-    
+
+    md5 = specialtags.get("#md5")
+    unpack_files = extract and compression in ["tar.gz", "tar.bz2"] and \
+        bool(specialtags.get("#files"))
+    unpack_dir = extract and not unpack_files and filename.endswith(".tar.gz")
+
+    if unpack_files or unpack_dir:
+        serverfiles.download(domain, filename, target + ".tmp",
+                             callback=callback, md5=md5, info=info)
+        f = tarfile.open(target + ".tmp")
+        try:
+            if unpack_files:
+                f.extractall(localpath(domain))
+            else:
+                # extract next to the target and move it into place
+                tmpdir = tempfile.mkdtemp(dir=localpath(domain))
+                try:
+                    f.extractall(tmpdir)
+                    if os.path.isdir(target):
+                        shutil.rmtree(target)
+                    os.rename(tmpdir, target)
+                except Exception:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                    raise
+        finally:
+            f.close()
+        if unpack_files:
+            _replace(target + ".tmp", target)
+        else:
+            os.remove(target + ".tmp")
+    elif extract and compression in ["gz", "bz2"]:
+        # decompress while downloading
+        serverfiles.download(domain, filename, target, callback=callback,
+                             decompress=compression, md5=md5, info=info)
+    else:
+        serverfiles.download(domain, filename, target, callback=callback,
+                             md5=md5, info=info)
+
     #file saved, now save info file
 
     _save_file_info(target + '.info', info)
-    
-    if extract:
-        if specialtags.get("#compression") in ["tar.gz", "tar.bz2"] and \
-                specialtags.get("#files"):
-            f = tarfile.open(target + ".tmp")
-            f.extractall(localpath(domain))
-            shutil.copyfile(target + ".tmp", target)
-        elif filename.endswith(".tar.gz"):
-            f = tarfile.open(target + ".tmp")
-            try:
-                os.mkdir(target)
-            except Exception:
-                pass
-            f.extractall(target)
-        elif specialtags.get("#compression") == "gz":
-            f = gzip.open(target + ".tmp")
-            shutil.copyfileobj(f, open(target, "wb"))
-        elif specialtags.get("#compression") == "bz2":
-            f = bz2.BZ2File(target + ".tmp", "r")
-            shutil.copyfileobj(f, open(target, "wb"))
-        f.close()
-        os.remove(target + ".tmp")
 
     if ConsoleProgressBar and type(callback) == DownloadProgress:
         callback.finish()
 
 
+def download_many(files, serverfiles=None, max_workers=4, callback=None,
+                  outdated_only=False, **kwargs):
+    """
+    Download many `(domain, filename)` pairs from the repository with up
+    to `max_workers` downloads in flight (sharing the pooled connections
+    of `serverfiles`). `callback`, if given, is called with the
+    `(domain, filename)` pair of each completed download. If
+    `outdated_only` is True files are downloaded with :obj:`update` (only
+    if they need an update, checked while holding the file lock).
+    Additional arguments are passed to the :obj:`download` function.
+    """
+    if not serverfiles:
+        serverfiles = ServerFiles()
+    files = list(files)
+    kwargs.setdefault("verbose", False)
+
+    def fetch(domain_filename):
+        domain, filename = domain_filename
+        if outdated_only:
+            if not update(domain, filename, serverfiles=serverfiles,
+                          **kwargs):
+                return None
+        else:
+            download(domain, filename, serverfiles=serverfiles, **kwargs)
+        return domain_filename
+
+    if max_workers > 1 and len(files) > 1:
+        pool = ThreadPool(min(max_workers, len(files)))
+        results = pool.imap_unordered(fetch, files)
+    else:
+        pool = None
+        results = six.moves.map(fetch, files)
+    try:
+        for domain_filename in results:
+            if callback and domain_filename is not None:
+                callback(domain_filename)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
 @_locked
 def localpath_download(domain, filename, **kwargs):
     """ 
@@ -636,7 +927,8 @@ def allinfo(domain):
 
 def needs_update(domain, filename, serverfiles=None):
     """True if a file does not exist in the local repository
-    or if there is a newer version on the server."""
+    or if there is a newer version on the server (as listed in the
+    cached :obj:`server_index`)."""
     if serverfiles == None: serverfiles = ServerFiles()
     if filename not in listfiles(domain):
         return True
@@ -644,19 +936,104 @@ def needs_update(domain, filename, serverfiles=None):
     dt_local = datetime.datetime.strptime(
         info(domain, filename)["datetime"][:19], dt_fmt)
     dt_server = datetime.datetime.strptime(
-        serverfiles.info(domain, filename)["datetime"][:19], dt_fmt)
+        _server_info(serverfiles, domain, filename)["datetime"][:19], dt_fmt)
     return dt_server > dt_local
 
+@_locked
 def update(domain, filename, serverfiles=None, **kwargs):
     """Downloads the corresponding file from the server and places it in 
     the local repository, but only if the server copy of the file is newer 
     or the local copy does not exist. An optional  :class:`ServerFiles` object
-    can be passed for authenticated access.
+    can be passed for authenticated access. Return True if the file was
+    downloaded.
     """
     if serverfiles == None: serverfiles = ServerFiles()
     if needs_update(domain, filename, serverfiles=serverfiles):
-        download(domain, filename, serverfiles=serverfiles, **kwargs)
+        download.unwraped(domain, filename, serverfiles=serverfiles, **kwargs)
+        return True
+    return False
         
+_index_lock = threading.Lock()
+_index_cache = {}
+
+
+def _index_key(serverfiles):
+    return (serverfiles.server, serverfiles.username, serverfiles.access_code)
+
+
+def _index_path():
+    return os.path.join(localpath(), "server_index.pck")
+
+
+def server_index(serverfiles=None, ttl=None, refresh=False):
+    """
+    Return a dictionary with `(domain, filename)` keys and info
+    dictionaries (as returned by :obj:`ServerFiles.info`) of all files
+    on the server.
+
+    The index is fetched with one `allinfo` request per domain and
+    cached in memory and in the local repository for `ttl` seconds
+    (:obj:`INDEX_TTL` by default). Pass `refresh=True` to fetch it
+    regardless of its age. If the server can not be reached an outdated
+    cached index is returned.
+    """
+    if serverfiles is None:
+        serverfiles = ServerFiles()
+    if ttl is None:
+        ttl = INDEX_TTL
+    key = _index_key(serverfiles)
+    path = _index_path()
+
+    def fresh(cached):
+        return cached is not None and cached["key"] == key and \
+            0 <= time.time() - cached["time"] < ttl
+
+    with _index_lock:
+        cached = _index_cache.get(key)
+        if not refresh and fresh(cached):
+            return cached["infos"]
+
+        flock = _FileLock(path)
+        flock.acquire()
+        try:
+            if cached is None or not refresh:
+                try:
+                    with open(path, "rb") as f:
+                        cached = pickle.load(f)
+                except Exception:
+                    cached = None
+                if not refresh and fresh(cached):
+                    _index_cache[key] = cached
+                    return cached["infos"]
+
+            try:
+                infos = serverfiles.allinfo_many()
+            except Exception:
+                if cached is not None and cached["key"] == key:
+                    return cached["infos"]
+                raise
+            cached = {"key": key, "time": time.time(), "infos": infos}
+            _create_path(localpath())
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+            _replace(path + ".tmp", path)
+        finally:
+            flock.release()
+        _index_cache[key] = cached
+        return cached["infos"]
+
+
+def _server_info(serverfiles, domain, filename):
+    """
+    Return the server info of a file from the cached server index (or
+    with an `info` request for files not in the index).
+    """
+    info = server_index(serverfiles).get((domain, filename))
+    if info is None:
+        info = serverfiles.info(domain, filename)
+    return info
+
+
 def _searchinfo():
     domains = listdomains()
     infos = {}
@@ -854,28 +1231,34 @@ def consoleupdate(domains=None, searchstr="essential"):
         except Exception as ex:
             print("Error occured:", ex)
 
-def update_local_files(verbose=True):
+def _update_files(files, sf, verbose=True, max_workers=4):
+    """
+    Download the outdated `(domain, filename)` pairs of `files` (checked
+    against the cached server index) in parallel.
+    """
+    files = list(files)
+    outdated = [(domain, filename) for domain, filename in files
+                if needs_update(domain, filename, serverfiles=sf)]
+    updated = set()
+    # recheck under the file locks (another process may have updated them)
+    download_many(outdated, serverfiles=sf, max_workers=max_workers,
+                  callback=updated.add, outdated_only=True)
+    if verbose:
+        for domain, filename in files:
+            print(filename,
+                  "Updated" if (domain, filename) in updated else "Ok")
+
+def update_local_files(verbose=True, max_workers=4):
     sf = ServerFiles()
-    for domain, filename in search(""):
-        uptodate = sf.info(domain, filename)["datetime"] <= info(domain, filename)["datetime"]
-        if not uptodate:
-            download(domain, filename, sf)
-        if verbose:
-            print(filename, "Ok" if uptodate else "Updated")
-
-def update_by_tags(tags=["essential"], domains=[], verbose=True):
+    _update_files(search(""), sf, verbose=verbose, max_workers=max_workers)
+
+def update_by_tags(tags=["essential"], domains=[], verbose=True,
+                   max_workers=4):
     sf = ServerFiles()
-    for domain, filename in sf.search(tags + domains, inTitle=False, inName=False):
-        if domains and domain not in domain:
-            continue
-        if os.path.exists(localpath(domain, filename)+".info"):
-            uptodate = sf.info(domain, filename)["datetime"] <= info(domain, filename)["datetime"]
-        else:
-            uptodate = False
-        if not uptodate:
-            download(domain, filename, sf)
-        if verbose:
-            print(filename, "Ok" if uptodate else "Updated")
+    files = [(domain, filename) for domain, filename in
+             sf.search(tags + domains, inTitle=False, inName=False)
+             if not domains or domain in domains]
+    _update_files(files, sf, verbose=verbose, max_workers=max_workers)
             
 def _example(myusername, mypassword):
 
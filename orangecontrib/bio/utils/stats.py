@@ -1,7 +1,10 @@
+import os
 import math
 import threading
 import six
 
+import numpy
+
 
 def _lngamma(z):
     x = 0
@@ -18,42 +21,147 @@ def _lngamma(z):
     return math.log(x) - 5.58106146679532777 - z + (z - 0.5) * math.log(z + 6.5)
         
 
+# the maximum number of terms evaluated at once by LogBin._sum_pmf
+_MAX_CELLS = 2 ** 20
+
+
+def _xlogy(x, logy):
+    """ x * logy with 0 * -inf == 0. """
+    return numpy.where(x == 0, 0.0, x * logy)
+
+
+def _log_factorial_table(n):
+    """ Return a numpy array of log(i!) for i in range(n). """
+    try:
+        from scipy.special import gammaln
+    except ImportError:
+        return numpy.fromiter(
+            (math.lgamma(i + 1) for i in six.moves.range(n)),
+            dtype=float, count=n)
+    else:
+        return gammaln(numpy.arange(1, n + 1, dtype=float))
+
+
 class LogBin(object):
-    _max = 2
-    _lookup = [0.0, 0.0]
-    _max_factorial = 1
+    _max = 0
+    _lookup = numpy.zeros(0)
     _lock = threading.Lock()
+    _cache_file = None
 
     def __init__(self, max=1000):
         self._extend(max)
 
     @staticmethod
-    def _extend(max):
+    def set_cache_file(filename):
+        """ Store the log factorial table in `filename` (a .npy file) and
+        memory map it from there. Processes using the same file share the
+        table instead of each computing its own.
+        """
+        with LogBin._lock:
+            LogBin._cache_file = filename
+            LogBin._max = 0
+            LogBin._lookup = numpy.zeros(0)
+
+    @staticmethod
+    def _extend(size):
         with LogBin._lock:
-            if max <= LogBin._max:
+            if size <= LogBin._max:
                 return
-            for i in range(LogBin._max, max):
-                if i > 1000: ## an arbitrary cuttof
-                    LogBin._lookup.append(LogBin._logfactorial(i))
-                else:
-                    LogBin._max_factorial *= i
-                    LogBin._lookup.append(math.log(LogBin._max_factorial))
-            LogBin._max = max
+            # grow geometrically so repeated extensions stay cheap
+            size = max(size, 2 * LogBin._max)
+            filename = LogBin._cache_file
+            lookup = None
+            if filename is not None and os.path.exists(filename):
+                lookup = numpy.load(filename, mmap_mode="r")
+                if len(lookup) < size:
+                    lookup = None
+            if lookup is None:
+                lookup = _log_factorial_table(size)
+                if filename is not None:
+                    tmp = "%s.%d.tmp" % (filename, os.getpid())
+                    with open(tmp, "wb") as f:
+                        numpy.save(f, lookup)
+                    os.rename(tmp, filename)
+                    lookup = numpy.load(filename, mmap_mode="r")
+            LogBin._lookup = lookup
+            LogBin._max = len(lookup)
 
     def _logbin(self, n, k):
         if n >= self._max:
             self._extend(n + 100)
         if k < n and k >= 0:
-            return self._lookup[n] - self._lookup[n - k] - self._lookup[k]
+            lookup = self._lookup
+            return float(lookup[n] - lookup[n - k] - lookup[k])
         else:
             return 0.0
 
-    @staticmethod
-    def _logfactorial(n):
-        if (n <= 1):
-            return 0.0
-        else:
-            return _lngamma(n + 1)
+    def _log_factorials(self, n):
+        """ Return a numpy array of log(i!) for i in range(n + 1) or more.
+        """
+        if n >= self._max:
+            self._extend(n + 100)
+        return LogBin._lookup
+
+    def _logbin_array(self, n, k):
+        """ Element-wise log(bin(n, k)) of integer arrays (-inf where
+        k is out of the [0, n] range).
+        """
+        n, k = numpy.broadcast_arrays(n, k)
+        lf = self._log_factorials(int(n.max()) if n.size else 0)
+        valid = (k >= 0) & (k <= n)
+        n, k = numpy.where(valid, n, 0), numpy.where(valid, k, 0)
+        return numpy.where(valid, lf[n] - lf[n - k] - lf[k], -numpy.inf)
+
+    def _sum_pmf(self, start, stop, *params):
+        """ Return sum(exp(self._log_pmf(i, *params))) for i in
+        range(start, stop) element-wise over the 1D arrays `start`,
+        `stop` and `params`.
+        """
+        width = numpy.maximum(stop - start, 0)
+        out = numpy.zeros(len(width))
+        if not len(width) or not width.max():
+            return out
+        offsets = numpy.arange(width.max())
+        # evaluate at most _MAX_CELLS terms at once
+        step = max(1, _MAX_CELLS // len(offsets))
+        for s in range(0, len(width), step):
+            sl = slice(s, s + step)
+            valid = offsets < width[sl, None]
+            i = numpy.where(valid, start[sl, None] + offsets, start[sl, None])
+            log_pmf = self._log_pmf(i, *[p[sl, None] for p in params])
+            out[sl] = numpy.where(valid, numpy.exp(log_pmf), 0.0).sum(axis=1)
+        return out
+
+    def p_values(self, k, N, m, n):
+        """ Array version of :obj:`p_value`. `k`, `N`, `m` and `n` are
+        integer arrays (or scalars) broadcast against each other. Return
+        an array of probabilities that k or more tests are positive.
+        """
+        arrays = numpy.broadcast_arrays(
+            *[numpy.asarray(a, dtype=numpy.int64) for a in (k, N, m, n)])
+        shape = arrays[0].shape
+        k, N, m, n = [a.ravel() for a in arrays]
+        lo, hi = self._support(N, m, n)
+        p = numpy.empty(len(k))
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            # sum the shorter side of the distribution
+            upper = (hi - k + 1) <= (k - lo)
+            p[upper] = self._sum_pmf(k[upper], hi[upper] + 1, N[upper],
+                                     m[upper], n[upper])
+            lower = ~upper
+            p[lower] = 1.0 - self._sum_pmf(lo[lower], k[lower], N[lower],
+                                           m[lower], n[lower])
+            # if the value is small it is probably inexact due to the
+            # limited precision of floats (1-(1-1e-20)) -> 0, so compute
+            # it without subtraction
+            inexact = lower & (p < 1e-3)
+            p[inexact] = self._sum_pmf(k[inexact], hi[inexact] + 1,
+                                       N[inexact], m[inexact], n[inexact])
+        return numpy.clip(p, 0.0, 1.0).reshape(shape)
+
+    def p_value(self, k, N, m, n):
+        """ The probability that k or more tests are positive. """
+        return float(self.p_values(k, N, m, n))
 
 class Binomial(LogBin):
     """ `Binomial distribution 
@@ -86,21 +194,13 @@ class Binomial(LogBin):
             raise
 ##        return math.exp(self._logbin(n, k) + math.log((p**k) * (1.0 - p)**(n - k)))
 
-    def p_value(self, k, N, m, n):
-        """ The probability that k or more tests are positive. """
-        if n - k + 1 <= k:
-            #starting from k gives the shorter list of values
-            return sum(self.__call__(i, N, m, n) for i in range(k, n+1))
-        else:
-            value = 1.0 - sum(self.__call__(i, N, m, n) for i in range(k))
-            #if the value is small it is probably inexact due to the limited
-            #precision of floats, as for example  (1-(1-1e-20)) -> 0
-            #if so, compute the result without substraction
-            if value < 1e-3: #arbitary threshold
-                #print "INEXACT", value, sum(self.__call__(i, N, m, n) for i in range(k, n+1))
-                return sum(self.__call__(i, N, m, n) for i in range(k, n+1))
-            else:
-                return value
+    def _support(self, N, m, n):
+        return numpy.zeros_like(n), n
+
+    def _log_pmf(self, i, N, m, n):
+        p = 1.0 * m / N
+        return self._logbin_array(n, i) + _xlogy(i, numpy.log(p)) + \
+               _xlogy(n - i, numpy.log1p(-p))
 
 class Hypergeometric(LogBin):
     """ `Hypergeometric distribution
@@ -125,87 +225,144 @@ class Hypergeometric(LogBin):
             print(k, N, m, n)
             raise
 
-    def p_value(self, k, N, m, n):
-        """ 
-        The probability that k or more tests are positive.
-        """
+    def _support(self, N, m, n):
+        return numpy.maximum(0, n + m - N), numpy.minimum(n, m)
 
-        if min(n,m) - k + 1 <= k:
-            #starting from k gives the shorter list of values
-            return sum(self.__call__(i, N, m, n) for i in range(k, min(n,m)+1))
-        else:
-            value = 1.0 - sum(self.__call__(i, N, m, n) for i in (range(k)))
-            #if the value is small it is probably inexact due to the limited
-            #precision of floats, as for example  (1-(1-1e-20)) -> 0
-            #if so, compute the result without substraction
-            if value < 1e-3: #arbitary threshold
-                #print "INEXACT", value, sum(self.__call__(i, N, m, n) for i in range(k, min(n,m)+1))
-                return sum(self.__call__(i, N, m, n) for i in range(k, min(n,m)+1))
-            else:
-                return value
+    def _log_pmf(self, i, N, m, n):
+        return self._logbin_array(m, i) + self._logbin_array(N - m, n - i) - \
+               self._logbin_array(N, n)
+
+## to speed-up FDR, sum([1/i for i in range(1, m+1)]) is looked up in a
+## table for m in [1, 100000], computed on first use. For higher values of m
+## use an approximation, with error less or equal to 4.99999157277e-006.
+## (sum([1/i for i in range(1, m+1)])  ~ log(m) + 0.5772..., 0.5572 is an
+## Euler-Mascheroni constant)
+_harmonic_table = None
 
-## to speed-up FDR, calculate ahead sum([1/i for i in range(1, m+1)]), for m in [1,100000]. For higher values of m use an approximation, with error less or equal to 4.99999157277e-006. (sum([1/i for i in range(1, m+1)])  ~ log(m) + 0.5772..., 0.5572 is an Euler-Mascheroni constant) 
-c = [1.0]
-for m in range(2, 100000):
-    c.append( c[-1] + 1.0/m)
+
+def _harmonic(m):
+    global _harmonic_table
+    if _harmonic_table is None:
+        _harmonic_table = numpy.cumsum(1.0 / numpy.arange(1, 100000))
+    if m <= len(_harmonic_table):
+        return float(_harmonic_table[m - 1])
+    else:
+        return math.log(m) + 0.57721566490153286060651209008240243104215933593992
 
 def is_sorted(l):
-    return all(l[i] <= l[i+1] for i in range(len(l)-1))
+    l = numpy.asarray(l)
+    return bool(numpy.all(l[:-1] <= l[1:]))
 
-def FDR(p_values, dependent=False, m=None, ordered=False):
+def _p_values_array(p_values, inplace):
+    """ Return `p_values` as a float numpy array (the array itself if
+    `inplace`).
     """
-    `False Discovery Rate <http://en.wikipedia.org/wiki/False_discovery_rate>`_ correction on a list of p-values.
+    if inplace:
+        if not isinstance(p_values, numpy.ndarray) or \
+                p_values.dtype.kind != "f":
+            raise TypeError("inplace requires a float numpy array")
+        return p_values
+    return numpy.array(p_values, dtype=float)
 
-    :param p_values: a list of p-values.
-    :param dependent: use correction for dependent hypotheses (default False).
-    :param m: number of hypotheses tested (default ``len(p_values)``).
-    :param ordered: prevent sorting of p-values if they are already sorted (default False).
+def _adjust_sorted(p_values, adjust, ordered):
+    """ Apply `adjust` to ascending sorted `p_values` (sorting them
+    first unless `ordered`) and store the results back into `p_values`.
     """
+    if ordered:
+        adjust(p_values)
+    else:
+        order = numpy.argsort(p_values, kind="mergesort")
+        sorted_p = p_values[order]
+        adjust(sorted_p)
+        p_values[order] = sorted_p
 
-    if not ordered:
-        ordered = is_sorted(p_values)
+def _result(adjusted, p_values):
+    """ Return `adjusted` as a list if `p_values` was not a numpy array.
+    """
+    if isinstance(p_values, numpy.ndarray):
+        return adjusted
+    return adjusted.tolist()
 
-    if not ordered:
-        joined = [ (v,i) for i,v in enumerate(p_values) ]
-        joined.sort()
-        p_values = [ p[0] for p in joined ]
-        indices = [ p[1] for p in joined ]
+def FDR(p_values, dependent=False, m=None, ordered=False, inplace=False):
+    """
+    `False Discovery Rate <http://en.wikipedia.org/wiki/False_discovery_rate>`_
+    (Benjamini-Hochberg) correction on a list or a numpy array of p-values.
 
+    :param p_values: a list or a numpy array of p-values.
+    :param dependent: use correction for dependent hypotheses (default False).
+    :param m: number of hypotheses tested (default ``len(p_values)``).
+    :param ordered: prevent sorting of p-values if they are already sorted (default False).
+    :param inplace: store the results into `p_values` (a float numpy array).
+    """
+    p = _p_values_array(p_values, inplace)
     if not m:
-        m = len(p_values)
-    if m <= 0 or not p_values:
-        return []
+        m = len(p)
+    if m <= 0 or not len(p):
+        return _result(p, p_values)
 
     if dependent: # correct q for dependent tests
-        k = c[m-1] if m <= len(c) else math.log(m) + 0.57721566490153286060651209008240243104215933593992
+        k = _harmonic(m)
         m = m * k
 
-    tmp_fdrs = [p*m/(i+1.0) for (i, p) in enumerate(p_values)]
-    fdrs = []
-    cmin = tmp_fdrs[-1]
-    for f in reversed(tmp_fdrs):
-        cmin = min(f, cmin)
-        fdrs.append( cmin)
-    fdrs.reverse()
+    def adjust(sorted_p):
+        sorted_p *= m
+        sorted_p /= numpy.arange(1, len(sorted_p) + 1)
+        numpy.minimum.accumulate(sorted_p[::-1], out=sorted_p[::-1])
+
+    _adjust_sorted(p, adjust, ordered)
+    return _result(p, p_values)
 
-    if not ordered:
-        new = [ None ] * len(fdrs)
-        for v,i in zip(fdrs, indices):
-            new[i] = v
-        fdrs = new
+def BenjaminiYekutieli(p_values, m=None, ordered=False, inplace=False):
+    """
+    `Benjamini-Yekutieli <http://en.wikipedia.org/wiki/False_discovery_rate>`_
+    correction (false discovery rate under arbitrary dependence) on a list
+    or a numpy array of p-values. Same as ``FDR(p_values, dependent=True)``.
 
-    return fdrs
+    :param p_values: a list or a numpy array of p-values.
+    :param m: number of hypotheses tested (default ``len(p_values)``).
+    :param ordered: prevent sorting of p-values if they are already sorted (default False).
+    :param inplace: store the results into `p_values` (a float numpy array).
+    """
+    return FDR(p_values, dependent=True, m=m, ordered=ordered,
+               inplace=inplace)
 
-def Bonferroni(p_values, m=None):
+def Bonferroni(p_values, m=None, inplace=False):
     """
-    `Bonferroni correction <http://en.wikipedia.org/wiki/Bonferroni_correction>`_ correction on a list of p-values.
+    `Bonferroni correction <http://en.wikipedia.org/wiki/Bonferroni_correction>`_ correction on a list or a numpy array of p-values.
 
-    :param p_values: a list of p-values.
+    :param p_values: a list or a numpy array of p-values.
     :param m: number of hypotheses tested (default ``len(p_values)``).
+    :param inplace: store the results into `p_values` (a float numpy array).
     """
+    p = _p_values_array(p_values, inplace)
     if not m:
-        m = len(p_values)
+        m = len(p)
     if m == 0:
-        return []
-    m = float(m)
-    return [p/m for p in p_values]
+        return _result(p, p_values)
+    p *= m
+    numpy.minimum(p, 1.0, out=p)
+    return _result(p, p_values)
+
+def Holm(p_values, m=None, ordered=False, inplace=False):
+    """
+    `Holm-Bonferroni <http://en.wikipedia.org/wiki/Holm-Bonferroni_method>`_
+    correction on a list or a numpy array of p-values.
+
+    :param p_values: a list or a numpy array of p-values.
+    :param m: number of hypotheses tested (default ``len(p_values)``).
+    :param ordered: prevent sorting of p-values if they are already sorted (default False).
+    :param inplace: store the results into `p_values` (a float numpy array).
+    """
+    p = _p_values_array(p_values, inplace)
+    if not m:
+        m = len(p)
+    if m <= 0 or not len(p):
+        return _result(p, p_values)
+
+    def adjust(sorted_p):
+        sorted_p *= m - numpy.arange(len(sorted_p))
+        numpy.maximum.accumulate(sorted_p, out=sorted_p)
+        numpy.minimum(sorted_p, 1.0, out=sorted_p)
+
+    _adjust_sorted(p, adjust, ordered)
+    return _result(p, p_values)